@@ -0,0 +1,194 @@
+﻿"""
+Almacenamiento local del stock en modo JSON
+===========================================
+
+Stock en memoria con redo log y volcado diferido a stock.json, compartido por
+app.py y app_modular.py.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class AlmacenStockJSON:
+    """Stock en memoria como fuente de verdad del modo JSON, con persistencia diferida
+    
+    Cada cambio se agrega primero a un redo log (append + fsync) y se aplica en memoria.
+    Un hilo de volcado reescribe stock.json en formato compacto (archivo temporal +
+    fsync + rename) cuando termina la ráfaga de escrituras. Al arrancar se carga el
+    último volcado y se reaplica el redo log, así un corte no pierde cambios confirmados.
+    Cada proceso mantiene su propia copia: pensado para un único worker.
+    """
+    
+    def __init__(self, ruta, espera_ms=500, espera_max_ms=5000):
+        self.ruta = ruta
+        self.ruta_redo = ruta + '.redo'
+        self.espera = espera_ms / 1000
+        self.espera_max = espera_max_ms / 1000
+        self._datos = None
+        self._primer_cambio = None
+        self._ultimo_cambio = None
+        self._volcador_activo = False
+        self._lock = threading.RLock()
+    
+    def existe(self):
+        """Indica si hay stock persistido (o ya cargado en memoria)"""
+        return self._datos is not None or os.path.exists(self.ruta) or os.path.exists(self.ruta_redo)
+    
+    def _asegurar_cargado(self):
+        """Leer el último volcado y reaplicar el redo log (solo la primera vez)"""
+        if self._datos is not None:
+            return
+        datos = {}
+        if os.path.exists(self.ruta):
+            with open(self.ruta, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+        
+        aplicados = 0
+        if os.path.exists(self.ruta_redo):
+            with open(self.ruta_redo, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        entrada = json.loads(linea)
+                    except json.JSONDecodeError:
+                        # Última línea incompleta por un corte durante la escritura
+                        break
+                    self._aplicar(datos, entrada)
+                    aplicados += 1
+        
+        self._datos = datos
+        if aplicados:
+            print(f"🔁 Redo log de stock reaplicado: {aplicados} cambios")
+            self._programar_volcado()
+    
+    @staticmethod
+    def _aplicar(datos, entrada):
+        """Aplicar una entrada del redo log sobre un diccionario de stock"""
+        if entrada.get('op') == 'del':
+            datos.pop(entrada['codigo'], None)
+        else:
+            datos[entrada['codigo']] = entrada['item']
+    
+    def cargar(self):
+        """Copia del stock actual (los requests la modifican sin tocar la memoria compartida)"""
+        with self._lock:
+            self._asegurar_cargado()
+            return {codigo: dict(item) for codigo, item in self._datos.items()}
+    
+    def cargar_codigos(self, codigos):
+        """Copia de los productos pedidos"""
+        with self._lock:
+            self._asegurar_cargado()
+            return {codigo: dict(self._datos[codigo]) for codigo in codigos if codigo in self._datos}
+    
+    def obtener(self, codigo):
+        """Lectura puntual de un producto (None si no existe)"""
+        return self.cargar_codigos([codigo]).get(codigo)
+    
+    def guardar(self, stock_data, modificados=None, eliminados=None):
+        """Registrar cambios: redo log durable primero, memoria después y volcado diferido"""
+        with self._lock:
+            self._asegurar_cargado()
+            if modificados is None and eliminados is None:
+                # Sin detalle de cambios: se calcula la diferencia con la memoria
+                modificados = [codigo for codigo, item in stock_data.items() if self._datos.get(codigo) != item]
+                eliminados = [codigo for codigo in self._datos if codigo not in stock_data]
+            
+            entradas = [{'op': 'set', 'codigo': codigo, 'item': dict(stock_data[codigo])} for codigo in modificados or ()]
+            entradas += [{'op': 'del', 'codigo': codigo} for codigo in eliminados or ()]
+            if not entradas:
+                return
+            
+            self._escribir_redo(entradas)
+            for entrada in entradas:
+                self._aplicar(self._datos, entrada)
+            self._programar_volcado()
+    
+    def _escribir_redo(self, entradas):
+        """Agregar entradas al redo log y forzarlas a disco"""
+        os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+        contenido = ''.join(json.dumps(entrada, ensure_ascii=False, separators=(',', ':')) + '\n' for entrada in entradas)
+        with open(self.ruta_redo, 'a', encoding='utf-8') as f:
+            f.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def _programar_volcado(self):
+        """Anotar un cambio y asegurar que haya un hilo esperando para volcar"""
+        ahora = time.monotonic()
+        self._ultimo_cambio = ahora
+        if self._primer_cambio is None:
+            self._primer_cambio = ahora
+        if not self._volcador_activo:
+            self._volcador_activo = True
+            threading.Thread(target=self._esperar_y_volcar, name='volcado-stock-json', daemon=True).start()
+    
+    def _esperar_y_volcar(self):
+        """Volcar cuando no hubo cambios durante `espera` o pasó `espera_max` desde el primero
+        
+        Si el volcado falla (disco lleno, permisos) los cambios siguen en el redo log y se
+        reintenta cada `espera_max`; el hilo no termina mientras queden cambios pendientes.
+        """
+        try:
+            while True:
+                with self._lock:
+                    if self._primer_cambio is None:
+                        self._volcador_activo = False
+                        return
+                    ahora = time.monotonic()
+                    restante = min(self.espera - (ahora - self._ultimo_cambio),
+                                   self.espera_max - (ahora - self._primer_cambio))
+                    if restante <= 0:
+                        try:
+                            self.volcar()
+                            continue
+                        except Exception as e:
+                            print(f"❌ Error al volcar {self.ruta}, se reintenta en {self.espera_max:g}s: {e}")
+                            restante = self.espera_max
+                time.sleep(restante)
+        except BaseException:
+            # Un error inesperado no puede dejar la marca puesta sin ningún hilo que vuelque
+            with self._lock:
+                self._volcador_activo = False
+            raise
+    
+    def volcar(self):
+        """Escribir el stock completo de forma atómica y descartar el redo log ya incluido"""
+        with self._lock:
+            if self._datos is None:
+                return
+            os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+            temporal = self.ruta + '.tmp'
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump(self._datos, f, ensure_ascii=False, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporal, self.ruta)
+            fsync_directorio(os.path.dirname(self.ruta))
+            
+            # Reaplicar el redo sobre el nuevo volcado es inofensivo, por eso se borra después
+            if os.path.exists(self.ruta_redo):
+                os.remove(self.ruta_redo)
+            self._primer_cambio = None
+            print(f"💾 Stock volcado a JSON: {len(self._datos)} productos")
+    
+    def drenar(self):
+        """Volcar cambios pendientes (se llama al cerrar el proceso)"""
+        with self._lock:
+            if self._primer_cambio is not None:
+                self.volcar()
+
+def fsync_directorio(directorio):
+    """Forzar a disco la entrada de directorio tras un rename (no disponible en Windows)"""
+    try:
+        fd = os.open(directorio, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -15,15 +15,40 @@ Versión: 1.1
 Fecha: 2025
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, stream_with_context, has_request_context
+import click
+import array
+import atexit
+import bisect
+import codecs
+import csv
+import gzip
+import hashlib
+import itertools
 import json
+import math
+import operator
 import os
-from datetime import datetime
-from collections import defaultdict
+import queue
+import re
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import urllib.request
+import zlib
+from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 import sqlalchemy as sa
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import SQLAlchemyError
 
+from almacen_json import AlmacenStockJSON, fsync_directorio
+
 # =====================================
 # CONFIGURACIÓN DE LA APLICACIÓN
 # =====================================
@@ -48,6 +73,12 @@ def safe_init():
         print("✅ [GUNICORN] Archivos verificados")
     except Exception as e:
         print(f"⚠️ [GUNICORN] Error en archivos (continuando): {e}")
+    
+    try:
+        alertas_stock.inicializar()
+        print("✅ [GUNICORN] Estado de alertas calculado")
+    except Exception as e:
+        print(f"⚠️ [GUNICORN] Error en alertas (continuando): {e}")
 
 # Configuración de base de datos
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///local_data.db')
@@ -58,7 +89,141 @@ if DATABASE_URL.startswith('postgres://'):
     DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
     print("🔄 Convertida postgres:// a postgresql://")
 
+# Réplica opcional de solo lectura para los GET (reportes, exportaciones, consultas)
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL', '')
+if DATABASE_READ_URL.startswith('postgres://'):
+    DATABASE_READ_URL = DATABASE_READ_URL.replace('postgres://', 'postgresql://', 1)
+
+# Segundos en que una sesión que escribió sigue leyendo de la primaria (leer lo propio)
+REPLICA_PEGAJOSA_SEGUNDOS = int(os.environ.get('REPLICA_PEGAJOSA_SEGUNDOS', 10))
+COOKIE_ESCRITURA_RECIENTE = 'escritura_reciente'
+
 engine = None
+engine_lectura = None
+
+def columna_serial():
+    """Clave primaria autoincremental según el motor (SQLite no conoce SERIAL)"""
+    return 'INTEGER PRIMARY KEY AUTOINCREMENT' if engine.dialect.name == 'sqlite' else 'SERIAL PRIMARY KEY'
+
+def columna_binaria():
+    """Tipo de columna para datos binarios según el motor"""
+    return 'BLOB' if engine.dialect.name == 'sqlite' else 'BYTEA'
+
+def agregar_columna_si_falta(conn, tabla, columna, tipo):
+    """Migración aditiva: agregar la columna solo si la tabla todavía no la tiene"""
+    existentes = {columna_db['name'] for columna_db in sa.inspect(conn).get_columns(tabla)}
+    if columna not in existentes:
+        conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}"))
+        print(f"🔧 Columna {tabla}.{columna} agregada")
+
+def crear_indices_movimientos(conn):
+    """Índices de movimientos: por fecha, historial por código o id de producto y rango por depósito"""
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_fecha ON movimientos (fecha)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_codigo_fecha ON movimientos (codigo, fecha)"))
+    if conn.dialect.name == 'postgresql':
+        # Rangos de prefijo por orden de bytes: con la collation del servidor (p. ej.
+        # es_AR.UTF-8) los '_' no ordenan y el rango podría dejar códigos afuera
+        conn.execute(text('CREATE INDEX IF NOT EXISTS idx_movimientos_codigo_c_fecha ON movimientos ((codigo COLLATE "C"), fecha)'))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_producto_fecha ON movimientos (producto_id, fecha)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_movimientos_ubicacion_fecha ON movimientos (ubicacion, fecha)"))
+
+def bloquear_escrituras(conn):
+    """Esperar a las escrituras en curso y frenar las nuevas hasta el fin de la transacción
+    
+    En PostgreSQL los ids de movimientos pueden confirmarse fuera de orden; con el bloqueo,
+    todo id menor o igual al máximo leído ya está confirmado. SQLite tiene un único escritor.
+    """
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("LOCK TABLE stock, movimientos IN SHARE ROW EXCLUSIVE MODE"))
+
+# =====================================
+# RUTEO DE LECTURAS (RÉPLICA)
+# =====================================
+
+_lecturas_primaria = threading.local()
+
+def init_replica_lectura():
+    """Crear el engine de la réplica; si no responde, todo se sigue leyendo de la primaria"""
+    global engine_lectura
+    if not DATABASE_READ_URL or not engine:
+        return
+    try:
+        replica = create_engine(DATABASE_READ_URL)
+        with replica.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        engine_lectura = replica
+        print(f"✅ Réplica de lectura conectada: {DATABASE_READ_URL.split('@')[1] if '@' in DATABASE_READ_URL else 'local'}")
+    except Exception as e:
+        print(f"⚠️ Réplica de lectura no disponible, se lee de la primaria: {e}")
+
+def escritura_reciente():
+    """Indica si la sesión del request escribió hace menos de REPLICA_PEGAJOSA_SEGUNDOS"""
+    try:
+        ultima = float(request.cookies.get(COOKIE_ESCRITURA_RECIENTE, 0))
+    except ValueError:
+        return False
+    return time.time() - ultima < REPLICA_PEGAJOSA_SEGUNDOS
+
+def leyendo_de_replica():
+    """Las lecturas van a la réplica solo dentro de un GET de una sesión sin escrituras recientes
+    
+    Los requests que escriben, las tareas de fondo y los comandos leen de la primaria:
+    leen para después escribir y no pueden ver datos atrasados.
+    """
+    if engine_lectura is None or getattr(_lecturas_primaria, 'activo', False) or not has_request_context():
+        return False
+    return request.method in ('GET', 'HEAD') and not escritura_reciente()
+
+def motor_lectura():
+    """Engine para una consulta de solo lectura según el request en curso"""
+    return engine_lectura if leyendo_de_replica() else engine
+
+def reintentar_en_primaria(funcion):
+    """Decorador: si una lectura dirigida a la réplica falla, se repite una vez en la primaria
+    
+    Dentro de la función, el error de la réplica se relanza en vez de caer al respaldo
+    JSON: el respaldo solo se usa si también falla la primaria.
+    """
+    @wraps(funcion)
+    def envoltura(*args, **kwargs):
+        if not leyendo_de_replica():
+            return funcion(*args, **kwargs)
+        try:
+            return funcion(*args, **kwargs)
+        except Exception as e:
+            print(f"⚠️ Falló la lectura en la réplica ({funcion.__name__}), reintentando en la primaria: {e}")
+            with lecturas_en_primaria():
+                return funcion(*args, **kwargs)
+    return envoltura
+
+@contextmanager
+def lecturas_en_primaria():
+    """Forzar la primaria para las lecturas del bloque (en este hilo)"""
+    anterior = getattr(_lecturas_primaria, 'activo', False)
+    _lecturas_primaria.activo = True
+    try:
+        yield
+    finally:
+        _lecturas_primaria.activo = anterior
+
+def stock_para_indice(stock=None):
+    """Stock para armar un índice incremental, siempre visto desde la primaria
+    
+    Los cambios anteriores al armado no se vuelven a notificar: un stock leído de una
+    réplica atrasada los perdería hasta el próximo reinicio.
+    """
+    if stock is not None and not leyendo_de_replica():
+        return stock
+    with lecturas_en_primaria():
+        return cargar_stock()
+
+@app.after_request
+def marcar_escritura_reciente(response):
+    """Después de una escritura exitosa, la sesión lee de la primaria por un rato"""
+    if engine_lectura is not None and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        response.set_cookie(COOKIE_ESCRITURA_RECIENTE, str(time.time()),
+                            max_age=REPLICA_PEGAJOSA_SEGUNDOS, httponly=True, samesite='Lax')
+    return response
 
 def init_database():
     """Inicializar conexión a la base de datos"""
@@ -81,7 +246,7 @@ def init_database():
         
         # Crear tablas si no existen
         print("📝 Creando tablas...")
-        with engine.connect() as conn:
+        with engine.begin() as conn:
             # Tabla de stock
             conn.execute(text("""
                 CREATE TABLE IF NOT EXISTS stock (
@@ -103,23 +268,87 @@ def init_database():
                 )
             """))
             
-            # Tabla de movimientos
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS movimientos (
-                    id SERIAL PRIMARY KEY,
+            # Clave sustituta entera; el código sigue siendo la clave natural
+            if engine.dialect.name == 'postgresql':
+                agregar_columna_si_falta(conn, 'stock', 'id', 'SERIAL')
+            else:
+                # SQLite no agrega columnas autoincrementales: se usa el rowid (modo local; puede
+                # reutilizar el id del último producto borrado)
+                agregar_columna_si_falta(conn, 'stock', 'id', 'INTEGER')
+                conn.execute(text("UPDATE stock SET id = rowid WHERE id IS NULL"))
+                conn.execute(text("""
+                    CREATE TRIGGER IF NOT EXISTS trg_stock_id AFTER INSERT ON stock
+                    FOR EACH ROW WHEN NEW.id IS NULL
+                    BEGIN UPDATE stock SET id = NEW.rowid WHERE rowid = NEW.rowid; END
+                """))
+            conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_id ON stock (id)"))
+            try:
+                with conn.begin_nested():
+                    conn.execute(text("""
+                        CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_natural
+                        ON stock (tipo, titulo, caracteristica, color, lote, ubicacion)
+                    """))
+            except Exception as e:
+                print(f"⚠️ No se pudo crear el índice único de atributos (¿lotes duplicados?): {e}")
+            # Cada depósito es un fragmento del stock: sus consultas recorren solo su rango del índice
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_stock_ubicacion ON stock (ubicacion)"))
+            
+            # Tabla de movimientos (en PostgreSQL, particionada por mes)
+            if engine.dialect.name == 'postgresql':
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS movimientos (
+                        id SERIAL,
+                        {COLUMNAS_MOVIMIENTOS_DDL},
+                        PRIMARY KEY (id, fecha)
+                    ) PARTITION BY RANGE (fecha)
+                """))
+            else:
+                conn.execute(text(f"""
+                    CREATE TABLE IF NOT EXISTS movimientos (
+                        id {columna_serial()},
+                        {COLUMNAS_MOVIMIENTOS_DDL}
+                    )
+                """))
+            # Imagen del producto después del movimiento (ledger del stock)
+            agregar_columna_si_falta(conn, 'movimientos', 'datos', 'TEXT')
+            agregar_columna_si_falta(conn, 'movimientos', 'producto_id', 'INTEGER')
+            crear_indices_movimientos(conn)
+            particiones_movimientos.detectar(conn)
+            
+            # Snapshots del stock proyectado desde el ledger
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS stock_snapshots (
+                    id {columna_serial()},
+                    ultimo_movimiento_id INTEGER NOT NULL,
                     fecha TIMESTAMP,
-                    tipo VARCHAR(50),
-                    codigo VARCHAR(255),
-                    descripcion TEXT,
-                    cantidad INTEGER,
-                    ubicacion VARCHAR(100),
-                    usuario VARCHAR(100)
+                    origen VARCHAR(20),
+                    productos INTEGER,
+                    datos {columna_binaria()}
+                )
+            """))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_ultimo ON stock_snapshots (ultimo_movimiento_id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_stock_snapshots_fecha ON stock_snapshots (fecha)"))
+            
+            # Alertas de cruce de umbral
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS alertas_stock (
+                    id {columna_serial()},
+                    fecha TIMESTAMP,
+                    grupo TEXT,
+                    estado VARCHAR(20),
+                    estado_anterior VARCHAR(20),
+                    cantidad FLOAT,
+                    umbral_bajo FLOAT,
+                    umbral_critico FLOAT,
+                    codigo VARCHAR(255)
                 )
             """))
             
-            conn.commit()
             print("✅ Base de datos PostgreSQL inicializada correctamente")
             print(f"🎯 Conectado a: {DATABASE_URL.split('@')[1] if '@' in DATABASE_URL else 'local'}")
+        
+        init_replica_lectura()
+        asegurar_snapshot_base()
             
     except Exception as e:
         print(f"❌ Error al inicializar base de datos: {e}")
@@ -130,9 +359,14 @@ def init_database():
 # Configuración de rutas de datos
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 STOCK_FILE = os.path.join(DATA_DIR, 'stock.json')
+STOCK_DAT_FILE = os.path.join(DATA_DIR, 'stock.dat')
 STOCK_INICIAL_FILE = os.path.join(DATA_DIR, 'stock_inicial.json')
 UMBRALES_FILE = os.path.join(DATA_DIR, 'umbrales_config.json')
-MOVIMIENTOS_FILE = os.path.join(DATA_DIR, 'movimientos.json')
+UMBRALES_OVERRIDES_FILE = os.path.join(DATA_DIR, 'umbrales_overrides.json')
+PRECIOS_FILE = os.path.join(DATA_DIR, 'precios_config.json')
+ALERTAS_FILE = os.path.join(DATA_DIR, 'alertas.jsonl')
+MOVIMIENTOS_FILE = os.path.join(DATA_DIR, 'movimientos.json')  # formato anterior, se migra a MOVIMIENTOS_DIR
+MOVIMIENTOS_DIR = os.path.join(DATA_DIR, 'movimientos')
 
 # =====================================
 # CONFIGURACIÓN DE DATOS MAESTROS
@@ -242,6 +476,564 @@ PARAMETROS_CARGA_DEFAULT = {
     }
 }
 
+# Precio estimado por kg cuando el tipo no tiene precio en la lista de precios
+PRECIO_KG_DEFAULT = 10
+
+# =====================================
+# PERSISTENCIA DIFERIDA DEL STOCK JSON
+# =====================================
+
+# Espera sin escrituras antes de volcar stock.json, y demora máxima durante ráfagas
+STOCK_JSON_ESPERA_MS = int(os.environ.get('STOCK_JSON_ESPERA_MS', 500))
+STOCK_JSON_ESPERA_MAX_MS = int(os.environ.get('STOCK_JSON_ESPERA_MAX_MS', 5000))
+
+
+class ArchivoStockIndexado:
+    """Archivo de stock con registros de longitud prefijada e índice codigo -> posición
+    
+    stock.dat es una secuencia de registros agregados al final: cabecera '>IH'
+    (largo del contenido, largo del código), el código y el producto en JSON compacto;
+    un contenido de largo 0 marca una baja. stock.idx guarda un punto de control del
+    índice y la posición hasta la que es válido, así al abrir solo se recorren las
+    cabeceras de los registros posteriores. Una lectura puntual o una actualización
+    tocan un único registro.
+    
+    Ambos archivos llevan el número de generación de stock.dat, que aumenta en cada
+    compactación: un índice de otra generación (por un corte entre el rename del
+    archivo compactado y el guardado del índice) se descarta y se reconstruye.
+    """
+    
+    MAGIA = b'ALVSTK02'
+    MAGIA_V1 = b'ALVSTK01'
+    GENERACION = struct.Struct('>Q')
+    CABECERA = struct.Struct('>IH')
+    
+    def __init__(self, ruta_datos):
+        self.ruta_datos = ruta_datos
+        self.ruta_indice = os.path.splitext(ruta_datos)[0] + '.idx'
+        self._indice = None
+        self._generacion = None
+        self._bytes_muertos = 0
+        self._registros_sin_indexar = 0
+        self._lock = threading.RLock()
+    
+    def existe(self):
+        """Indica si el archivo de datos ya fue creado"""
+        return os.path.exists(self.ruta_datos)
+    
+    def _cabecera_archivo(self, generacion):
+        return self.MAGIA + self.GENERACION.pack(generacion)
+    
+    def _leer_cabecera_archivo(self, f):
+        """Devolver (generación, inicio de los registros); los archivos v1 son la generación 0"""
+        magia = f.read(len(self.MAGIA))
+        if magia == self.MAGIA_V1:
+            return 0, len(self.MAGIA_V1)
+        if magia != self.MAGIA:
+            raise ValueError(f"{self.ruta_datos} no es un archivo de stock indexado")
+        generacion, = self.GENERACION.unpack(f.read(self.GENERACION.size))
+        return generacion, len(self.MAGIA) + self.GENERACION.size
+    
+    def _abrir(self):
+        """Cargar el punto de control del índice y recorrer los registros posteriores"""
+        if self._indice is not None:
+            return
+        if not self.existe():
+            with open(self.ruta_datos, 'wb') as f:
+                f.write(self._cabecera_archivo(1))
+        
+        with open(self.ruta_datos, 'r+b') as f:
+            generacion, inicio = self._leer_cabecera_archivo(f)
+            tamano = f.seek(0, os.SEEK_END)
+            
+            indice, fin, bytes_muertos = {}, inicio, 0
+            if os.path.exists(self.ruta_indice):
+                try:
+                    with open(self.ruta_indice, 'r', encoding='utf-8') as fi:
+                        punto = json.load(fi)
+                    if punto.get('generacion', 0) != generacion:
+                        print(f"⚠️ {self.ruta_indice} no corresponde a la generación {generacion} de {self.ruta_datos}, se reconstruye")
+                    elif inicio <= punto['fin'] <= tamano:
+                        indice = dict(zip(punto['codigos'], zip(punto['posiciones'], punto['largos'])))
+                        fin = punto['fin']
+                        bytes_muertos = punto.get('bytes_muertos', 0)
+                except (OSError, ValueError, KeyError):
+                    pass
+            
+            self._generacion = generacion
+            self._bytes_muertos = bytes_muertos
+            posicion = fin
+            while posicion + self.CABECERA.size <= tamano:
+                f.seek(posicion)
+                largo, largo_codigo = self.CABECERA.unpack(f.read(self.CABECERA.size))
+                inicio_contenido = posicion + self.CABECERA.size + largo_codigo
+                if inicio_contenido + largo > tamano:
+                    break
+                codigo = f.read(largo_codigo).decode('utf-8')
+                self._anotar(indice, codigo, inicio_contenido, largo)
+                self._registros_sin_indexar += 1
+                posicion = inicio_contenido + largo
+            if posicion < tamano:
+                # Registro incompleto por un corte durante la escritura
+                f.truncate(posicion)
+        self._indice = indice
+    
+    def _anotar(self, indice, codigo, posicion, largo):
+        """Actualizar el índice con un registro y contabilizar el espacio que queda obsoleto"""
+        anterior = indice.pop(codigo, None)
+        if anterior:
+            self._bytes_muertos += anterior[1]
+        if largo:
+            indice[codigo] = (posicion, largo)
+        else:
+            self._bytes_muertos += self.CABECERA.size
+    
+    def codigos(self):
+        """Códigos vigentes según el índice"""
+        with self._lock:
+            self._abrir()
+            return list(self._indice.keys())
+    
+    def leer(self, codigos):
+        """Leer solo los registros pedidos (en orden de posición en el archivo)"""
+        with self._lock:
+            self._abrir()
+            ubicados = sorted((self._indice[c][0], self._indice[c][1], c) for c in codigos if c in self._indice)
+            resultado = {}
+            with open(self.ruta_datos, 'rb') as f:
+                for posicion, largo, codigo in ubicados:
+                    f.seek(posicion)
+                    resultado[codigo] = json.loads(f.read(largo))
+            return resultado
+    
+    def leer_todo(self):
+        """Leer todos los registros vigentes"""
+        return self.leer(self.codigos())
+    
+    def _agregar_registros(self, ruta, cambios):
+        """Agregar registros al final de `ruta`, forzarlos a disco y devolver su ubicación"""
+        with open(ruta, 'ab') as f:
+            posicion = f.seek(0, os.SEEK_END)
+            bloque = bytearray()
+            nuevos = []
+            for codigo, item in cambios.items():
+                codigo_bytes = codigo.encode('utf-8')
+                contenido = b'' if item is None else json.dumps(item, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                bloque += self.CABECERA.pack(len(contenido), len(codigo_bytes)) + codigo_bytes
+                nuevos.append((codigo, posicion + len(bloque), len(contenido)))
+                bloque += contenido
+            f.write(bloque)
+            f.flush()
+            os.fsync(f.fileno())
+        return nuevos
+    
+    def escribir(self, cambios):
+        """Agregar registros (producto o None para baja) sin reescribir el archivo"""
+        with self._lock:
+            self._abrir()
+            nuevos = self._agregar_registros(self.ruta_datos, cambios)
+            for codigo, posicion, largo in nuevos:
+                self._anotar(self._indice, codigo, posicion, largo)
+            self._registros_sin_indexar += len(nuevos)
+    
+    def pendientes_de_indexar(self):
+        """Registros escritos desde el último punto de control"""
+        return self._registros_sin_indexar
+    
+    def punto_de_control(self):
+        """Guardar el índice (y compactar si más de la mitad del archivo es espacio obsoleto)"""
+        with self._lock:
+            self._abrir()
+            tamano = os.path.getsize(self.ruta_datos)
+            if self._bytes_muertos > tamano // 2:
+                self.compactar()
+                return
+            self._guardar_indice(tamano)
+    
+    def _guardar_indice(self, fin):
+        codigos = list(self._indice.keys())
+        punto = {
+            'version': 2,
+            'generacion': self._generacion,
+            'fin': fin,
+            'bytes_muertos': self._bytes_muertos,
+            'codigos': codigos,
+            'posiciones': [self._indice[c][0] for c in codigos],
+            'largos': [self._indice[c][1] for c in codigos]
+        }
+        temporal = self.ruta_indice + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(punto, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.ruta_indice)
+        self._registros_sin_indexar = 0
+    
+    def compactar(self):
+        """Reescribir solo los registros vigentes en un archivo nuevo"""
+        with self._lock:
+            datos = self.leer_todo()
+            generacion = self._generacion + 1
+            temporal = self.ruta_datos + '.tmp'
+            with open(temporal, 'wb') as f:
+                f.write(self._cabecera_archivo(generacion))
+            nuevos = self._agregar_registros(temporal, datos)
+            os.replace(temporal, self.ruta_datos)
+            fsync_directorio(os.path.dirname(self.ruta_datos))
+            self._generacion = generacion
+            self._indice = {codigo: (posicion, largo) for codigo, posicion, largo in nuevos}
+            self._bytes_muertos = 0
+            self._guardar_indice(os.path.getsize(self.ruta_datos))
+            print(f"🗜️ Stock indexado compactado: {len(datos)} productos")
+
+class AlmacenStockIndexado:
+    """Almacén del modo JSON sobre ArchivoStockIndexado, con la misma interfaz que AlmacenStockJSON
+    
+    Cada guardado agrega solo los registros cambiados (sin reescribir el archivo) y las
+    lecturas puntuales no cargan el resto del stock. El índice se guarda cada
+    `registros_por_punto` escrituras y al cerrar el proceso.
+    """
+    
+    def __init__(self, ruta_datos, ruta_json_legado=None, registros_por_punto=1000):
+        self.archivo = ArchivoStockIndexado(ruta_datos)
+        self.ruta_json_legado = ruta_json_legado
+        self.registros_por_punto = registros_por_punto
+        self._datos = None
+        self._lock = threading.RLock()
+    
+    def existe(self):
+        """Indica si hay stock persistido (indexado o stock.json por migrar)"""
+        return self.archivo.existe() or bool(self.ruta_json_legado and os.path.exists(self.ruta_json_legado))
+    
+    def _migrar_si_hace_falta(self):
+        """Convertir stock.json al formato indexado la primera vez"""
+        if self.archivo.existe() or not (self.ruta_json_legado and os.path.exists(self.ruta_json_legado)):
+            return
+        with open(self.ruta_json_legado, 'r', encoding='utf-8') as f:
+            datos = json.load(f)
+        self.archivo.escribir(datos)
+        self.archivo.punto_de_control()
+        print(f"🔄 stock.json migrado a formato indexado: {len(datos)} productos")
+    
+    def cargar(self):
+        """Copia del stock completo (la primera vez lee todos los registros)"""
+        with self._lock:
+            if self._datos is None:
+                self._migrar_si_hace_falta()
+                self._datos = self.archivo.leer_todo()
+            return {codigo: dict(item) for codigo, item in self._datos.items()}
+    
+    def cargar_codigos(self, codigos):
+        """Copia de los productos pedidos, leyendo solo sus registros si el stock no está en memoria"""
+        with self._lock:
+            if self._datos is not None:
+                return {c: dict(self._datos[c]) for c in codigos if c in self._datos}
+            self._migrar_si_hace_falta()
+            return self.archivo.leer(codigos)
+    
+    def obtener(self, codigo):
+        """Lectura puntual de un producto (None si no existe)"""
+        return self.cargar_codigos([codigo]).get(codigo)
+    
+    def guardar(self, stock_data, modificados=None, eliminados=None):
+        """Agregar los registros cambiados y actualizar la copia en memoria si existe"""
+        with self._lock:
+            self._migrar_si_hace_falta()
+            if modificados is None and eliminados is None:
+                actuales = self._datos if self._datos is not None else self.archivo.leer_todo()
+                modificados = [c for c, item in stock_data.items() if actuales.get(c) != item]
+                eliminados = [c for c in actuales if c not in stock_data]
+            cambios = {codigo: dict(stock_data[codigo]) for codigo in modificados or ()}
+            cambios.update({codigo: None for codigo in eliminados or ()})
+            if not cambios:
+                return
+            self.archivo.escribir(cambios)
+            if self._datos is not None:
+                for codigo, item in cambios.items():
+                    if item is None:
+                        self._datos.pop(codigo, None)
+                    else:
+                        self._datos[codigo] = item
+            if self.archivo.pendientes_de_indexar() >= self.registros_por_punto:
+                self.archivo.punto_de_control()
+    
+    def drenar(self):
+        """Guardar el índice al cerrar el proceso"""
+        with self._lock:
+            if self.archivo.existe():
+                self.archivo.punto_de_control()
+
+# Formato del almacenamiento local: 'json' (stock.json) o 'indexado' (stock.dat + stock.idx)
+STOCK_FORMATO = os.environ.get('STOCK_FORMATO', 'json')
+
+if STOCK_FORMATO == 'indexado':
+    almacen_stock_json = AlmacenStockIndexado(STOCK_DAT_FILE, STOCK_FILE)
+else:
+    almacen_stock_json = AlmacenStockJSON(STOCK_FILE, STOCK_JSON_ESPERA_MS, STOCK_JSON_ESPERA_MAX_MS)
+atexit.register(almacen_stock_json.drenar)
+
+# =====================================
+# HISTORIAL DE MOVIMIENTOS POR MES
+# =====================================
+
+COLUMNAS_MOVIMIENTOS_DDL = """
+    fecha TIMESTAMP,
+    tipo VARCHAR(50),
+    codigo VARCHAR(255),
+    descripcion TEXT,
+    cantidad INTEGER,
+    ubicacion VARCHAR(100),
+    usuario VARCHAR(100),
+    datos TEXT,
+    producto_id INTEGER
+"""
+
+def inicio_mes(fecha):
+    """Primer instante del mes de `fecha`"""
+    return datetime(fecha.year, fecha.month, 1)
+
+def sumar_meses(fecha, meses):
+    """Primer día del mes que está `meses` meses después del de `fecha`"""
+    indice = fecha.year * 12 + fecha.month - 1 + meses
+    return datetime(indice // 12, indice % 12 + 1, 1)
+
+class HistorialMovimientosJSON:
+    """Historial de movimientos en archivos mensuales AAAA-MM.jsonl
+    
+    Cada movimiento se agrega al final del archivo de su mes, sin reescribir nada.
+    Los meses cerrados se comprimen en segmentos AAAA-MM.jsonl.gz: las consultas
+    recientes leen solo el mes en curso y se conserva el historial completo.
+    """
+    
+    def __init__(self, directorio, archivo_legado):
+        self.directorio = directorio
+        self.archivo_legado = archivo_legado
+        self._lock = threading.RLock()
+        self._preparado = False
+        self._mes_caliente = None
+    
+    def _ruta(self, mes, comprimido=False):
+        return os.path.join(self.directorio, f"{mes}.jsonl" + ('.gz' if comprimido else ''))
+    
+    def _preparar(self):
+        """Crear el directorio, migrando la primera vez el movimientos.json anterior"""
+        if self._preparado:
+            return
+        if not os.path.isdir(self.directorio):
+            os.makedirs(self.directorio, exist_ok=True)
+            try:
+                with open(self.archivo_legado, 'r', encoding='utf-8') as f:
+                    legado = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                legado = []
+            if legado:
+                # El archivo anterior está ordenado del más reciente al más antiguo
+                self._agregar(list(reversed(legado)))
+                print(f"📦 Movimientos migrados a {self.directorio}: {len(legado)}")
+        self._preparado = True
+    
+    def meses(self):
+        """Meses con movimientos, del más reciente al más antiguo"""
+        meses = {nombre.split('.', 1)[0] for nombre in os.listdir(self.directorio)
+                 if nombre.endswith('.jsonl') or nombre.endswith('.jsonl.gz')}
+        return sorted(meses, reverse=True)
+    
+    def _agregar(self, movimientos):
+        por_mes = defaultdict(list)
+        for movimiento in movimientos:
+            por_mes[(movimiento.get('fecha') or '')[:7] or '0000-00'].append(movimiento)
+        for mes, filas in por_mes.items():
+            with open(self._ruta(mes), 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(fila, ensure_ascii=False) + '\n' for fila in filas))
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def agregar(self, movimientos):
+        """Agregar movimientos (ya formateados) en orden cronológico"""
+        with self._lock:
+            self._preparar()
+            self._agregar(movimientos)
+            # Al primer uso y en cada cambio de mes se archivan los meses cerrados
+            mes_actual = datetime.now().strftime('%Y-%m')
+            if self._mes_caliente != mes_actual:
+                self._mes_caliente = mes_actual
+                self.compactar_cerrados()
+    
+    def compactar_cerrados(self):
+        """Comprimir en segmentos .gz los meses anteriores al mes en curso"""
+        with self._lock:
+            self._preparar()
+            mes_actual = datetime.now().strftime('%Y-%m')
+            for mes in self.meses():
+                ruta = self._ruta(mes)
+                if mes >= mes_actual or not os.path.exists(ruta):
+                    continue
+                with open(ruta, 'rb') as f:
+                    contenido = f.read()
+                
+                destino = self._ruta(mes, comprimido=True)
+                previo = b''
+                if os.path.exists(destino):
+                    with open(destino, 'rb') as f:
+                        previo = f.read()
+                # Si un archivado anterior se cortó antes de borrar el .jsonl, ya está en el segmento
+                if not previo or not gzip.decompress(previo).endswith(contenido):
+                    temporal = destino + '.tmp'
+                    with open(temporal, 'wb') as f:
+                        # Varios miembros gzip concatenados se leen como un solo archivo
+                        f.write(previo + gzip.compress(contenido))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(temporal, destino)
+                    fsync_directorio(self.directorio)
+                os.remove(ruta)
+                print(f"🗜️ Movimientos de {mes} archivados en {os.path.basename(destino)}")
+    
+    def leer_mes(self, mes):
+        """Movimientos de un mes en orden cronológico (segmento archivado + archivo abierto)"""
+        filas = []
+        ruta = self._ruta(mes, comprimido=True)
+        if os.path.exists(ruta):
+            with gzip.open(ruta, 'rt', encoding='utf-8') as f:
+                filas.extend(json.loads(linea) for linea in f if linea.strip())
+        ruta = self._ruta(mes)
+        if os.path.exists(ruta):
+            with open(ruta, 'r', encoding='utf-8') as f:
+                for linea in f:
+                    try:
+                        filas.append(json.loads(linea))
+                    except json.JSONDecodeError:
+                        # Última línea incompleta de una escritura cortada
+                        continue
+        return filas
+    
+    def cargar(self, limite=None, coincide=None, desde=None, hasta=None):
+        """Movimientos del más reciente al más antiguo, leyendo meses hacia atrás
+        
+        `desde` y `hasta` son fechas 'AAAA-MM-DD HH:MM:SS'; los meses fuera del rango
+        no se abren y la lectura termina al juntar `limite` movimientos.
+        """
+        resultado = []
+        with self._lock:
+            self._preparar()
+            for mes in self.meses():
+                if hasta and mes > hasta[:7]:
+                    continue
+                if desde and mes < desde[:7]:
+                    break
+                for movimiento in reversed(self.leer_mes(mes)):
+                    fecha = movimiento.get('fecha') or ''
+                    if (desde and fecha < desde) or (hasta and fecha > hasta):
+                        continue
+                    if coincide and not coincide(movimiento):
+                        continue
+                    resultado.append(movimiento)
+                    if limite and len(resultado) >= limite:
+                        return resultado
+        return resultado
+    
+    def reemplazar(self, movimientos):
+        """Reemplazar todo el historial (movimientos en orden cronológico)"""
+        with self._lock:
+            self._preparar()
+            for nombre in os.listdir(self.directorio):
+                if nombre.endswith('.jsonl') or nombre.endswith('.jsonl.gz'):
+                    os.remove(os.path.join(self.directorio, nombre))
+            self._agregar(movimientos)
+            self._mes_caliente = None
+
+historial_movimientos_json = HistorialMovimientosJSON(MOVIMIENTOS_DIR, MOVIMIENTOS_FILE)
+
+class ParticionesMovimientos:
+    """Particiones mensuales de la tabla movimientos en PostgreSQL
+    
+    Las particiones se crean con MESES_ADELANTE meses de anticipación; la partición
+    DEFAULT solo recibe filas sin fecha o fuera de los meses creados.
+    """
+    
+    MESES_ADELANTE = 2
+    
+    def __init__(self):
+        self.activo = False
+        self._cubierto_hasta = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def es_particionada(conn):
+        if conn.dialect.name != 'postgresql':
+            return False
+        return conn.execute(text("""
+            SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = 'movimientos' AND pg_table_is_visible(c.oid)
+        """)).first() is not None
+    
+    def detectar(self, conn):
+        """Al iniciar: si la tabla está particionada, asegurar las particiones próximas"""
+        self.activo = self.es_particionada(conn)
+        if self.activo:
+            conn.execute(text("CREATE TABLE IF NOT EXISTS movimientos_default PARTITION OF movimientos DEFAULT"))
+            self.asegurar(conn, datetime.now())
+    
+    def asegurar(self, conn, desde):
+        """Crear las particiones mensuales desde el mes de `desde` hasta MESES_ADELANTE meses después de hoy"""
+        mes = inicio_mes(desde)
+        fin = sumar_meses(datetime.now(), self.MESES_ADELANTE + 1)
+        while mes < fin:
+            siguiente = sumar_meses(mes, 1)
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS movimientos_{mes:%Y_%m} PARTITION OF movimientos
+                FOR VALUES FROM ('{mes:%Y-%m-%d}') TO ('{siguiente:%Y-%m-%d}')
+            """))
+            mes = siguiente
+        self._cubierto_hasta = sumar_meses(datetime.now(), self.MESES_ADELANTE)
+    
+    def revisar(self):
+        """Antes de escribir: crear las particiones que falten cuando cambia el mes"""
+        if not self.activo or datetime.now() < self._cubierto_hasta:
+            return
+        with self._lock:
+            if datetime.now() >= self._cubierto_hasta:
+                with engine.begin() as conn:
+                    self.asegurar(conn, datetime.now())
+    
+    def particionar(self):
+        """Convertir una tabla movimientos existente en particionada por mes (migración única)"""
+        with engine.begin() as conn:
+            if self.es_particionada(conn):
+                return None
+            conn.execute(text("LOCK TABLE movimientos IN ACCESS EXCLUSIVE MODE"))
+            primera = fecha_db(conn.execute(text("SELECT MIN(fecha) FROM movimientos")).scalar()) or datetime.now()
+            secuencia = conn.execute(text("SELECT pg_get_serial_sequence('movimientos', 'id')")).scalar()
+            
+            conn.execute(text("ALTER TABLE movimientos RENAME TO movimientos_sin_particionar"))
+            conn.execute(text("ALTER INDEX IF EXISTS idx_movimientos_fecha RENAME TO idx_movimientos_fecha_sin_particionar"))
+            conn.execute(text(f"""
+                CREATE TABLE movimientos (
+                    id INTEGER NOT NULL DEFAULT nextval('{secuencia}'),
+                    {COLUMNAS_MOVIMIENTOS_DDL},
+                    PRIMARY KEY (id, fecha)
+                ) PARTITION BY RANGE (fecha)
+            """))
+            conn.execute(text("CREATE TABLE movimientos_default PARTITION OF movimientos DEFAULT"))
+            self.asegurar(conn, primera)
+            
+            copiadas = conn.execute(text("""
+                INSERT INTO movimientos (id, fecha, tipo, codigo, descripcion, cantidad, ubicacion, usuario, datos, producto_id)
+                SELECT id, COALESCE(fecha, TIMESTAMP '1970-01-01'), tipo, codigo, descripcion, cantidad, ubicacion, usuario,
+                       datos, producto_id
+                FROM movimientos_sin_particionar
+            """)).rowcount
+            # La secuencia pasa a la tabla nueva antes de borrar la anterior
+            conn.execute(text(f"ALTER SEQUENCE {secuencia} OWNED BY movimientos.id"))
+            conn.execute(text("DROP TABLE movimientos_sin_particionar"))
+            # Con la tabla anterior se fueron todos sus índices: se recrean en la misma transacción
+            crear_indices_movimientos(conn)
+        
+        self.activo = True
+        return copiadas
+
+particiones_movimientos = ParticionesMovimientos()
+
 # =====================================
 # FUNCIONES DE GESTIÓN DE DATOS
 # =====================================
@@ -269,58 +1061,155 @@ def verificar_archivos_datos():
     print(f"   - Stock: {os.path.exists(STOCK_FILE)}")
     print(f"   - Umbrales: {os.path.exists(UMBRALES_FILE)}")
 
-def cargar_stock():
-    """Cargar datos del stock desde PostgreSQL o JSON como fallback"""
+def fecha_db(valor):
+    """Normalizar una fecha leída de la base (SQLite devuelve texto, PostgreSQL datetime)"""
+    if isinstance(valor, str):
+        return datetime.fromisoformat(valor)
+    return valor
+
+def fila_a_producto(row):
+    """Convertir una fila de la tabla stock al formato de producto usado por la app"""
+    return {
+        'id': row.id,
+        'tipo': row.tipo,
+        'titulo': row.titulo,
+        'caracteristica': row.caracteristica,
+        'color': row.color,
+        'formato': row.formato,
+        'lote': row.lote,
+        'ubicacion': row.ubicacion,
+        'proveedor': row.proveedor,
+        'cantidad': row.cantidad,
+        'kilos_por_caja': row.kilos_por_caja,
+        'conos_por_caja': row.conos_por_caja,
+        'descripcion_cono': row.descripcion_cono,
+        'fecha_ingreso': fecha_db(row.fecha_ingreso).isoformat() if row.fecha_ingreso else None,
+        'ultima_modificacion': fecha_db(row.ultima_modificacion).isoformat() if row.ultima_modificacion else None
+    }
+
+# Hilos para consultar los fragmentos por ubicación en paralelo (1, por defecto: una sola consulta)
+STOCK_FRAGMENTOS_HILOS = int(os.environ.get('STOCK_FRAGMENTOS_HILOS', 1))
+
+# Compartido por todos los requests: las lecturas en paralelo nunca ocupan más de
+# STOCK_FRAGMENTOS_HILOS conexiones del pool, haya los requests que haya
+ejecutor_fragmentos = ThreadPoolExecutor(max_workers=STOCK_FRAGMENTOS_HILOS,
+                                         thread_name_prefix='fragmentos') if STOCK_FRAGMENTOS_HILOS > 1 else None
+
+def fragmentos_stock():
+    """Fragmentos del stock: uno por depósito más uno (None) para ubicaciones fuera de la lista"""
+    return LISTA_DE_UBICACIONES + [None]
+
+def consultar_fragmento_stock(ubicacion, motor):
+    """Productos de un fragmento, sobre su propia conexión del pool de `motor`"""
+    if ubicacion is None:
+        consulta = text("SELECT * FROM stock WHERE ubicacion IS NULL OR ubicacion NOT IN :ubicaciones").bindparams(
+            sa.bindparam('ubicaciones', expanding=True))
+        parametros = {'ubicaciones': LISTA_DE_UBICACIONES}
+    else:
+        consulta = text("SELECT * FROM stock WHERE ubicacion = :ubicacion")
+        parametros = {'ubicacion': ubicacion}
+    with motor.connect() as conn:
+        return {row.codigo: fila_a_producto(row) for row in conn.execute(consulta, parametros)}
+
+def unir_fragmentos_stock():
+    """Stock completo: una sola consulta o, con STOCK_FRAGMENTOS_HILOS > 1, la unión de los
+    fragmentos consultados en paralelo
+    
+    En paralelo cada fragmento se lee en su propia transacción: una transferencia
+    confirmada entre dos lecturas puede verse en los dos depósitos o en ninguno. Por eso
+    la consulta única (una sola instantánea) es el valor por defecto.
+    """
+    # Los hilos no ven el request: el engine (primaria o réplica) se elige acá
+    motor = motor_lectura()
+    if ejecutor_fragmentos is None:
+        with motor.connect() as conn:
+            return {row.codigo: fila_a_producto(row) for row in conn.execute(text("SELECT * FROM stock"))}
+    
+    partes = list(ejecutor_fragmentos.map(lambda ubicacion: consultar_fragmento_stock(ubicacion, motor),
+                                          fragmentos_stock()))
+    stock_data = {}
+    for parte in partes:
+        stock_data.update(parte)
+    return stock_data
+
+@reintentar_en_primaria
+def cargar_stock(ubicacion=None):
+    """Cargar datos del stock desde PostgreSQL o JSON como fallback
+    
+    Con `ubicacion` se lee solo el fragmento de ese depósito; sin ella se unen todos.
+    """
     try:
         if engine:
             # Usar PostgreSQL
-            with engine.connect() as conn:
-                result = conn.execute(text("SELECT * FROM stock"))
-                rows = result.fetchall()
-                
-                stock_data = {}
-                for row in rows:
-                    stock_data[row.codigo] = {
-                        'tipo': row.tipo,
-                        'titulo': row.titulo,
-                        'caracteristica': row.caracteristica,
-                        'color': row.color,
-                        'formato': row.formato,
-                        'lote': row.lote,
-                        'ubicacion': row.ubicacion,
-                        'proveedor': row.proveedor,
-                        'cantidad': row.cantidad,
-                        'kilos_por_caja': row.kilos_por_caja,
-                        'conos_por_caja': row.conos_por_caja,
-                        'descripcion_cono': row.descripcion_cono,
-                        'fecha_ingreso': row.fecha_ingreso.isoformat() if row.fecha_ingreso else None,
-                        'ultima_modificacion': row.ultima_modificacion.isoformat() if row.ultima_modificacion else None
-                    }
-                
-                print(f"✅ Stock cargado desde PostgreSQL: {len(stock_data)} productos")
-                return stock_data
+            if ubicacion:
+                stock_data = consultar_fragmento_stock(ubicacion, motor_lectura())
+            else:
+                stock_data = unir_fragmentos_stock()
+            
+            print(f"✅ Stock cargado desde PostgreSQL: {len(stock_data)} productos")
+            return stock_data
         
         # Fallback a JSON (desarrollo local)
-        return cargar_stock_json()
+        return cargar_stock_json(ubicacion)
         
     except Exception as e:
+        if leyendo_de_replica():
+            raise
         print(f"❌ Error al cargar desde PostgreSQL, usando JSON: {e}")
-        return cargar_stock_json()
+        return cargar_stock_json(ubicacion)
 
-def cargar_stock_json():
-    """Cargar datos del stock desde JSON (fallback)"""
+@reintentar_en_primaria
+def cargar_productos(codigos):
+    """Cargar solo los productos indicados"""
     try:
-        # Primero intentar cargar stock.json
-        if os.path.exists(STOCK_FILE):
-            with open(STOCK_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print(f"✅ Stock cargado desde JSON: {len(data)} productos")
-                return data
+        if engine:
+            codigos = list(codigos)
+            if not codigos:
+                return {}
+            consulta = text("SELECT * FROM stock WHERE codigo IN :codigos").bindparams(
+                sa.bindparam('codigos', expanding=True))
+            with motor_lectura().connect() as conn:
+                result = conn.execute(consulta, {'codigos': codigos})
+                return {row.codigo: fila_a_producto(row) for row in result}
+        
+        return cargar_productos_json(codigos)
+        
+    except Exception as e:
+        if leyendo_de_replica():
+            raise
+        print(f"❌ Error al cargar productos desde PostgreSQL, usando JSON: {e}")
+        return cargar_productos_json(codigos)
+
+def cargar_productos_json(codigos):
+    """Cargar solo los productos indicados desde el almacén local"""
+    if almacen_stock_json.existe():
+        return almacen_stock_json.cargar_codigos(codigos)
+    codigos = set(codigos)
+    return {codigo: item for codigo, item in cargar_stock_json().items() if codigo in codigos}
+
+def obtener_producto(codigo):
+    """Lectura puntual de un producto (None si no existe)"""
+    return cargar_productos([codigo]).get(codigo)
+
+def cargar_stock_json(ubicacion=None):
+    """Cargar datos del stock desde JSON (fallback), todo o solo el fragmento de una ubicación"""
+    try:
+        # Primero intentar cargar stock.json (en memoria tras la primera lectura)
+        if almacen_stock_json.existe():
+            if ubicacion:
+                # Solo se copian los códigos del fragmento, no todo el stock
+                data = almacen_stock_json.cargar_codigos(fragmentos_ubicacion.codigos(ubicacion))
+            else:
+                data = almacen_stock_json.cargar()
+            print(f"✅ Stock cargado desde JSON: {len(data)} productos")
+            return data
         
         # Si no existe, usar stock_inicial.json
         elif os.path.exists(STOCK_INICIAL_FILE):
             with open(STOCK_INICIAL_FILE, 'r', encoding='utf-8') as f:
                 data = json.load(f)
+                if ubicacion:
+                    data = {codigo: item for codigo, item in data.items() if item.get('ubicacion') == ubicacion}
                 print(f"✅ Stock inicial cargado: {len(data)} productos")
                 return data
         
@@ -367,99 +1256,125 @@ def cargar_stock_json():
             else:
                 # guardar_stock_json(datos_por_defecto)  # Eliminado: no migrar datos preestablecidos
                 pass
+            if ubicacion:
+                return {codigo: item for codigo, item in datos_por_defecto.items() if item['ubicacion'] == ubicacion}
             return datos_por_defecto
             
     except Exception as e:
         print(f"❌ Error al cargar stock JSON: {e}")
         return {}
 
-def guardar_stock(stock_data):
-    """Guardar datos del stock a PostgreSQL o JSON como fallback"""
+def reemplazar_stock(conn, stock_data):
+    """Dejar la tabla stock igual a stock_data dentro de la transacción de `conn`"""
+    # Obtener productos existentes
+    result = conn.execute(text("SELECT codigo FROM stock"))
+    codigos_existentes = set(row.codigo for row in result)
+    
+    # Eliminar productos que ya no están en stock_data
+    codigos_a_eliminar = codigos_existentes - set(stock_data.keys())
+    if codigos_a_eliminar:
+        conn.execute(SQL_ELIMINAR_PRODUCTO, [{'codigo': codigo} for codigo in codigos_a_eliminar])
+    
+    # Actualizar o insertar cada producto
+    if stock_data:
+        conn.execute(SQL_UPSERT_PRODUCTO, [parametros_producto(codigo, item) for codigo, item in stock_data.items()])
+
+def guardar_stock(stock_data, respaldo_json=True):
+    """Guardar datos del stock a PostgreSQL o JSON como fallback
+    
+    Un reemplazo completo no queda explicado por los movimientos, así que en la base
+    se registra a la vez un snapshot que sirve de nueva base al ledger. Con
+    `respaldo_json=False` un error de la base se propaga en vez de escribir el JSON.
+    """
     try:
         if engine:
             # Usar PostgreSQL con operaciones específicas
-            with engine.connect() as conn:
-                # Obtener productos existentes
-                result = conn.execute(text("SELECT codigo FROM stock"))
-                codigos_existentes = set(row.codigo for row in result)
-                codigos_nuevos = set(stock_data.keys())
-                
-                # Eliminar productos que ya no están en stock_data
-                codigos_a_eliminar = codigos_existentes - codigos_nuevos
-                for codigo in codigos_a_eliminar:
-                    conn.execute(text("DELETE FROM stock WHERE codigo = :codigo"), {'codigo': codigo})
+            with engine.begin() as conn:
+                bloquear_escrituras(conn)
+                reemplazar_stock(conn, stock_data)
+                insertar_snapshot_stock(conn, stock_data, ultimo_movimiento_id(conn), 'tabla')
                 
-                # Actualizar o insertar cada producto
-                for codigo, item in stock_data.items():
-                    if codigo in codigos_existentes:
-                        # Actualizar producto existente
-                        conn.execute(text("""
-                            UPDATE stock SET 
-                                tipo = :tipo, titulo = :titulo, caracteristica = :caracteristica,
-                                color = :color, formato = :formato, lote = :lote,
-                                ubicacion = :ubicacion, proveedor = :proveedor, cantidad = :cantidad,
-                                kilos_por_caja = :kilos_por_caja, conos_por_caja = :conos_por_caja,
-                                descripcion_cono = :descripcion_cono, ultima_modificacion = :ultima_modificacion
-                            WHERE codigo = :codigo
-                        """), {
-                            'codigo': codigo,
-                            'tipo': item.get('tipo'),
-                            'titulo': item.get('titulo'),
-                            'caracteristica': item.get('caracteristica'),
-                            'color': item.get('color'),
-                            'formato': item.get('formato'),
-                            'lote': item.get('lote'),
-                            'ubicacion': item.get('ubicacion'),
-                            'proveedor': item.get('proveedor'),
-                            'cantidad': item.get('cantidad', 0),
-                            'kilos_por_caja': item.get('kilos_por_caja', 0.0),
-                            'conos_por_caja': item.get('conos_por_caja', 0),
-                            'descripcion_cono': item.get('descripcion_cono', ''),
-                            'ultima_modificacion': datetime.now()
-                        })
-                    else:
-                        # Insertar producto nuevo
-                        conn.execute(text("""
-                            INSERT INTO stock (codigo, tipo, titulo, caracteristica, color, formato, 
-                                             lote, ubicacion, proveedor, cantidad, kilos_por_caja, 
-                                             conos_por_caja, descripcion_cono, fecha_ingreso, ultima_modificacion)
-                            VALUES (:codigo, :tipo, :titulo, :caracteristica, :color, :formato,
-                                   :lote, :ubicacion, :proveedor, :cantidad, :kilos_por_caja,
-                                   :conos_por_caja, :descripcion_cono, :fecha_ingreso, :ultima_modificacion)
-                        """), {
-                            'codigo': codigo,
-                            'tipo': item.get('tipo'),
-                            'titulo': item.get('titulo'),
-                            'caracteristica': item.get('caracteristica'),
-                            'color': item.get('color'),
-                            'formato': item.get('formato'),
-                            'lote': item.get('lote'),
-                            'ubicacion': item.get('ubicacion'),
-                            'proveedor': item.get('proveedor'),
-                            'cantidad': item.get('cantidad', 0),
-                            'kilos_por_caja': item.get('kilos_por_caja', 0.0),
-                            'conos_por_caja': item.get('conos_por_caja', 0),
-                            'descripcion_cono': item.get('descripcion_cono', ''),
-                            'fecha_ingreso': datetime.fromisoformat(item['fecha_ingreso']) if item.get('fecha_ingreso') else datetime.now(),
-                            'ultima_modificacion': datetime.now()
-                        })
-                
-                conn.commit()
                 print(f"✅ Stock guardado en PostgreSQL: {len(stock_data)} productos")
         else:
             # Fallback a JSON
             guardar_stock_json(stock_data)
             
     except Exception as e:
+        if not respaldo_json:
+            raise
         print(f"❌ Error al guardar en PostgreSQL, usando JSON: {e}")
         guardar_stock_json(stock_data)
+    
+    notificar_cambios(stock_data, completo=True)
+
+class IdsProductosJSON:
+    """Ids enteros de los productos en el modo JSON (en la base los asigna la columna stock.id)
+    
+    El último id y el mapa id -> código se arman una vez desde el stock; los productos
+    que todavía no tienen id lo reciben en ese momento. Como el almacén JSON, pensado
+    para un único worker.
+    """
+    
+    def __init__(self):
+        self._ultimo = None
+        self._codigos = {}
+        self._ids = {}
+        self._lock = threading.RLock()
+    
+    def _asegurar(self):
+        if self._ultimo is not None:
+            return
+        stock = cargar_stock_json()
+        self._ultimo = max((item.get('id') or 0 for item in stock.values()), default=0)
+        faltantes = sorted((codigo for codigo, item in stock.items() if not item.get('id')),
+                           key=lambda codigo: (stock[codigo].get('fecha_ingreso') or '', codigo))
+        for codigo in faltantes:
+            self._ultimo += 1
+            stock[codigo]['id'] = self._ultimo
+        self._ids = {codigo: item['id'] for codigo, item in stock.items()}
+        self._codigos = {id_producto: codigo for codigo, id_producto in self._ids.items()}
+        if faltantes:
+            almacen_stock_json.guardar(stock, faltantes, [])
+            print(f"🔢 Ids asignados a {len(faltantes)} productos JSON")
+    
+    def asignar(self, stock_data, modificados=None, eliminados=None):
+        """Dar id a los productos nuevos y olvidar los eliminados (antes de persistirlos)"""
+        with self._lock:
+            self._asegurar()
+            if modificados is None and eliminados is None:
+                modificados = list(stock_data)
+                eliminados = [codigo for codigo in self._ids if codigo not in stock_data]
+            for codigo in eliminados or ():
+                self._codigos.pop(self._ids.pop(codigo, None), None)
+            for codigo in modificados or ():
+                item = stock_data.get(codigo)
+                if item is None:
+                    continue
+                if not item.get('id'):
+                    item['id'] = self._ids.get(codigo)
+                    if not item['id']:
+                        self._ultimo += 1
+                        item['id'] = self._ultimo
+                self._ids[codigo] = item['id']
+                self._codigos[item['id']] = codigo
+    
+    def id_de(self, codigo):
+        with self._lock:
+            self._asegurar()
+            return self._ids.get(codigo)
+    
+    def codigo_de(self, id_producto):
+        with self._lock:
+            self._asegurar()
+            return self._codigos.get(id_producto)
+
+ids_productos_json = IdsProductosJSON()
 
-def guardar_stock_json(stock_data):
-    """Guardar datos del stock a JSON (fallback)"""
+def guardar_stock_json(stock_data, modificados=None, eliminados=None):
+    """Guardar datos del stock a JSON (fallback) mediante el almacén con volcado diferido"""
     try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(STOCK_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stock_data, f, ensure_ascii=False, indent=2)
+        ids_productos_json.asignar(stock_data, modificados, eliminados)
+        almacen_stock_json.guardar(stock_data, modificados, eliminados)
         print(f"✅ Stock guardado en JSON: {len(stock_data)} productos")
     except Exception as e:
         print(f"❌ Error guardando stock JSON: {e}")
@@ -483,131 +1398,2747 @@ def cargar_umbrales():
 
 def guardar_umbrales(umbrales_data):
     """Guardar umbrales de stock a JSON"""
+    global _umbrales_compilados
     with open(UMBRALES_FILE, 'w', encoding='utf-8') as f:
         json.dump(umbrales_data, f, ensure_ascii=False, indent=2)
+    _umbrales_compilados = None
+    alertas_stock.reclasificar()
+    tarea_sugerencia_compras.solicitar()
+
+# Atributos que admiten umbrales particulares, en orden de prioridad ante empates
+ATRIBUTOS_OVERRIDE = ['titulo', 'caracteristica', 'color', 'proveedor']
+
+def cargar_overrides_umbrales():
+    """Cargar las reglas de umbral por titulo/caracteristica/color/proveedor"""
+    try:
+        with open(UMBRALES_OVERRIDES_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+def validar_override_umbral(regla):
+    """Normalizar una regla de umbral; ValueError si está incompleta"""
+    if not isinstance(regla, dict) or not regla.get('tipo'):
+        raise ValueError('Cada regla necesita al menos un tipo')
+    try:
+        umbral_bajo = int(regla['umbral_bajo'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Regla para {regla['tipo']}: umbral_bajo inválido")
+    umbral_critico = regla.get('umbral_critico')
+    umbral_critico = max(1, umbral_bajo // 2) if umbral_critico in (None, '') else int(umbral_critico)
+    if umbral_bajo < 0 or umbral_critico < 0 or umbral_critico > umbral_bajo:
+        raise ValueError(f"Regla para {regla['tipo']}: se requiere 0 <= umbral_critico <= umbral_bajo")
+    normalizada = {'tipo': regla['tipo'], 'formato': regla.get('formato') or None}
+    for atributo in ATRIBUTOS_OVERRIDE:
+        valor = regla.get(atributo)
+        normalizada[atributo] = str(valor) if valor not in (None, '') else None
+    normalizada.update(umbral_bajo=umbral_bajo, umbral_critico=umbral_critico)
+    return normalizada
+
+def guardar_overrides_umbrales(reglas):
+    """Validar y guardar las reglas; cambian los grupos de alerta, así que se recalculan"""
+    global _umbrales_compilados
+    if not isinstance(reglas, list):
+        raise ValueError('Se esperaba una lista de reglas')
+    reglas = [validar_override_umbral(regla) for regla in reglas]
+    with open(UMBRALES_OVERRIDES_FILE, 'w', encoding='utf-8') as f:
+        json.dump(reglas, f, ensure_ascii=False, indent=2)
+    _umbrales_compilados = None
+    alertas_stock.inicializar()
+    tarea_sugerencia_compras.solicitar()
+    return reglas
+
+class ResolutorUmbrales:
+    """Resolución de umbrales de la regla más específica a la general
+    
+    Las reglas se indexan por su clave completa (tipo, formato, titulo, caracteristica,
+    color, proveedor), con None en los atributos que no fija. Solo se prueban las
+    combinaciones de atributos que alguna regla usa, ordenadas por cantidad de atributos,
+    y el resultado se guarda por combinación de valores: clasificar no recorre las reglas.
+    """
+    
+    def __init__(self, base, reglas):
+        self._base = base
+        self._reglas = {}
+        patrones = set()
+        for regla in reglas:
+            valores = tuple(regla.get(atributo) for atributo in ATRIBUTOS_OVERRIDE)
+            self._reglas[(regla['tipo'], regla.get('formato')) + valores] = (regla['umbral_bajo'], regla['umbral_critico'])
+            patrones.add(tuple(i for i, valor in enumerate(valores) if valor is not None))
+        self._patrones = sorted(patrones, key=lambda patron: (-len(patron), patron))
+        self._cache = {}
+    
+    def resolver(self, tipo, formato, titulo=None, caracteristica=None, color=None, proveedor=None):
+        """(clave de la regla aplicada, umbral bajo, umbral crítico)"""
+        atributos = (tipo, formato, titulo, caracteristica, color, proveedor)
+        resultado = self._cache.get(atributos)
+        if resultado is None:
+            valores = tuple(str(valor) if valor not in (None, '') else None for valor in atributos[2:])
+            resultado = self._buscar(tipo, formato, valores)
+            self._cache[atributos] = resultado
+        return resultado
+    
+    def _buscar(self, tipo, formato, valores):
+        for patron in self._patrones:
+            if any(valores[i] is None for i in patron):
+                continue
+            fijados = tuple(valor if i in patron else None for i, valor in enumerate(valores))
+            for formato_regla in (formato, None):
+                clave = (tipo, formato_regla) + fijados
+                if clave in self._reglas:
+                    return (clave,) + self._reglas[clave]
+        clave = (tipo, formato) + (None,) * len(ATRIBUTOS_OVERRIDE)
+        return (clave,) + self.umbral_clave(clave)
+    
+    def umbral_clave(self, clave):
+        """(umbral bajo, umbral crítico) de una clave devuelta por resolver()"""
+        return self._reglas.get(clave) or self._base.get(clave[:2], (10, 5))
+
+# Umbrales ya resueltos; se invalida al guardar la configuración o las reglas
+_umbrales_compilados = None
+
+def umbrales_compilados():
+    """Resolutor de umbrales armado una sola vez a partir de la configuración y las reglas"""
+    global _umbrales_compilados
+    if _umbrales_compilados is None:
+        base = {
+            (tipo, formato): (umbral_bajo, max(1, umbral_bajo // 2))
+            for tipo, formatos in cargar_umbrales().items()
+            for formato, umbral_bajo in formatos.items()
+        }
+        _umbrales_compilados = ResolutorUmbrales(base, cargar_overrides_umbrales())
+    return _umbrales_compilados
+
+def regla_umbral(item, tipo=None, formato=None):
+    """(clave de regla, umbral bajo, umbral crítico) que rige para un producto"""
+    return umbrales_compilados().resolver(
+        tipo or item.get('tipo'), formato or item.get('formato') or 'cajas',
+        *(item.get(atributo) for atributo in ATRIBUTOS_OVERRIDE))
 
-def cargar_movimientos():
-    """Cargar historial de movimientos desde PostgreSQL o JSON como fallback"""
+def umbral_producto(item, tipo=None, formato=None):
+    """(umbral bajo, umbral crítico) de un producto; 10 cajas si no está configurado"""
+    return regla_umbral(item, tipo, formato)[1:]
+
+def clasificar_cantidad(cantidad, umbral_bajo, umbral_critico):
+    """Estado de stock según los umbrales: 'Crítico', 'Bajo' o 'Normal'"""
+    if cantidad <= umbral_critico:
+        return 'Crítico'
+    if cantidad <= umbral_bajo:
+        return 'Bajo'
+    return 'Normal'
+
+def consultar_movimientos(conn, limite=None, tipo=None, desde=None, hasta=None, ubicacion=None, con_datos=False):
+    """Movimientos filtrados por tipo, ubicación y rango de fechas, del más reciente al más antiguo
+    
+    Con `con_datos` se incluye la imagen del producto que guarda el ledger.
+    """
+    condiciones, parametros = [], {}
+    if tipo:
+        condiciones.append("UPPER(tipo) = :tipo")
+        parametros['tipo'] = tipo.upper()
+    if ubicacion:
+        condiciones.append("ubicacion = :ubicacion")
+        parametros['ubicacion'] = ubicacion
+    if desde:
+        condiciones.append("fecha >= :desde")
+        parametros['desde'] = desde
+    if hasta:
+        condiciones.append("fecha <= :hasta")
+        parametros['hasta'] = hasta
+    
+    consulta = "SELECT fecha, tipo, codigo, producto_id, descripcion, cantidad, ubicacion, usuario"
+    consulta += ", datos FROM movimientos" if con_datos else " FROM movimientos"
+    if condiciones:
+        consulta += " WHERE " + " AND ".join(condiciones)
+    consulta += " ORDER BY fecha DESC, id DESC"
+    if limite:
+        consulta += " LIMIT :limite"
+        parametros['limite'] = limite
+    
+    movimientos = []
+    for row in conn.execute(text(consulta), parametros):
+        movimiento = {
+            'fecha': fecha_db(row.fecha).strftime('%Y-%m-%d %H:%M:%S') if row.fecha else '',
+            'tipo': row.tipo,
+            'codigo': row.codigo,
+            'producto_id': row.producto_id,
+            'descripcion': row.descripcion,
+            'cantidad': row.cantidad,
+            'ubicacion': row.ubicacion,
+            'usuario': row.usuario
+        }
+        if con_datos:
+            movimiento['datos'] = row.datos
+        movimientos.append(movimiento)
+    return movimientos
+
+@reintentar_en_primaria
+def cargar_movimientos(limite=None, tipo=None, desde=None, hasta=None, ubicacion=None, con_datos=False):
+    """Cargar historial de movimientos (más recientes primero) desde PostgreSQL o JSON como fallback
+    
+    Con `limite` y sin `desde` se consulta primero el mes en curso (la partición caliente)
+    y solo se baja a meses anteriores si faltan filas. Con `ubicacion` se recorre solo el
+    rango de ese depósito en idx_movimientos_ubicacion_fecha. `con_datos` agrega la
+    imagen del ledger (solo en la base; el historial JSON no la guarda).
+    """
     try:
         if engine:
             # Usar PostgreSQL
-            with engine.connect() as conn:
-                result = conn.execute(text("SELECT * FROM movimientos ORDER BY fecha DESC"))
-                rows = result.fetchall()
-                
-                movimientos = []
-                for row in rows:
-                    movimientos.append({
-                        'fecha': row.fecha.strftime('%Y-%m-%d %H:%M:%S') if row.fecha else '',
-                        'tipo': row.tipo,
-                        'codigo': row.codigo,
-                        'descripcion': row.descripcion,
-                        'cantidad': row.cantidad,
-                        'ubicacion': row.ubicacion,
-                        'usuario': row.usuario
-                    })
+            with motor_lectura().connect() as conn:
+                if limite and desde is None:
+                    mes_actual = inicio_mes(datetime.now())
+                    movimientos = consultar_movimientos(conn, limite, tipo, mes_actual, hasta, ubicacion, con_datos)
+                    if len(movimientos) < limite:
+                        antes_del_mes = mes_actual - timedelta(microseconds=1)
+                        movimientos += consultar_movimientos(conn, limite - len(movimientos), tipo, None,
+                                                             min(hasta, antes_del_mes) if hasta else antes_del_mes,
+                                                             ubicacion, con_datos)
+                else:
+                    movimientos = consultar_movimientos(conn, limite, tipo, desde, hasta, ubicacion, con_datos)
                 
                 print(f"✅ Movimientos cargados desde PostgreSQL: {len(movimientos)}")
                 return movimientos
         
         # Fallback a JSON (desarrollo local)
-        return cargar_movimientos_json()
+        return cargar_movimientos_json(limite, tipo, desde, hasta, ubicacion)
         
     except Exception as e:
+        if leyendo_de_replica():
+            raise
         print(f"❌ Error al cargar movimientos desde PostgreSQL, usando JSON: {e}")
-        return cargar_movimientos_json()
+        return cargar_movimientos_json(limite, tipo, desde, hasta, ubicacion)
+
+def cargar_movimientos_json(limite=None, tipo=None, desde=None, hasta=None, ubicacion=None):
+    """Cargar historial de movimientos desde los archivos mensuales"""
+    def coincide(movimiento):
+        return ((not tipo or (movimiento.get('tipo') or '').upper() == tipo.upper())
+                and (not ubicacion or movimiento.get('ubicacion') == ubicacion))
+    try:
+        return historial_movimientos_json.cargar(
+            limite,
+            coincide=coincide if tipo or ubicacion else None,
+            desde=desde.strftime('%Y-%m-%d %H:%M:%S') if desde else None,
+            hasta=hasta.strftime('%Y-%m-%d %H:%M:%S') if hasta else None)
+    except Exception as e:
+        print(f"❌ Error al cargar movimientos JSON: {e}")
+        return []
+
+def guardar_movimiento(tipo, codigo, descripcion, cantidad, ubicacion, usuario="Sistema"):
+    """Registrar un nuevo movimiento en el historial - PostgreSQL y JSON"""
+    guardar_cambios(None, movimientos=[crear_movimiento(tipo, codigo, descripcion, cantidad, ubicacion, usuario)])
+
+def guardar_movimiento_json(tipo, codigo, descripcion, cantidad, ubicacion, usuario="Sistema"):
+    """Registrar un nuevo movimiento en el historial JSON"""
+    guardar_movimientos_json([crear_movimiento(tipo, codigo, descripcion, cantidad, ubicacion, usuario)])
+
+def guardar_movimientos_json(movimientos_nuevos):
+    """Registrar varios movimientos en el historial JSON (se agregan al archivo del mes)"""
+    try:
+        historial_movimientos_json.agregar([formatear_movimiento_json(mov) for mov in movimientos_nuevos])
+        
+    except Exception as e:
+        print(f"Error guardando movimiento JSON: {e}")
+
+def formatear_movimiento_json(movimiento):
+    """Convertir un movimiento al formato serializable del historial JSON"""
+    fecha = movimiento.get('fecha')
+    return {
+        'fecha': fecha.strftime('%Y-%m-%d %H:%M:%S') if isinstance(fecha, datetime) else fecha,
+        'tipo': movimiento.get('tipo'),
+        'codigo': movimiento.get('codigo'),
+        'producto_id': movimiento.get('producto_id'),
+        'descripcion': movimiento.get('descripcion'),
+        'cantidad': movimiento.get('cantidad'),
+        'ubicacion': movimiento.get('ubicacion'),
+        'usuario': movimiento.get('usuario')
+    }
+
+# =====================================
+# UNIDAD DE TRABAJO (STOCK + MOVIMIENTOS)
+# =====================================
+
+SQL_UPSERT_PRODUCTO = text("""
+    INSERT INTO stock (codigo, tipo, titulo, caracteristica, color, formato,
+                       lote, ubicacion, proveedor, cantidad, kilos_por_caja,
+                       conos_por_caja, descripcion_cono, fecha_ingreso, ultima_modificacion)
+    VALUES (:codigo, :tipo, :titulo, :caracteristica, :color, :formato,
+            :lote, :ubicacion, :proveedor, :cantidad, :kilos_por_caja,
+            :conos_por_caja, :descripcion_cono, :fecha_ingreso, :ultima_modificacion)
+    ON CONFLICT (codigo) DO UPDATE SET
+        tipo = excluded.tipo, titulo = excluded.titulo, caracteristica = excluded.caracteristica,
+        color = excluded.color, formato = excluded.formato, lote = excluded.lote,
+        ubicacion = excluded.ubicacion, proveedor = excluded.proveedor, cantidad = excluded.cantidad,
+        kilos_por_caja = excluded.kilos_por_caja, conos_por_caja = excluded.conos_por_caja,
+        descripcion_cono = excluded.descripcion_cono, ultima_modificacion = excluded.ultima_modificacion
+""")
+
+SQL_ELIMINAR_PRODUCTO = text("DELETE FROM stock WHERE codigo = :codigo")
+
+SQL_INSERTAR_MOVIMIENTO = text("""
+    INSERT INTO movimientos (fecha, tipo, codigo, producto_id, descripcion, cantidad, ubicacion, usuario, datos)
+    VALUES (:fecha, :tipo, :codigo, :producto_id, :descripcion, :cantidad, :ubicacion, :usuario, :datos)
+""")
+
+def ids_productos(conn, codigos):
+    """Ids enteros de los códigos indicados"""
+    codigos = list(codigos)
+    if not codigos:
+        return {}
+    consulta = text("SELECT codigo, id FROM stock WHERE codigo IN :codigos").bindparams(
+        sa.bindparam('codigos', expanding=True))
+    return {row.codigo: row.id for row in conn.execute(consulta, {'codigos': codigos})}
+
+@reintentar_en_primaria
+def codigo_por_id(id_producto):
+    """Código del producto con ese id (None si no existe)"""
+    if engine:
+        try:
+            with motor_lectura().connect() as conn:
+                return conn.execute(text("SELECT codigo FROM stock WHERE id = :id"), {'id': id_producto}).scalar()
+        except Exception as e:
+            if leyendo_de_replica():
+                raise
+            print(f"❌ Error buscando id en PostgreSQL, usando JSON: {e}")
+    return ids_productos_json.codigo_de(id_producto)
+
+class EspejoMovimientosJSON:
+    """Escritor en segundo plano del respaldo movimientos.json
+    
+    Los requests encolan sus movimientos en una cola acotada; un único hilo los toma
+    en lotes y reescribe el archivo una vez por lote. Al cerrar el proceso se drena
+    la cola para no perder el respaldo.
+    """
+    
+    def __init__(self, capacidad=1000, max_lote=200):
+        self.max_lote = max_lote
+        self._cola = queue.Queue(maxsize=capacidad)
+        self._hilo = None
+        self._lock = threading.Lock()
+    
+    def _iniciar(self):
+        """Arrancar el hilo escritor la primera vez que se lo necesita"""
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._ciclo, name='espejo-movimientos-json', daemon=True)
+                self._hilo.start()
+    
+    def encolar(self, movimientos):
+        """Encolar movimientos ya confirmados en la base para su respaldo"""
+        self._iniciar()
+        try:
+            self._cola.put_nowait(list(movimientos))
+        except queue.Full:
+            # Cola llena: se escribe en el request antes que perder el respaldo
+            print("⚠️ Cola del respaldo JSON llena, escribiendo en línea")
+            guardar_movimientos_json(movimientos)
+    
+    def _ciclo(self):
+        """Tomar lotes de la cola y escribirlos con una sola reescritura del archivo"""
+        terminar = False
+        while not terminar:
+            lote = self._cola.get()
+            tomados = 1
+            if lote is None:
+                pendientes, terminar = [], True
+            else:
+                pendientes = list(lote)
+            
+            while not terminar and len(pendientes) < self.max_lote:
+                try:
+                    lote = self._cola.get_nowait()
+                except queue.Empty:
+                    break
+                tomados += 1
+                if lote is None:
+                    terminar = True
+                else:
+                    pendientes.extend(lote)
+            
+            if pendientes:
+                guardar_movimientos_json(pendientes)
+            for _ in range(tomados):
+                self._cola.task_done()
+    
+    def drenar(self, timeout=10):
+        """Escribir lo pendiente y detener el hilo (se llama al cerrar el proceso)"""
+        if self._hilo is None or not self._hilo.is_alive():
+            return
+        self._cola.put(None)
+        self._hilo.join(timeout)
+
+espejo_movimientos_json = EspejoMovimientosJSON()
+atexit.register(espejo_movimientos_json.drenar)
+
+def parametros_producto(codigo, item):
+    """Parámetros SQL de una fila de stock"""
+    return {
+        'codigo': codigo,
+        'tipo': item.get('tipo'),
+        'titulo': item.get('titulo'),
+        'caracteristica': item.get('caracteristica'),
+        'color': item.get('color'),
+        'formato': item.get('formato'),
+        'lote': item.get('lote'),
+        'ubicacion': item.get('ubicacion'),
+        'proveedor': item.get('proveedor'),
+        'cantidad': item.get('cantidad', 0),
+        'kilos_por_caja': item.get('kilos_por_caja', 0.0),
+        'conos_por_caja': item.get('conos_por_caja', 0),
+        'descripcion_cono': item.get('descripcion_cono', ''),
+        'fecha_ingreso': datetime.fromisoformat(item['fecha_ingreso']) if item.get('fecha_ingreso') else datetime.now(),
+        # Las operaciones ya la actualizan en memoria; un snapshot restaurado conserva la suya
+        'ultima_modificacion': datetime.fromisoformat(item['ultima_modificacion']) if item.get('ultima_modificacion') else datetime.now()
+    }
+
+def crear_movimiento(tipo, codigo, descripcion, cantidad, ubicacion, usuario="Sistema"):
+    """Construir un movimiento listo para persistir con guardar_cambios"""
+    return {
+        'fecha': datetime.now(),
+        'tipo': tipo,
+        'codigo': codigo,
+        'descripcion': descripcion,
+        'cantidad': cantidad,
+        'ubicacion': ubicacion,
+        'usuario': usuario,
+        'datos': None,
+        'producto_id': None
+    }
+
+def anotar_imagenes(stock_data, modificados, eliminados, movimientos):
+    """Completar los movimientos con la imagen de cada producto tras la operación
+    
+    `datos` guarda el producto como JSON ('null' si se eliminó); así el stock se puede
+    reconstruir reproduciendo el ledger. Los productos cambiados sin movimiento propio
+    (edición de atributos) reciben un movimiento MODIFICACION con cantidad 0.
+    """
+    imagenes = {codigo: stock_data[codigo] for codigo in modificados}
+    imagenes.update((codigo, None) for codigo in eliminados)
+    
+    con_movimiento = set()
+    for movimiento in movimientos:
+        codigo = movimiento['codigo']
+        if codigo in imagenes:
+            movimiento['datos'] = json.dumps(imagenes[codigo], ensure_ascii=False)
+            con_movimiento.add(codigo)
+        else:
+            movimiento.setdefault('datos', None)
+    
+    for codigo, item in imagenes.items():
+        if codigo not in con_movimiento:
+            movimiento = crear_movimiento('MODIFICACION', codigo, descripcion_producto(item) if item else codigo,
+                                          0, item.get('ubicacion', '') if item else '')
+            movimiento['datos'] = json.dumps(item, ensure_ascii=False)
+            movimientos.append(movimiento)
+    return movimientos
+
+# Funciones a avisar después de cada cambio confirmado del stock
+_observadores_cambios = []
+
+def registrar_observador(funcion):
+    """Registrar `funcion(stock_data, modificados, eliminados, movimientos, completo)` (usable como decorador)
+    
+    Se llama después de confirmar cada unidad de trabajo; `completo` indica que se
+    reemplazó todo el stock y no solo los códigos listados.
+    """
+    _observadores_cambios.append(funcion)
+    return funcion
+
+def notificar_cambios(stock_data, modificados=(), eliminados=(), movimientos=(), completo=False):
+    """Avisar a los observadores; un observador con error no afecta la escritura ya confirmada"""
+    for observador in _observadores_cambios:
+        try:
+            observador(stock_data, modificados, eliminados, movimientos, completo)
+        except Exception as e:
+            print(f"⚠️ Error en observador {observador.__name__}: {e}")
+
+def guardar_cambios(stock_data, modificados=(), eliminados=(), movimientos=()):
+    """Persistir productos afectados y sus movimientos en una única transacción
+    
+    Solo se escriben las filas indicadas en `modificados` (upsert) y `eliminados`,
+    junto con los movimientos, sobre una sola conexión del pool. El respaldo JSON
+    de movimientos se escribe fuera del request.
+    """
+    modificados = list(modificados)
+    # Un código eliminado y recreado en la misma unidad de trabajo (transferencia de ida
+    # y vuelta, ingreso posterior) sigue existiendo: solo se escribe su upsert
+    eliminados = [codigo for codigo in eliminados if stock_data is None or codigo not in stock_data]
+    movimientos = anotar_imagenes(stock_data, modificados, eliminados, list(movimientos))
+    
+    if engine:
+        try:
+            particiones_movimientos.revisar()
+            with engine.begin() as conn:
+                ids = ids_productos(conn, eliminados) if eliminados and movimientos else {}
+                for codigo in modificados:
+                    conn.execute(SQL_UPSERT_PRODUCTO, parametros_producto(codigo, stock_data[codigo]))
+                for codigo in eliminados:
+                    conn.execute(SQL_ELIMINAR_PRODUCTO, {'codigo': codigo})
+                if movimientos:
+                    ids.update(ids_productos(conn, {mov['codigo'] for mov in movimientos} - set(ids)))
+                    for movimiento in movimientos:
+                        movimiento['producto_id'] = ids.get(movimiento['codigo'])
+                    conn.execute(SQL_INSERTAR_MOVIMIENTO, movimientos)
+                for codigo in modificados:
+                    if codigo in ids:
+                        stock_data[codigo]['id'] = ids[codigo]
+            
+            print(f"✅ Cambios guardados en PostgreSQL: {len(modificados) + len(eliminados)} productos, {len(movimientos)} movimientos")
+            
+            # Respaldo JSON de movimientos fuera del camino del request
+            if movimientos:
+                espejo_movimientos_json.encolar(movimientos)
+                snapshots_stock.anotar(len(movimientos))
+            notificar_cambios(stock_data, modificados, eliminados, movimientos)
+            return
+            
+        except Exception as e:
+            print(f"❌ Error en transacción PostgreSQL, usando JSON: {e}")
+    
+    # Modo JSON (o fallback): el archivo es el almacenamiento principal
+    ids = {codigo: ids_productos_json.id_de(codigo) for codigo in eliminados}
+    if stock_data is not None and (modificados or eliminados):
+        guardar_stock_json(stock_data, modificados, eliminados)
+    if movimientos:
+        for movimiento in movimientos:
+            item = (stock_data or {}).get(movimiento['codigo'])
+            movimiento['producto_id'] = item.get('id') if item else ids.get(movimiento['codigo'])
+        guardar_movimientos_json(movimientos)
+    notificar_cambios(stock_data, modificados, eliminados, movimientos)
+
+def obtener_titulos(tipo_hilado):
+    """Obtener títulos disponibles para un tipo de hilado"""
+    hilado = CATALOGO_DE_HILOS.get(tipo_hilado)
+    if hilado is None:
+        return []
+    if isinstance(hilado, dict):
+        return list(hilado.keys())
+    if isinstance(hilado, list):
+        return hilado
+    return []
+
+def obtener_caracteristicas(tipo_hilado, titulo):
+    """Obtener características disponibles para un hilo específico"""
+    hilado = CATALOGO_DE_HILOS.get(tipo_hilado)
+    if hilado is None:
+        return []
+    if tipo_hilado == "Melange":
+        porcentajes = hilado.get(titulo, {}).get("Porcentaje", [])
+        return porcentajes
+    if isinstance(hilado, dict):
+        return hilado.get(titulo, {}).get("caracteristica", [])
+    return []
+
+# =====================================
+# FRAGMENTOS DEL STOCK POR UBICACIÓN
+# =====================================
+
+class FragmentosUbicacion:
+    """Códigos del stock JSON agrupados por ubicación (un fragmento por depósito)
+    
+    Las consultas de un depósito copian solo los productos de su fragmento. Se arma
+    una vez desde el almacén y después cada cambio confirmado mueve solo los códigos
+    tocados. En PostgreSQL el fragmento es el rango de idx_stock_ubicacion.
+    """
+    
+    def __init__(self):
+        self._ubicacion = {}
+        self._codigos = defaultdict(set)
+        self._inicializado = False
+        self._lock = threading.Lock()
+    
+    def inicializar(self, stock=None):
+        stock = cargar_stock_json() if stock is None else stock
+        ubicaciones = {codigo: item.get('ubicacion') for codigo, item in stock.items()}
+        codigos = defaultdict(set)
+        for codigo, ubicacion in ubicaciones.items():
+            codigos[ubicacion].add(codigo)
+        with self._lock:
+            self._ubicacion, self._codigos = ubicaciones, codigos
+            self._inicializado = True
+    
+    def aplicar(self, stock_data, modificados, eliminados, movimientos, completo=False):
+        """Observador de cambios: mover solo los códigos afectados de fragmento"""
+        if completo:
+            if self._inicializado:
+                self.inicializar(stock_data)
+            return
+        if not self._inicializado:
+            return
+        modificados = set(modificados)
+        with self._lock:
+            for codigo in modificados | set(eliminados):
+                if codigo in self._ubicacion:
+                    self._codigos[self._ubicacion.pop(codigo)].discard(codigo)
+                if codigo in modificados and stock_data and codigo in stock_data:
+                    ubicacion = stock_data[codigo].get('ubicacion')
+                    self._ubicacion[codigo] = ubicacion
+                    self._codigos[ubicacion].add(codigo)
+    
+    def codigos(self, ubicacion):
+        """Códigos del fragmento de `ubicacion` (arma los fragmentos la primera vez)"""
+        if not self._inicializado:
+            self.inicializar()
+        with self._lock:
+            return list(self._codigos.get(ubicacion, ()))
+
+fragmentos_ubicacion = FragmentosUbicacion()
+registrar_observador(fragmentos_ubicacion.aplicar)
+
+def modelo_ubicacion(ubicacion=None):
+    """Modelo columnar de todo el stock (cacheado) o solo del fragmento de una ubicación"""
+    if ubicacion:
+        return ColumnasStock.desde_stock(cargar_stock(ubicacion))
+    return modelo_stock.obtener()
+
+# =====================================
+# OPERACIONES DE STOCK
+# =====================================
+
+# Tipos de operación aceptados por /api/deposito/operaciones-lote
+OPERACIONES_STOCK = ['INGRESO', 'AJUSTE', 'EGRESO', 'TRANSFERENCIA']
+MAX_OPERACIONES_LOTE = 500
+
+# Campos obligatorios de un ingreso (modelo de /api/deposito/agregar-hilo)
+CAMPOS_OBLIGATORIOS_HILO = ['tipo_hilado', 'titulo', 'caracteristica', 'color', 'lote', 'formato', 'ubicacion', 'proveedor']
+
+class OperacionInvalida(ValueError):
+    """Operación de stock rechazada por validación"""
+
+class ProductoNoEncontrado(LookupError):
+    """El código no existe en el stock"""
+
+def generar_codigo(tipo, titulo, caracteristica, color, lote, ubicacion):
+    """Generar el código único de un lote"""
+    return f"{tipo}_{titulo}_{caracteristica}_{color}_{lote}_{ubicacion}".replace(' ', '_').replace('&', 'y')
+
+def descripcion_producto(item):
+    """Descripción corta de un producto para el historial de movimientos"""
+    return f"{item.get('tipo', '')} {item.get('titulo', '')} {item.get('caracteristica', '')} {item.get('color', '')}".strip()
+
+def validar_hilo(data):
+    """Validar los campos de un ingreso contra el catálogo y los datos maestros"""
+    if not all(data.get(campo) for campo in CAMPOS_OBLIGATORIOS_HILO):
+        raise OperacionInvalida('Complete todos los campos obligatorios')
+    
+    tipo = data['tipo_hilado']
+    titulo = data['titulo']
+    if tipo not in CATALOGO_DE_HILOS:
+        raise OperacionInvalida(f"Tipo de hilado desconocido: {tipo}")
+    if titulo not in CATALOGO_DE_HILOS[tipo]:
+        raise OperacionInvalida(f"Título {titulo} no disponible para {tipo}")
+    if data['caracteristica'] not in CATALOGO_DE_HILOS[tipo][titulo].get('caracteristica', []):
+        raise OperacionInvalida(f"Característica {data['caracteristica']} no disponible para {tipo} {titulo}")
+    if data['color'] not in LISTA_DE_COLORES:
+        raise OperacionInvalida(f"Color desconocido: {data['color']}")
+    if data['formato'] not in LISTA_DE_FORMATOS:
+        raise OperacionInvalida(f"Formato desconocido: {data['formato']}")
+    if data['ubicacion'] not in LISTA_DE_UBICACIONES:
+        raise OperacionInvalida(f"Ubicación desconocida: {data['ubicacion']}")
+    if data['proveedor'] not in LISTA_DE_PROVEEDORES:
+        raise OperacionInvalida(f"Proveedor desconocido: {data['proveedor']}")
+
+def construir_item_hilo(data):
+    """Construir un producto a partir de los campos de /api/deposito/agregar-hilo"""
+    formato = data.get('formato')
+    item = {
+        'tipo': data.get('tipo_hilado'),
+        'titulo': data.get('titulo'),
+        'caracteristica': data.get('caracteristica'),
+        'color': data.get('color'),
+        'formato': formato,
+        'lote': data.get('lote'),
+        'ubicacion': data.get('ubicacion'),
+        'proveedor': data.get('proveedor'),
+        'fecha_ingreso': datetime.now().isoformat(),
+        'ultima_modificacion': datetime.now().isoformat()
+    }
+    
+    # Agregar campos específicos según formato
+    if formato == "cajas":
+        item.update({
+            'cantidad': int(data.get('cantidad_cajas', 0)),
+            'kilos_por_caja': float(data.get('kilos_por_caja', 0)),
+            'conos_por_caja': int(data.get('conos_por_caja', 0)),
+            'descripcion_cono': data.get('descripcion_cono', '')
+        })
+    elif formato == "Palletizado":
+        item.update({
+            'cantidad': int(data.get('cantidad_pallets', 0)),
+            'kilos_por_pallet': float(data.get('kilos_por_pallet', 0)),
+            'conos_por_pallet': int(data.get('conos_por_pallet', 0)),
+            'descripcion_cono': data.get('descripcion_cono', '')
+        })
+    return item
+
+def aplicar_ingreso(stock, item, modificados, movimientos, usuario='Sistema', tipo_suma='AJUSTE', eliminados=None):
+    """Sumar un lote al stock en memoria (lo crea si no existe) y registrar su movimiento"""
+    codigo = generar_codigo(item['tipo'], item['titulo'], item['caracteristica'],
+                            item['color'], item['lote'], item['ubicacion'])
+    descripcion_movimiento = descripcion_producto(item)
+    cantidad_movimiento = item['cantidad']
+    
+    if codigo in stock:
+        stock[codigo]['cantidad'] += cantidad_movimiento
+        stock[codigo]['ultima_modificacion'] = datetime.now().isoformat()
+        movimientos.append(crear_movimiento(tipo_suma, codigo, f"Suma a stock existente: {descripcion_movimiento}",
+                                            cantidad_movimiento, item['ubicacion'], usuario))
+    else:
+        stock[codigo] = item
+        movimientos.append(crear_movimiento('INGRESO', codigo, f"Nuevo ingreso: {descripcion_movimiento}",
+                                            cantidad_movimiento, item['ubicacion'], usuario))
+    
+    modificados.add(codigo)
+    if eliminados is not None:
+        eliminados.discard(codigo)
+    return codigo
+
+def _cantidad_operacion(operacion, permitir_negativa=False):
+    """Leer y validar la cantidad de una operación"""
+    try:
+        cantidad = int(operacion.get('cantidad'))
+    except (TypeError, ValueError):
+        raise OperacionInvalida('Cantidad inválida')
+    if cantidad == 0 or (cantidad < 0 and not permitir_negativa):
+        raise OperacionInvalida('La cantidad debe ser mayor a cero')
+    return cantidad
+
+def _producto_operacion(stock, operacion):
+    """Obtener el producto referenciado por una operación"""
+    codigo = operacion.get('codigo')
+    if not codigo or codigo not in stock:
+        raise OperacionInvalida(f"Producto no encontrado: {codigo}")
+    return codigo, stock[codigo]
+
+def aplicar_transferencia(stock, codigo, ubicacion_destino, cantidad, modificados, eliminados, movimientos, usuario='Sistema'):
+    """Mover cantidad de un lote a otra ubicación, dividiendo o fusionando lotes"""
+    if ubicacion_destino not in LISTA_DE_UBICACIONES:
+        raise OperacionInvalida(f"Ubicación desconocida: {ubicacion_destino}")
+    origen = stock[codigo]
+    if ubicacion_destino == origen.get('ubicacion'):
+        raise OperacionInvalida('La ubicación destino es igual a la de origen')
+    disponible = origen.get('cantidad', 0)
+    if cantidad is None:
+        cantidad = disponible
+    if cantidad <= 0 or cantidad > disponible:
+        raise OperacionInvalida(f"Cantidad a transferir inválida (disponible: {disponible})")
+    
+    codigo_destino = generar_codigo(origen.get('tipo'), origen.get('titulo'), origen.get('caracteristica'),
+                                    origen.get('color'), origen.get('lote'), ubicacion_destino)
+    ahora = datetime.now().isoformat()
+    if codigo_destino in stock:
+        stock[codigo_destino]['cantidad'] += cantidad
+        stock[codigo_destino]['ultima_modificacion'] = ahora
+    else:
+        # El lote nuevo recibe su propio id al guardarse
+        stock[codigo_destino] = dict(origen, ubicacion=ubicacion_destino, cantidad=cantidad, ultima_modificacion=ahora)
+        stock[codigo_destino].pop('id', None)
+    modificados.add(codigo_destino)
+    eliminados.discard(codigo_destino)
+    
+    # Un movimiento completo de lote deja de existir en el origen
+    if cantidad == disponible:
+        del stock[codigo]
+        modificados.discard(codigo)
+        eliminados.add(codigo)
+    else:
+        origen['cantidad'] = disponible - cantidad
+        origen['ultima_modificacion'] = ahora
+        modificados.add(codigo)
+        eliminados.discard(codigo)
+    
+    descripcion = descripcion_producto(origen)
+    movimientos.append(crear_movimiento('TRANSFERENCIA', codigo, f"Transferencia a {ubicacion_destino}: {descripcion}",
+                                        -cantidad, origen.get('ubicacion', ''), usuario))
+    movimientos.append(crear_movimiento('TRANSFERENCIA', codigo_destino, f"Transferencia desde {origen.get('ubicacion', '')}: {descripcion}",
+                                        cantidad, ubicacion_destino, usuario))
+    return codigo_destino
+
+def codigo_destino_transferencia(item, ubicacion_destino):
+    """Código que tendrá el lote en la ubicación destino"""
+    return generar_codigo(item.get('tipo'), item.get('titulo'), item.get('caracteristica'),
+                          item.get('color'), item.get('lote'), ubicacion_destino)
+
+def transferir_lotes(pedidos, usuario='Sistema'):
+    """Aplicar varias transferencias en una sola unidad de trabajo (todas o ninguna)
+    
+    Solo se cargan los lotes de origen y los posibles destinos; el destino de un salto
+    encadenado (A→B y después B→C) se carga al llegar a ese salto. Cada transferencia
+    deja su par de movimientos (salida del origen y entrada al destino).
+    """
+    if not isinstance(pedidos, list) or not pedidos:
+        raise OperacionInvalida('Debe enviar al menos una transferencia')
+    if len(pedidos) > MAX_OPERACIONES_LOTE:
+        raise OperacionInvalida(f'Máximo {MAX_OPERACIONES_LOTE} transferencias por pedido')
+    for pedido in pedidos:
+        if not isinstance(pedido, dict):
+            raise OperacionInvalida('Transferencia con formato inválido')
+        if not pedido.get('codigo') and pedido.get('id') is not None:
+            pedido['codigo'] = codigo_por_id(int(pedido['id']))
+    
+    stock = cargar_productos({pedido.get('codigo') for pedido in pedidos if pedido.get('codigo')})
+    destinos = {codigo_destino_transferencia(stock[pedido['codigo']], pedido.get('ubicacion_destino'))
+                for pedido in pedidos if pedido.get('codigo') in stock}
+    stock.update(cargar_productos(destinos - set(stock)))
+    
+    modificados, eliminados, movimientos = set(), set(), []
+    resultados = []
+    for indice, pedido in enumerate(pedidos):
+        try:
+            codigo, origen = _producto_operacion(stock, pedido)
+            cantidad = _cantidad_operacion(pedido) if pedido.get('cantidad') is not None else None
+            movida = origen.get('cantidad', 0) if cantidad is None else cantidad
+            destino = codigo_destino_transferencia(origen, pedido.get('ubicacion_destino'))
+            if destino not in stock and destino not in eliminados:
+                stock.update(cargar_productos([destino]))
+            destino = aplicar_transferencia(stock, codigo, pedido.get('ubicacion_destino'), cantidad,
+                                            modificados, eliminados, movimientos, pedido.get('usuario') or usuario)
+        except OperacionInvalida as e:
+            raise OperacionInvalida(f"Transferencia {indice}: {e}")
+        resultados.append({'codigo_origen': codigo, 'codigo_destino': destino,
+                           'cantidad': movida,
+                           'cantidad_origen': stock[codigo].get('cantidad', 0) if codigo in stock else 0,
+                           'cantidad_destino': stock[destino].get('cantidad', 0)})
+    
+    guardar_cambios(stock, modificados=modificados, eliminados=eliminados, movimientos=movimientos)
+    for resultado in resultados:
+        # Un destino que un salto posterior vació ya no tiene id
+        resultado['id_destino'] = stock.get(resultado['codigo_destino'], {}).get('id')
+    return resultados
+
+def actualizar_con_transferencia(codigo, data):
+    """PUT que cambia la ubicación: se aplican los demás campos y el lote completo se transfiere
+    
+    Así el código (derivado de la ubicación) no queda desactualizado. Devuelve
+    (código final, producto).
+    """
+    stock = cargar_productos([codigo])
+    if codigo not in stock:
+        raise ProductoNoEncontrado(codigo)
+    modificados, eliminados, movimientos = set(), set(), []
+    resto = {campo: valor for campo, valor in data.items() if campo != 'ubicacion'}
+    if resto:
+        aplicar_actualizacion(stock, codigo, resto, modificados, movimientos)
+    if data['ubicacion'] != stock[codigo].get('ubicacion'):
+        destino = codigo_destino_transferencia(stock[codigo], data['ubicacion'])
+        if destino != codigo:
+            stock.update(cargar_productos([destino]))
+        codigo = aplicar_transferencia(stock, codigo, data['ubicacion'], None, modificados, eliminados, movimientos)
+    guardar_cambios(stock, modificados=modificados, eliminados=eliminados, movimientos=movimientos)
+    return codigo, dict(stock[codigo])
+
+def aplicar_actualizacion(stock, codigo, data, modificados, movimientos):
+    """Aplicar los campos de un PUT sobre un producto en memoria y registrar el ajuste de cantidad"""
+    if codigo not in stock:
+        raise ProductoNoEncontrado(codigo)
+    
+    # Guardar valores anteriores para el log
+    producto_anterior = stock[codigo].copy()
+    cantidad_anterior = producto_anterior.get('cantidad', 0)
+    
+    # Convertir antes de modificar para no dejar el producto a medio actualizar
+    cambios = {}
+    for key, value in data.items():
+        if key in ['cantidad', 'precio_unitario']:
+            cambios[key] = float(value) if value is not None else producto_anterior.get(key, 0)
+        else:
+            cambios[key] = value
+    
+    stock[codigo].update(cambios)
+    stock[codigo]['ultima_modificacion'] = datetime.now().isoformat()
+    modificados.add(codigo)
+    
+    # Registrar movimiento si cambió la cantidad
+    cantidad_nueva = stock[codigo].get('cantidad', 0)
+    if cantidad_anterior != cantidad_nueva:
+        diferencia = cantidad_nueva - cantidad_anterior
+        descripcion = f"{producto_anterior.get('tipo', '')} {producto_anterior.get('titulo', '')} {producto_anterior.get('color', '')}".strip()
+        movimientos.append(crear_movimiento('AJUSTE', codigo, f"Actualización de stock: {descripcion}",
+                                            diferencia, producto_anterior.get('ubicacion', ''), 'Sistema'))
+    
+    return dict(stock[codigo])
+
+def aplicar_operacion(stock, operacion, modificados, eliminados, movimientos):
+    """Aplicar una operación de lote sobre el stock en memoria y devolver su resultado"""
+    if not isinstance(operacion, dict):
+        raise OperacionInvalida('Operación con formato inválido')
+    tipo_operacion = str(operacion.get('operacion', '')).upper()
+    usuario = operacion.get('usuario') or 'Sistema'
+    
+    if tipo_operacion == 'INGRESO':
+        validar_hilo(operacion)
+        item = construir_item_hilo(operacion)
+        if item.get('cantidad', 0) <= 0:
+            raise OperacionInvalida('La cantidad debe ser mayor a cero')
+        codigo = aplicar_ingreso(stock, item, modificados, movimientos, usuario, eliminados=eliminados)
+    
+    elif tipo_operacion in ('AJUSTE', 'EGRESO'):
+        codigo, producto = _producto_operacion(stock, operacion)
+        cantidad = _cantidad_operacion(operacion, permitir_negativa=(tipo_operacion == 'AJUSTE'))
+        diferencia = cantidad if tipo_operacion == 'AJUSTE' else -cantidad
+        if producto.get('cantidad', 0) + diferencia < 0:
+            raise OperacionInvalida(f"Stock insuficiente (disponible: {producto.get('cantidad', 0)})")
+        producto['cantidad'] = producto.get('cantidad', 0) + diferencia
+        producto['ultima_modificacion'] = datetime.now().isoformat()
+        modificados.add(codigo)
+        etiqueta = 'Ajuste de stock' if tipo_operacion == 'AJUSTE' else 'Egreso de stock'
+        movimientos.append(crear_movimiento(tipo_operacion, codigo, f"{etiqueta}: {descripcion_producto(producto)}",
+                                            diferencia, producto.get('ubicacion', ''), usuario))
+    
+    elif tipo_operacion == 'TRANSFERENCIA':
+        codigo_origen, _ = _producto_operacion(stock, operacion)
+        cantidad = _cantidad_operacion(operacion) if operacion.get('cantidad') is not None else None
+        codigo = aplicar_transferencia(stock, codigo_origen, operacion.get('ubicacion_destino'), cantidad,
+                                       modificados, eliminados, movimientos, usuario)
+    
+    else:
+        raise OperacionInvalida(f"Operación desconocida: {operacion.get('operacion')} (válidas: {', '.join(OPERACIONES_STOCK)})")
+    
+    return {'codigo': codigo, 'cantidad': stock[codigo].get('cantidad', 0)}
+
+# =====================================
+# AGRUPAMIENTO DE AJUSTES (GROUP COMMIT)
+# =====================================
+
+# Ventana en milisegundos para agrupar PUTs de productos; 0 desactiva el modo
+COALESCER_AJUSTES_MS = int(os.environ.get('COALESCER_AJUSTES_MS', 0))
+
+class CoalescedorAjustes:
+    """Agrupa las actualizaciones de productos recibidas en una ventana corta y las confirma juntas
+    
+    El primer request de la ventana actúa como líder: espera la ventana, toma todos los
+    pedidos pendientes, los aplica en orden de llegada y los confirma con una sola llamada
+    a guardar_cambios. Cada pedido conserva su propio movimiento de AJUSTE y recibe el
+    producto tal como quedó después de su actualización.
+    """
+    
+    def __init__(self, ventana_ms):
+        self.ventana = ventana_ms / 1000
+        self._pendientes = []
+        self._hay_lider = False
+        self._lock = threading.Lock()
+        self._lock_confirmacion = threading.Lock()
+    
+    def enviar(self, codigo, data):
+        """Encolar una actualización y esperar a que se confirme su grupo"""
+        pedido = {'codigo': codigo, 'data': data, 'listo': threading.Event(), 'resultado': None, 'error': None}
+        with self._lock:
+            self._pendientes.append(pedido)
+            es_lider = not self._hay_lider
+            self._hay_lider = True
+        
+        if es_lider:
+            time.sleep(self.ventana)
+            with self._lock:
+                grupo, self._pendientes = self._pendientes, []
+                self._hay_lider = False
+            self._confirmar(grupo)
+        
+        pedido['listo'].wait()
+        if pedido['error'] is not None:
+            raise pedido['error']
+        return pedido['resultado']
+    
+    def _confirmar(self, grupo):
+        """Aplicar y persistir un grupo de pedidos en una única transacción"""
+        # Los grupos se confirman de a uno para que cada uno lea lo que escribió el anterior
+        with self._lock_confirmacion:
+            try:
+                stock = cargar_productos({pedido['codigo'] for pedido in grupo})
+                modificados, movimientos = set(), []
+                for pedido in grupo:
+                    try:
+                        pedido['resultado'] = aplicar_actualizacion(stock, pedido['codigo'], pedido['data'],
+                                                                    modificados, movimientos)
+                    except Exception as e:
+                        pedido['error'] = e
+                if modificados:
+                    guardar_cambios(stock, modificados=modificados, movimientos=movimientos)
+                print(f"✅ Grupo de ajustes confirmado: {len(grupo)} pedidos, {len(modificados)} productos")
+            except Exception as e:
+                for pedido in grupo:
+                    if pedido['error'] is None:
+                        pedido['error'] = e
+            finally:
+                for pedido in grupo:
+                    pedido['listo'].set()
+
+coalescedor_ajustes = CoalescedorAjustes(COALESCER_AJUSTES_MS) if COALESCER_AJUSTES_MS > 0 else None
+
+# =====================================
+# IMPORTACIÓN DE REMITOS (CSV)
+# =====================================
+
+# Filas por transacción al importar remitos
+TAMANO_BLOQUE_IMPORTACION = 500
+MAX_ERRORES_REPORTADOS = 100
+
+# Codificación de respaldo cuando el CSV no es UTF-8 (exportaciones de Excel es-AR)
+CODIFICACION_RESPALDO_REMITO = 'cp1252'
+
+# Encabezados aceptados en los CSV de proveedores -> campo de /api/deposito/agregar-hilo
+ALIAS_COLUMNAS_REMITO = {
+    'tipo': 'tipo_hilado', 'tipo_hilado': 'tipo_hilado', 'hilado': 'tipo_hilado',
+    'titulo': 'titulo',
+    'caracteristica': 'caracteristica',
+    'color': 'color',
+    'lote': 'lote', 'partida': 'lote',
+    'formato': 'formato',
+    'ubicacion': 'ubicacion', 'deposito': 'ubicacion',
+    'proveedor': 'proveedor',
+    'cantidad': 'cantidad', 'bultos': 'cantidad',
+    'cantidad_cajas': 'cantidad_cajas', 'cajas': 'cantidad_cajas',
+    'cantidad_pallets': 'cantidad_pallets', 'pallets': 'cantidad_pallets',
+    'kilos': 'kilos', 'kilos_por_caja': 'kilos_por_caja', 'kilos_por_pallet': 'kilos_por_pallet',
+    'conos': 'conos', 'conos_por_caja': 'conos_por_caja', 'conos_por_pallet': 'conos_por_pallet',
+    'descripcion_cono': 'descripcion_cono'
+}
+
+def normalizar_encabezado(encabezado):
+    """Normalizar un encabezado de CSV: minúsculas, sin acentos y con guiones bajos"""
+    texto = unicodedata.normalize('NFKD', (encabezado or '').strip().lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return texto.replace(' ', '_').replace('-', '_')
+
+def mapear_fila_remito(fila, columnas, valores_defecto):
+    """Traducir una fila del CSV al modelo de campos de api_agregar_hilo"""
+    data = dict(valores_defecto)
+    for encabezado, campo in columnas.items():
+        valor = (fila.get(encabezado) or '').strip()
+        if valor:
+            data[campo] = valor
+    
+    # Decimales con coma (planillas es-AR)
+    for campo in ('kilos', 'kilos_por_caja', 'kilos_por_pallet'):
+        if campo in data:
+            data[campo] = str(data[campo]).replace(',', '.')
+    
+    # Las columnas genéricas se asignan según el formato del lote
+    sufijo = 'pallet' if data.get('formato') == 'Palletizado' else 'caja'
+    if 'cantidad' in data:
+        data.setdefault('cantidad_pallets' if sufijo == 'pallet' else 'cantidad_cajas', data.pop('cantidad'))
+    if 'kilos' in data:
+        data.setdefault(f'kilos_por_{sufijo}', data.pop('kilos'))
+    if 'conos' in data:
+        data.setdefault(f'conos_por_{sufijo}', data.pop('conos'))
+    return data
+
+def decodificar_lineas(flujo, codificacion=None):
+    """Líneas de texto de un flujo binario
+    
+    Sin `codificacion` se lee UTF-8 (con o sin BOM) y, desde la primera línea que no
+    lo es, CODIFICACION_RESPALDO_REMITO. Una línea que no se puede decodificar levanta
+    UnicodeDecodeError al llegar a ella.
+    """
+    primera = True
+    for linea in flujo:
+        if primera and linea.startswith(codecs.BOM_UTF8) and codificacion in (None, 'utf-8', 'utf-8-sig'):
+            linea = linea[len(codecs.BOM_UTF8):]
+        primera = False
+        if codificacion is None:
+            try:
+                yield linea.decode('utf-8')
+                continue
+            except UnicodeDecodeError:
+                codificacion = CODIFICACION_RESPALDO_REMITO
+        yield linea.decode(codificacion)
+
+def leer_remito_csv(flujo, codificacion=None):
+    """Leer un CSV de remito fila a fila sin cargarlo completo en memoria"""
+    if codificacion:
+        try:
+            codificacion = codecs.lookup(codificacion).name
+        except LookupError:
+            raise OperacionInvalida(f"Codificación desconocida: {codificacion}")
+    texto = decodificar_lineas(flujo, codificacion)
+    primera_linea = next(texto, '')
+    if not primera_linea:
+        return {}, iter(())
+    
+    # Las planillas exportadas en es-AR suelen usar ';' como separador
+    separador = ';' if primera_linea.count(';') > primera_linea.count(',') else ','
+    lector = csv.DictReader(itertools.chain([primera_linea], texto), delimiter=separador)
+    columnas = {}
+    for encabezado in lector.fieldnames or []:
+        campo = ALIAS_COLUMNAS_REMITO.get(normalizar_encabezado(encabezado))
+        if campo:
+            columnas[encabezado] = campo
+    return columnas, lector
+
+def importar_bloque_remito(filas, modificados_total, usuario, solo_validar):
+    """Validar y aplicar un bloque de filas del remito en una sola transacción"""
+    items = []
+    errores = []
+    for numero_fila, data in filas:
+        try:
+            validar_hilo(data)
+            item = construir_item_hilo(data)
+            if item.get('cantidad', 0) <= 0:
+                raise OperacionInvalida('La cantidad debe ser mayor a cero')
+            items.append(item)
+        except (OperacionInvalida, TypeError, ValueError) as e:
+            errores.append({'fila': numero_fila, 'error': str(e)})
+    
+    if not items or solo_validar:
+        return len(items), errores
+    
+    codigos = {generar_codigo(i['tipo'], i['titulo'], i['caracteristica'], i['color'], i['lote'], i['ubicacion']) for i in items}
+    stock = cargar_productos(codigos)
+    modificados, movimientos = set(), []
+    for item in items:
+        aplicar_ingreso(stock, item, modificados, movimientos, usuario, tipo_suma='INGRESO')
+    guardar_cambios(stock, modificados=modificados, movimientos=movimientos)
+    modificados_total.update(modificados)
+    return len(items), errores
+
+def importar_remito(flujo, valores_defecto, usuario='Sistema', solo_validar=False, codificacion=None):
+    """Importar un remito CSV en bloques de TAMANO_BLOQUE_IMPORTACION filas
+    
+    Si el archivo se corta o no se puede decodificar, se confirman las filas ya leídas
+    y se devuelve el resumen con la línea que falló en `interrumpido`: todas las filas
+    anteriores quedan importadas y las siguientes no.
+    """
+    columnas, lector = leer_remito_csv(flujo, codificacion)
+    if not columnas:
+        raise OperacionInvalida('El archivo no tiene encabezados reconocibles')
+    
+    resumen = {
+        'filas_leidas': 0,
+        'filas_importadas': 0,
+        'filas_con_error': 0,
+        'productos_afectados': 0,
+        'bloques': 0,
+        'columnas_reconocidas': sorted(set(columnas.values())),
+        'errores': [],
+        'progreso': []
+    }
+    modificados_total = set()
+    bloque = []
+    
+    def procesar_bloque():
+        importadas, errores = importar_bloque_remito(bloque, modificados_total, usuario, solo_validar)
+        resumen['bloques'] += 1
+        resumen['filas_importadas'] += importadas
+        resumen['filas_con_error'] += len(errores)
+        espacio = MAX_ERRORES_REPORTADOS - len(resumen['errores'])
+        resumen['errores'].extend(errores[:max(espacio, 0)])
+        resumen['progreso'].append({'bloque': resumen['bloques'], 'filas_leidas': resumen['filas_leidas'],
+                                    'filas_importadas': resumen['filas_importadas']})
+        print(f"📥 Remito: bloque {resumen['bloques']} - {resumen['filas_leidas']} filas leídas")
+        bloque.clear()
+    
+    # La fila 1 es el encabezado
+    filas = enumerate(lector, start=2)
+    while True:
+        try:
+            numero_fila, fila = next(filas)
+        except StopIteration:
+            break
+        except (UnicodeDecodeError, csv.Error) as e:
+            # csv.Error ya contó la línea fallida; UnicodeDecodeError todavía no
+            linea = lector.line_num + (1 if isinstance(e, UnicodeDecodeError) else 0)
+            resumen['interrumpido'] = {'linea': linea, 'error': str(e)}
+            print(f"❌ Remito interrumpido en la línea {linea}: {e}")
+            break
+        resumen['filas_leidas'] += 1
+        bloque.append((numero_fila, mapear_fila_remito(fila, columnas, valores_defecto)))
+        if len(bloque) >= TAMANO_BLOQUE_IMPORTACION:
+            procesar_bloque()
+    if bloque:
+        procesar_bloque()
+    
+    resumen['productos_afectados'] = len(modificados_total)
+    return resumen
+
+# =====================================
+# IDEMPOTENCIA DE MUTACIONES
+# =====================================
+
+IDEMPOTENCIA_TTL_SEGUNDOS = int(os.environ.get('IDEMPOTENCIA_TTL_SEGUNDOS', 3600))
+IDEMPOTENCIA_MAX_ENTRADAS = 10000
+
+# Cuerpos más grandes (p. ej. remitos CSV) se identifican por tipo y tamaño
+IDEMPOTENCIA_MAX_BYTES_HUELLA = 1024 * 1024
+
+class AlmacenIdempotencia:
+    """Respuestas recientes indexadas por Idempotency-Key, con vencimiento"""
+    
+    EN_CURSO = 'en_curso'
+    
+    def __init__(self, ttl_segundos, max_entradas):
+        self.ttl_segundos = ttl_segundos
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _purgar(self, ahora):
+        """Eliminar entradas vencidas y las más antiguas si se supera el máximo"""
+        while self._entradas:
+            clave, entrada = next(iter(self._entradas.items()))
+            if entrada['vence'] > ahora and len(self._entradas) <= self.max_entradas:
+                break
+            del self._entradas[clave]
+    
+    def reservar(self, clave, huella):
+        """Reservar una clave; devuelve None si es nueva o la entrada existente"""
+        ahora = time.time()
+        with self._lock:
+            self._purgar(ahora)
+            entrada = self._entradas.get(clave)
+            if entrada and entrada['vence'] > ahora:
+                return entrada
+            self._entradas[clave] = {'estado': self.EN_CURSO, 'huella': huella, 'vence': ahora + self.ttl_segundos}
+            return None
+    
+    def completar(self, clave, respuesta):
+        """Guardar la respuesta final de una clave reservada"""
+        with self._lock:
+            self._entradas[clave] = {
+                'estado': 'completa',
+                'huella': self._entradas.get(clave, {}).get('huella'),
+                'vence': time.time() + self.ttl_segundos,
+                'status': respuesta.status_code,
+                'cuerpo': respuesta.get_data(),
+                'mimetype': respuesta.mimetype
+            }
+            self._entradas.move_to_end(clave)
+    
+    def liberar(self, clave):
+        """Descartar una reserva (la solicitud falló y puede reintentarse)"""
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+almacen_idempotencia = AlmacenIdempotencia(IDEMPOTENCIA_TTL_SEGUNDOS, IDEMPOTENCIA_MAX_ENTRADAS)
+
+def huella_formulario():
+    """Huella de un multipart: campos y contenido de cada archivo, sin el boundary (cambia en cada envío)"""
+    huella = hashlib.sha256()
+    for campo, valor in sorted(request.form.items(multi=True)):
+        huella.update(json.dumps(['campo', campo, valor], ensure_ascii=False).encode())
+    for campo, archivo in sorted(request.files.items(multi=True), key=lambda par: (par[0], par[1].filename or '')):
+        contenido = hashlib.sha256()
+        for bloque in iter(lambda: archivo.stream.read(65536), b''):
+            contenido.update(bloque)
+        archivo.stream.seek(0)
+        huella.update(json.dumps(['archivo', campo, archivo.filename, contenido.hexdigest()], ensure_ascii=False).encode())
+    return huella.hexdigest()
+
+def huella_request():
+    """Huella del cuerpo del request para detectar claves reutilizadas con otro contenido"""
+    if request.mimetype == 'multipart/form-data':
+        return huella_formulario()
+    if (request.content_length or 0) > IDEMPOTENCIA_MAX_BYTES_HUELLA:
+        contenido = f"{request.content_type}|{request.content_length}".encode()
+    else:
+        contenido = request.get_data(cache=True)
+    return hashlib.sha256(contenido).hexdigest()
+
+def idempotente(vista):
+    """Decorador: un reintento con el mismo Idempotency-Key devuelve la respuesta original sin re-ejecutar"""
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        clave_cliente = request.headers.get('Idempotency-Key')
+        if not clave_cliente:
+            return vista(*args, **kwargs)
+        
+        clave = f"{request.method} {request.path} {clave_cliente}"
+        huella = huella_request()
+        entrada = almacen_idempotencia.reservar(clave, huella)
+        
+        if entrada is not None:
+            if entrada['huella'] != huella:
+                return jsonify({'success': False, 'error': 'Idempotency-Key ya utilizada con otro contenido'}), 422
+            if entrada['estado'] == AlmacenIdempotencia.EN_CURSO:
+                return jsonify({'success': False, 'error': 'Solicitud en curso, reintente en unos segundos'}), 409
+            respuesta = app.response_class(entrada['cuerpo'], status=entrada['status'], mimetype=entrada['mimetype'])
+            respuesta.headers['Idempotent-Replayed'] = 'true'
+            return respuesta
+        
+        try:
+            respuesta = app.make_response(vista(*args, **kwargs))
+        except Exception:
+            almacen_idempotencia.liberar(clave)
+            raise
+        
+        # Los errores del servidor no se guardan para permitir el reintento
+        if respuesta.status_code >= 500:
+            almacen_idempotencia.liberar(clave)
+        else:
+            almacen_idempotencia.completar(clave, respuesta)
+        return respuesta
+    
+    return envoltura
+
+# =====================================
+# SNAPSHOTS COMPACTOS (STOCK + MOVIMIENTOS)
+# =====================================
+
+SNAPSHOT_MAGIA = b'ALVSNAP'
+SNAPSHOT_VERSION = 1
+
+# Columnas con pocos valores distintos: se guardan como índices a un diccionario
+COLUMNAS_CATEGORICAS_STOCK = ['tipo', 'titulo', 'caracteristica', 'color', 'formato', 'ubicacion', 'proveedor', 'descripcion_cono']
+COLUMNAS_CATEGORICAS_MOVIMIENTOS = ['tipo', 'codigo', 'ubicacion', 'usuario']
+
+FECHA_EPOCH = datetime(1970, 1, 1)
+
+def codificar_columnas(filas, categoricas):
+    """Pasar una lista de dicts a columnas, con codificación por diccionario de las categóricas"""
+    nombres = []
+    for fila in filas:
+        for nombre in fila:
+            if nombre not in nombres:
+                nombres.append(nombre)
+    
+    columnas, diccionarios = {}, {}
+    for nombre in nombres:
+        valores = [fila.get(nombre) for fila in filas]
+        if nombre in categoricas:
+            posiciones = {}
+            columnas[nombre] = [posiciones.setdefault(valor, len(posiciones)) for valor in valores]
+            diccionarios[nombre] = list(posiciones.keys())
+        else:
+            columnas[nombre] = valores
+    return {'filas': len(filas), 'columnas': columnas, 'diccionarios': diccionarios}
+
+def decodificar_columnas(bloque):
+    """Reconstruir la lista de dicts a partir de columnas"""
+    columnas = {}
+    for nombre, valores in bloque['columnas'].items():
+        diccionario = bloque['diccionarios'].get(nombre)
+        columnas[nombre] = [diccionario[i] for i in valores] if diccionario is not None else valores
+    nombres = list(columnas.keys())
+    return [dict(zip(nombres, valores)) for valores in zip(*columnas.values())] if nombres else [{} for _ in range(bloque['filas'])]
+
+def _segundos_fecha(fecha):
+    """Fecha 'AAAA-MM-DD HH:MM:SS' a segundos desde 1970 (sin zona horaria)"""
+    return int((datetime.strptime(fecha, '%Y-%m-%d %H:%M:%S') - FECHA_EPOCH).total_seconds()) if fecha else None
+
+def _fecha_segundos(segundos):
+    return (FECHA_EPOCH + timedelta(seconds=segundos)).strftime('%Y-%m-%d %H:%M:%S') if segundos is not None else ''
+
+def codificar_snapshot(stock, movimientos=None):
+    """Serializar stock (y opcionalmente movimientos) al formato de snapshot compacto
+    
+    Cabecera: 'ALVSNAP' + versión (1 byte). Cuerpo: JSON columnar comprimido con zlib.
+    Las fechas de movimientos se guardan como diferencias en segundos, que comprimen mejor.
+    """
+    codigos = list(stock.keys())
+    contenido = {
+        'version': SNAPSHOT_VERSION,
+        'generado': datetime.now().isoformat(),
+        'stock': dict(codificar_columnas([stock[c] for c in codigos], COLUMNAS_CATEGORICAS_STOCK), codigos=codigos)
+    }
+    if movimientos is not None:
+        filas = [dict(mov) for mov in movimientos]
+        segundos = [_segundos_fecha(fila.pop('fecha', '')) for fila in filas]
+        anterior, deltas = 0, []
+        for valor in segundos:
+            deltas.append(None if valor is None else valor - anterior)
+            anterior = valor if valor is not None else anterior
+        contenido['movimientos'] = dict(codificar_columnas(filas, COLUMNAS_CATEGORICAS_MOVIMIENTOS), fechas=deltas)
+    
+    cuerpo = json.dumps(contenido, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return SNAPSHOT_MAGIA + bytes([SNAPSHOT_VERSION]) + zlib.compress(cuerpo, 6)
+
+def decodificar_snapshot(datos):
+    """Leer un snapshot compacto; devuelve (stock, movimientos o None, metadatos)"""
+    if datos[:len(SNAPSHOT_MAGIA)] != SNAPSHOT_MAGIA:
+        raise ValueError('No es un snapshot de Sistema Alvear')
+    version = datos[len(SNAPSHOT_MAGIA)]
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(f'Versión de snapshot no soportada: {version}')
+    contenido = json.loads(zlib.decompress(datos[len(SNAPSHOT_MAGIA) + 1:]))
+    
+    bloque = contenido['stock']
+    stock = dict(zip(bloque['codigos'], decodificar_columnas(bloque)))
+    
+    movimientos = None
+    if 'movimientos' in contenido:
+        bloque = contenido['movimientos']
+        movimientos = decodificar_columnas(bloque)
+        acumulado = 0
+        for movimiento, delta in zip(movimientos, bloque['fechas']):
+            if delta is None:
+                movimiento['fecha'] = ''
+            else:
+                acumulado += delta
+                movimiento['fecha'] = _fecha_segundos(acumulado)
+    
+    return stock, movimientos, {'version': version, 'generado': contenido.get('generado')}
+
+def guardar_snapshot(ruta, incluir_movimientos=True):
+    """Escribir un snapshot del stock y los movimientos actuales (con sus imágenes del ledger) en `ruta`"""
+    stock = cargar_stock()
+    movimientos = cargar_movimientos(con_datos=True) if incluir_movimientos else None
+    datos = codificar_snapshot(stock, movimientos)
+    temporal = ruta + '.tmp'
+    with open(temporal, 'wb') as f:
+        f.write(datos)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+    return {'productos': len(stock), 'movimientos': len(movimientos or []), 'bytes': len(datos)}
+
+def restaurar_snapshot(ruta, incluir_movimientos=True):
+    """Reemplazar stock (y movimientos) por el contenido de un snapshot
+    
+    En la base, stock, movimientos y el snapshot del ledger se reemplazan en una sola
+    transacción: el snapshot queda en el último movimiento restaurado y los movimientos
+    conservan su imagen del producto, así el ledger puede reproducirlos.
+    """
+    with open(ruta, 'rb') as f:
+        stock, movimientos, metadatos = decodificar_snapshot(f.read())
+    
+    # Una restauración fallida no puede informarse como hecha (ni terminar en el JSON)
+    if not (incluir_movimientos and movimientos is not None):
+        guardar_stock(stock, respaldo_json=False)
+    elif engine:
+        with engine.begin() as conn:
+            bloquear_escrituras(conn)
+            reemplazar_stock(conn, stock)
+            conn.execute(text("DELETE FROM movimientos"))
+            # Igual que movimientos-particionar: sin fecha no entran en la clave (id, fecha)
+            filas = [dict(mov, fecha=datetime.strptime(mov['fecha'], '%Y-%m-%d %H:%M:%S') if mov.get('fecha') else FECHA_EPOCH,
+                          datos=mov.get('datos'), producto_id=mov.get('producto_id'))
+                     for mov in reversed(movimientos)]
+            if filas:
+                conn.execute(SQL_INSERTAR_MOVIMIENTO, filas)
+            insertar_snapshot_stock(conn, stock, ultimo_movimiento_id(conn), 'restauracion')
+        print(f"✅ Snapshot restaurado en PostgreSQL: {len(stock)} productos, {len(filas)} movimientos")
+        notificar_cambios(stock, completo=True)
+    else:
+        guardar_stock(stock, respaldo_json=False)
+        historial_movimientos_json.reemplazar([formatear_movimiento_json(mov) for mov in reversed(movimientos)])
+    if incluir_movimientos and movimientos is not None:
+        cache_series_stock.limpiar()
+    
+    return dict(metadatos, productos=len(stock), movimientos=len(movimientos or []))
+
+# =====================================
+# LEDGER DE MOVIMIENTOS (STOCK COMO PROYECCIÓN)
+# =====================================
+
+# Cada cuántos movimientos confirmados se toma un snapshot proyectado del stock
+SNAPSHOT_STOCK_CADA = int(os.environ.get('SNAPSHOT_STOCK_CADA', 1000))
+
+# Campos que deben coincidir entre la tabla stock y la proyección del ledger
+CAMPOS_VERIFICADOS_LEDGER = ['tipo', 'titulo', 'caracteristica', 'color', 'formato', 'lote', 'ubicacion', 'proveedor', 'cantidad']
+
+def ultimo_movimiento_id(conn):
+    """Id del último movimiento registrado (0 si no hay ninguno)"""
+    return conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM movimientos")).scalar()
+
+def insertar_snapshot_stock(conn, stock, ultimo_id, origen, fecha=None):
+    """Guardar el stock como snapshot del ledger hasta el movimiento `ultimo_id`
+    
+    `fecha` es el instante que representa el snapshot (por defecto, ahora); las
+    consultas históricas eligen el snapshot por esta fecha.
+    """
+    return conn.execute(text("""
+        INSERT INTO stock_snapshots (ultimo_movimiento_id, fecha, origen, productos, datos)
+        VALUES (:ultimo, :fecha, :origen, :productos, :datos)
+        RETURNING id
+    """), {'ultimo': ultimo_id, 'fecha': fecha or datetime.now(), 'origen': origen,
+           'productos': len(stock), 'datos': codificar_snapshot(stock)}).scalar()
+
+def cargar_snapshot_base(conn, hasta_id=None, hasta_fecha=None):
+    """Último snapshot que no pasa del movimiento `hasta_id` (o de la fecha `hasta_fecha`)
+    
+    Devuelve (stock, ultimo_id, snapshot_id); sin snapshot, un stock vacío desde el inicio.
+    """
+    if hasta_fecha is None:
+        condicion, orden, limite = 'ultimo_movimiento_id <= :hasta', 'ultimo_movimiento_id DESC', hasta_id
+    else:
+        condicion, orden, limite = 'fecha <= :hasta', 'fecha DESC', hasta_fecha
+    fila = conn.execute(text(f"""
+        SELECT id, ultimo_movimiento_id, datos FROM stock_snapshots
+        WHERE {condicion}
+        ORDER BY {orden}, id DESC LIMIT 1
+    """), {'hasta': limite}).first()
+    if fila is None:
+        return {}, 0, None
+    stock, _, _ = decodificar_snapshot(bytes(fila.datos))
+    return stock, fila.ultimo_movimiento_id, fila.id
+
+def proyectar_eventos(stock, eventos):
+    """Aplicar sobre `stock`, en orden, las imágenes de producto de los eventos
+    
+    Un evento con datos 'null' elimina el producto; los movimientos sin imagen
+    (anteriores al ledger o sin efecto sobre el stock) se ignoran.
+    """
+    aplicados = 0
+    for evento in eventos:
+        if evento.datos is None:
+            continue
+        imagen = json.loads(evento.datos)
+        if imagen is None:
+            stock.pop(evento.codigo, None)
+        else:
+            stock[evento.codigo] = imagen
+        aplicados += 1
+    return aplicados
+
+def reproducir_ledger(conn, hasta_id=None, hasta_fecha=None):
+    """Stock al movimiento `hasta_id` (o a la fecha `hasta_fecha`): snapshot más cercano + eventos posteriores
+    
+    Solo se leen los eventos posteriores al snapshot, por rango de id o de fecha (indexados).
+    """
+    stock, desde_id, snapshot_id = cargar_snapshot_base(conn, hasta_id, hasta_fecha)
+    condicion, limite = ('id <= :hasta', hasta_id) if hasta_fecha is None else ('fecha <= :hasta', hasta_fecha)
+    eventos = conn.execute(text(f"""
+        SELECT id, codigo, datos FROM movimientos
+        WHERE id > :desde AND {condicion} AND datos IS NOT NULL
+        ORDER BY id
+    """).execution_options(stream_results=True), {'desde': desde_id, 'hasta': limite})
+    aplicados = proyectar_eventos(stock, eventos)
+    return stock, {'snapshot_id': snapshot_id, 'desde_movimiento': desde_id,
+                   'hasta_movimiento': hasta_id, 'eventos_aplicados': aplicados}
+
+def asegurar_snapshot_base():
+    """Tomar el primer snapshot desde la tabla stock si el ledger todavía no tiene ninguno
+    
+    Los movimientos anteriores al ledger no traen imagen del producto: la reproducción
+    arranca desde este snapshot.
+    """
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM stock_snapshots LIMIT 1")).first():
+            return
+        bloquear_escrituras(conn)
+        stock = {row.codigo: fila_a_producto(row) for row in conn.execute(text("SELECT * FROM stock"))}
+        insertar_snapshot_stock(conn, stock, ultimo_movimiento_id(conn), 'tabla')
+        print(f"📸 Snapshot base del ledger creado: {len(stock)} productos")
+
+def tomar_snapshot_stock():
+    """Proyectar el ledger hasta el último movimiento confirmado y guardarlo como snapshot"""
+    # Transacción corta solo para fijar la cota; la proyección no frena a los escritores
+    with engine.begin() as conn:
+        bloquear_escrituras(conn)
+        hasta_id = ultimo_movimiento_id(conn)
+    
+    with engine.begin() as conn:
+        stock, resultado = reproducir_ledger(conn, hasta_id)
+        if resultado['desde_movimiento'] == hasta_id:
+            return dict(resultado, nuevo_snapshot_id=None, productos=len(stock))
+        fecha_corte = conn.execute(text("SELECT fecha FROM movimientos WHERE id = :id"), {'id': hasta_id}).scalar()
+        nuevo_id = insertar_snapshot_stock(conn, stock, hasta_id, 'proyeccion', fecha_db(fecha_corte))
+    
+    print(f"📸 Snapshot del ledger {nuevo_id}: {len(stock)} productos hasta el movimiento {hasta_id}")
+    return dict(resultado, nuevo_snapshot_id=nuevo_id, productos=len(stock))
+
+def verificar_ledger(max_diferencias=100):
+    """Comparar la tabla stock con la proyección del ledger en un mismo instante"""
+    with engine.begin() as conn:
+        bloquear_escrituras(conn)
+        hasta_id = ultimo_movimiento_id(conn)
+        tabla = {row.codigo: fila_a_producto(row) for row in conn.execute(text("SELECT * FROM stock"))}
+        proyectado, resultado = reproducir_ledger(conn, hasta_id)
+    
+    diferencias = []
+    for codigo in sorted(set(tabla) | set(proyectado)):
+        actual, esperado = tabla.get(codigo), proyectado.get(codigo)
+        if actual is None or esperado is None:
+            campos = ['existencia']
+        else:
+            campos = [campo for campo in CAMPOS_VERIFICADOS_LEDGER if actual.get(campo) != esperado.get(campo)]
+        if campos:
+            diferencias.append({
+                'codigo': codigo,
+                'campos': campos,
+                'tabla': {campo: actual.get(campo) for campo in CAMPOS_VERIFICADOS_LEDGER} if actual else None,
+                'ledger': {campo: esperado.get(campo) for campo in CAMPOS_VERIFICADOS_LEDGER} if esperado else None
+            })
+    
+    return dict(resultado,
+                consistente=not diferencias,
+                productos_tabla=len(tabla),
+                productos_ledger=len(proyectado),
+                total_diferencias=len(diferencias),
+                diferencias=diferencias[:max_diferencias])
+
+AGRUPACIONES_STOCK_HISTORICO = ['codigo', 'tipo', 'ubicacion']
+
+def leer_fecha_historica(valor):
+    """Fecha de una consulta histórica; un día sin hora se toma al cierre de ese día"""
+    fecha = datetime.fromisoformat(valor.strip())
+    if len(valor.strip()) == 10:
+        fecha += timedelta(days=1, microseconds=-1)
+    return fecha
+
+@reintentar_en_primaria
+def stock_en_fecha(fecha):
+    """Stock tal como estaba en `fecha`, reconstruido desde el ledger"""
+    with motor_lectura().connect() as conn:
+        stock, resultado = reproducir_ledger(conn, hasta_fecha=fecha)
+        if resultado['snapshot_id'] is None:
+            inicio = conn.execute(text("SELECT MIN(fecha) FROM stock_snapshots")).scalar()
+            raise ValueError(f"No hay historial del ledger anterior a {fecha_db(inicio).strftime('%Y-%m-%d %H:%M:%S') if inicio else 'hoy'}")
+    return stock, resultado
+
+def agrupar_stock(stock, agrupar):
+    """Resumir el stock por tipo o ubicación (cantidad de lotes y de unidades)"""
+    grupos = {}
+    for item in stock.values():
+        clave = item.get(agrupar) or 'Sin dato'
+        grupo = grupos.setdefault(clave, {agrupar: clave, 'productos': 0, 'cantidad': 0})
+        grupo['productos'] += 1
+        grupo['cantidad'] += item.get('cantidad', 0) or 0
+    return [grupos[clave] for clave in sorted(grupos)]
+
+def reconstruir_stock_desde_ledger():
+    """Reescribir la tabla stock con la proyección del ledger (recuperación)"""
+    with engine.begin() as conn:
+        bloquear_escrituras(conn)
+        hasta_id = ultimo_movimiento_id(conn)
+        stock, resultado = reproducir_ledger(conn, hasta_id)
+        reemplazar_stock(conn, stock)
+    return dict(resultado, productos=len(stock))
+
+class SnapshotsPeriodicos:
+    """Dispara un snapshot del ledger en segundo plano cada `cada` movimientos confirmados"""
+    
+    def __init__(self, cada):
+        self.cada = cada
+        self._pendientes = 0
+        self._activo = False
+        self._lock = threading.Lock()
+    
+    def anotar(self, cantidad):
+        """Contar movimientos confirmados y lanzar el snapshot al llegar al umbral"""
+        if self.cada <= 0:
+            return
+        with self._lock:
+            self._pendientes += cantidad
+            if self._activo or self._pendientes < self.cada:
+                return
+            self._activo = True
+            self._pendientes = 0
+        threading.Thread(target=self._tomar, name='snapshot-ledger', daemon=True).start()
+    
+    def _tomar(self):
+        try:
+            tomar_snapshot_stock()
+        except Exception as e:
+            print(f"❌ Error tomando snapshot del ledger: {e}")
+        finally:
+            with self._lock:
+                self._activo = False
+
+snapshots_stock = SnapshotsPeriodicos(SNAPSHOT_STOCK_CADA)
+
+# =====================================
+# SERIES DE STOCK (HISTORIA POR PRODUCTO Y TIPO)
+# =====================================
+
+# Intervalos disponibles y cantidad de períodos que se devuelven por defecto
+INTERVALOS_HISTORIA = {'dia': 90, 'semana': 52}
+MAX_PERIODOS_HISTORIA = 3660
+
+def inicio_periodo(fecha, intervalo):
+    """Comienzo del día (o del lunes de la semana) que contiene a `fecha`"""
+    dia = datetime(fecha.year, fecha.month, fecha.day)
+    return dia - timedelta(days=dia.weekday()) if intervalo == 'semana' else dia
+
+def largo_periodo(intervalo):
+    return timedelta(days=7 if intervalo == 'semana' else 1)
+
+@reintentar_en_primaria
+def leer_deltas_movimientos(codigo=None, prefijo=None, desde=None, hasta=None):
+    """(fecha, cantidad) de los movimientos de un código, o de los códigos con `prefijo`, en [desde, hasta)"""
+    if engine:
+        try:
+            with motor_lectura().connect() as conn:
+                if codigo:
+                    condicion = 'codigo = :clave'
+                else:
+                    # Rango [prefijo, prefijo con el último carácter siguiente): recorre solo ese
+                    # tramo del índice por código, a diferencia de SUBSTR
+                    columna = 'codigo COLLATE "C"' if conn.dialect.name == 'postgresql' else 'codigo'
+                    condicion = f'{columna} >= :clave AND {columna} < :clave_siguiente'
+                filas = conn.execute(text(f"""
+                    SELECT fecha, cantidad FROM movimientos
+                    WHERE {condicion} AND fecha >= :desde AND fecha < :hasta
+                """), {'clave': codigo or prefijo, 'desde': desde, 'hasta': hasta,
+                       'clave_siguiente': prefijo[:-1] + chr(ord(prefijo[-1]) + 1) if prefijo else None})
+                return [(fecha_db(fila.fecha), fila.cantidad or 0) for fila in filas]
+        except Exception as e:
+            if leyendo_de_replica():
+                raise
+            print(f"❌ Error al leer movimientos desde PostgreSQL, usando JSON: {e}")
+    
+    if codigo:
+        coincide = lambda movimiento: movimiento.get('codigo') == codigo
+    else:
+        coincide = lambda movimiento: (movimiento.get('codigo') or '').startswith(prefijo)
+    movimientos = historial_movimientos_json.cargar(
+        coincide=coincide,
+        desde=desde.strftime('%Y-%m-%d %H:%M:%S'),
+        hasta=(hasta - timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S'))
+    return [(datetime.strptime(mov['fecha'], '%Y-%m-%d %H:%M:%S'), mov.get('cantidad') or 0) for mov in movimientos]
+
+def acumular_netos(netos, deltas, intervalo):
+    """Sumar entradas y salidas por período"""
+    for fecha, cantidad in deltas:
+        totales = netos.setdefault(inicio_periodo(fecha, intervalo), [0, 0])
+        if cantidad > 0:
+            totales[0] += cantidad
+        else:
+            totales[1] -= cantidad
+    return netos
+
+@reintentar_en_primaria
+def cantidad_actual(codigo=None, tipo=None):
+    """Cantidad en stock hoy de un código o de todo un tipo de hilado"""
+    if codigo:
+        producto = obtener_producto(codigo)
+        return (producto.get('cantidad') or 0) if producto else 0
+    if engine:
+        try:
+            with motor_lectura().connect() as conn:
+                return conn.execute(text("SELECT COALESCE(SUM(cantidad), 0) FROM stock WHERE tipo = :tipo"),
+                                    {'tipo': tipo}).scalar()
+        except Exception as e:
+            if leyendo_de_replica():
+                raise
+            print(f"❌ Error al sumar stock en PostgreSQL, usando JSON: {e}")
+    return sum(item.get('cantidad', 0) or 0 for item in cargar_stock_json().values() if item.get('tipo') == tipo)
+
+class CacheSeriesStock:
+    """Entradas y salidas por período cerrado de cada serie (código o tipo + intervalo)
+    
+    Un período cerrado ya no cambia: se calcula una vez y en las consultas siguientes
+    solo se leen los movimientos del período abierto y de los cerrados que falten.
+    """
+    
+    def __init__(self, max_series=500):
+        self.max_series = max_series
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def netos(self, serie, desde, abierto, leer, intervalo):
+        """Netos de los períodos cerrados en [desde, abierto)"""
+        with self._lock:
+            entrada = self._series.get(serie)
+            if entrada is not None:
+                self._series.move_to_end(serie)
+        
+        if entrada is None:
+            tramos, netos = [(desde, abierto)], {}
+        else:
+            tramos, netos = [], dict(entrada['netos'])
+            if desde < entrada['desde']:
+                tramos.append((desde, entrada['desde']))
+            if entrada['hasta'] < abierto:
+                tramos.append((entrada['hasta'], abierto))
+        for inicio, fin in tramos:
+            acumular_netos(netos, leer(inicio, fin), intervalo)
+        
+        if tramos:
+            nueva = {'desde': min(desde, entrada['desde']) if entrada else desde,
+                     'hasta': max(abierto, entrada['hasta']) if entrada else abierto,
+                     'netos': netos}
+            with self._lock:
+                # Si otra consulta cambió la serie mientras tanto, se descarta para no dejar huecos
+                if self._series.get(serie) is entrada:
+                    self._series[serie] = nueva
+                    self._series.move_to_end(serie)
+                    while len(self._series) > self.max_series:
+                        self._series.popitem(last=False)
+        return netos
+    
+    def limpiar(self):
+        """Olvidar todo (el historial fue reemplazado)"""
+        with self._lock:
+            self._series.clear()
+
+cache_series_stock = CacheSeriesStock()
+
+def serie_stock(codigo=None, tipo=None, intervalo='dia', desde=None, hasta=None):
+    """Nivel de stock al cierre de cada período, reconstruido hacia atrás desde la cantidad actual"""
+    if intervalo not in INTERVALOS_HISTORIA:
+        raise ValueError(f"intervalo debe ser uno de {list(INTERVALOS_HISTORIA)}")
+    ahora = datetime.now()
+    paso = largo_periodo(intervalo)
+    abierto = inicio_periodo(ahora, intervalo)
+    ultimo = inicio_periodo(min(hasta, ahora) if hasta else ahora, intervalo)
+    primero = inicio_periodo(desde, intervalo) if desde else ultimo - paso * (INTERVALOS_HISTORIA[intervalo] - 1)
+    if primero > ultimo:
+        raise ValueError('desde debe ser anterior a hasta')
+    if (abierto - primero) // paso >= MAX_PERIODOS_HISTORIA:
+        raise ValueError(f'La serie no puede superar {MAX_PERIODOS_HISTORIA} períodos')
+    
+    # Los códigos empiezan con el tipo normalizado como en generar_codigo
+    prefijo = tipo.replace(' ', '_').replace('&', 'y') + '_' if tipo else None
+    leer = lambda inicio, fin: leer_deltas_movimientos(codigo, prefijo, inicio, fin)
+    netos = cache_series_stock.netos(('codigo', codigo, intervalo) if codigo else ('tipo', tipo, intervalo),
+                                     primero, abierto, leer, intervalo)
+    netos.update(acumular_netos({}, leer(abierto, abierto + paso), intervalo))
+    
+    # Hacia atrás: el nivel al cierre de un período es el del siguiente menos su neto
+    nivel = cantidad_actual(codigo, tipo)
+    actual = nivel
+    puntos = []
+    periodo = abierto
+    while periodo >= primero:
+        entradas, salidas = netos.get(periodo, (0, 0))
+        if periodo <= ultimo:
+            puntos.append({'periodo': periodo.strftime('%Y-%m-%d'), 'cantidad': nivel,
+                           'entradas': entradas, 'salidas': salidas})
+        nivel -= entradas - salidas
+        periodo -= paso
+    puntos.reverse()
+    return {'intervalo': intervalo, 'cantidad_actual': actual, 'serie': puntos}
+
+# =====================================
+# PRONÓSTICO DE CONSUMO Y COBERTURA
+# =====================================
+
+PRONOSTICO_INTERVALO_MIN = int(os.environ.get('PRONOSTICO_INTERVALO_MIN', 60))
+# Días que tarda una reposición: el umbral sugerido cubre el consumo de ese plazo
+PRONOSTICO_PLAZO_DIAS = int(os.environ.get('PRONOSTICO_PLAZO_DIAS', 14))
+VENTANAS_CONSUMO = [7, 30, 90]
+# Ventanas para la cobertura, en orden de preferencia: 7 días es demasiado ruidoso para proyectar
+VENTANAS_COBERTURA = (30, 90)
+# Factor del stock de seguridad (~95 % de nivel de servicio con demanda normal)
+Z_NIVEL_SERVICIO = 1.65
+
+class TareaPeriodica:
+    """Recalcula `funcion` en un hilo cada `intervalo` segundos y guarda el último resultado
+    
+    Los requests leen el resultado guardado; solo el primero (sin resultado todavía)
+    calcula en línea. `solicitar()` adelanta el próximo cálculo.
+    """
+    
+    def __init__(self, nombre, intervalo, funcion, espera=0):
+        self.nombre = nombre
+        self.intervalo = intervalo
+        self.funcion = funcion
+        # Al pedir un recálculo se espera este tiempo para juntar varios pedidos seguidos
+        self.espera = espera
+        self.resultado = None
+        self.actualizado = None
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._lock_calculo = threading.Lock()
+        self._despertar = threading.Event()
+    
+    def _iniciar(self):
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._ciclo, name=self.nombre, daemon=True)
+                self._hilo.start()
+    
+    def _ciclo(self):
+        while True:
+            if self._despertar.wait(self.intervalo) and self.espera:
+                time.sleep(self.espera)
+            self._despertar.clear()
+            self.ejecutar()
+    
+    def ejecutar(self):
+        """Calcular ahora y guardar el resultado (si falla, se conserva el anterior)"""
+        with self._lock_calculo:
+            inicio = time.time()
+            try:
+                self.resultado = self.funcion()
+                self.actualizado = datetime.now()
+                print(f"🔁 {self.nombre} recalculado ({time.time() - inicio:.2f}s)")
+            except Exception as e:
+                print(f"❌ Error en {self.nombre}: {e}")
+    
+    def obtener(self, calcular_si_falta=True):
+        """Último resultado calculado y su fecha
+        
+        Con `calcular_si_falta=False` nunca calcula en el request: si todavía no hay
+        resultado, pide el cálculo en segundo plano y devuelve None.
+        """
+        self._iniciar()
+        if self.resultado is None and not calcular_si_falta:
+            self.solicitar()
+        elif self.resultado is None:
+            with self._lock_calculo:
+                necesita = self.resultado is None
+            if necesita:
+                self.ejecutar()
+        return self.resultado, self.actualizado
+    
+    def solicitar(self):
+        """Pedir un recálculo sin esperar al próximo intervalo"""
+        self._iniciar()
+        self._despertar.set()
+
+def atributos_codigo(codigo, stock):
+    """(tipo, titulo, color, formato) de un código: del stock actual o, si ya no existe, del código mismo"""
+    item = stock.get(codigo)
+    if item:
+        return item.get('tipo'), item.get('titulo'), item.get('color'), item.get('formato')
+    partes = codigo.split('_')
+    color = next((parte for parte in partes[2:] if parte in LISTA_DE_COLORES), None)
+    return partes[0], partes[1] if len(partes) > 1 else None, color, None
+
+@reintentar_en_primaria
+def leer_consumos():
+    """(fecha, codigo, cantidad consumida) de los egresos y ajustes negativos de todo el historial"""
+    if engine:
+        try:
+            with motor_lectura().connect() as conn:
+                filas = conn.execute(text("""
+                    SELECT fecha, codigo, cantidad FROM movimientos
+                    WHERE tipo IN ('EGRESO', 'AJUSTE') AND cantidad < 0 AND fecha IS NOT NULL
+                """).execution_options(stream_results=True))
+                return [(fecha_db(fila.fecha), fila.codigo, -fila.cantidad) for fila in filas]
+        except Exception as e:
+            if leyendo_de_replica():
+                raise
+            print(f"❌ Error al leer consumos desde PostgreSQL, usando JSON: {e}")
+    
+    movimientos = historial_movimientos_json.cargar(
+        coincide=lambda mov: mov.get('tipo') in ('EGRESO', 'AJUSTE') and (mov.get('cantidad') or 0) < 0 and mov.get('fecha'))
+    return [(datetime.strptime(mov['fecha'], '%Y-%m-%d %H:%M:%S'), mov['codigo'], -mov['cantidad']) for mov in movimientos]
+
+def estadisticas_consumo(diario):
+    """Consumo promedio por ventana y desvío diario de los últimos 90 días
+    
+    Usa sumas prefijas del consumo diario y de sus cuadrados: cada ventana sale en O(1).
+    """
+    suma = list(itertools.accumulate(diario, initial=0))
+    cuadrados = list(itertools.accumulate((valor * valor for valor in diario), initial=0))
+    dias = len(diario)
+    
+    tasas = {}
+    for ventana in VENTANAS_CONSUMO:
+        largo = min(ventana, dias)
+        tasas[ventana] = (suma[dias] - suma[dias - largo]) / largo
+    
+    largo = min(90, dias)
+    media = (suma[dias] - suma[dias - largo]) / largo
+    varianza = max((cuadrados[dias] - cuadrados[dias - largo]) / largo - media * media, 0.0)
+    return tasas, media, math.sqrt(varianza)
+
+def calcular_pronostico():
+    """Tasas de consumo, días de cobertura y umbrales sugeridos a partir de todo el historial"""
+    stock = cargar_stock()
+    consumos = leer_consumos()
+    hoy = datetime.now().date()
+    inicio = min((fecha.date() for fecha, _, _ in consumos), default=hoy)
+    dias = (hoy - inicio).days + 1
+    
+    # Consumo diario por tipo/título/color y por tipo/formato (para los umbrales)
+    por_producto = defaultdict(lambda: [0.0] * dias)
+    por_formato = defaultdict(lambda: [0.0] * dias)
+    for fecha, codigo, cantidad in consumos:
+        tipo, titulo, color, formato = atributos_codigo(codigo, stock)
+        indice = (fecha.date() - inicio).days
+        por_producto[(tipo, titulo, color)][indice] += cantidad
+        por_formato[(tipo, formato or 'cajas')][indice] += cantidad
+    
+    existencias = defaultdict(float)
+    for item in stock.values():
+        existencias[(item.get('tipo'), item.get('titulo'), item.get('color'))] += item.get('cantidad', 0) or 0
+    
+    productos = []
+    for clave in set(existencias) | set(por_producto):
+        tasas, _, _ = estadisticas_consumo(por_producto[clave]) if clave in por_producto else ({v: 0.0 for v in VENTANAS_CONSUMO}, 0, 0)
+        # Consumo de 30 días; si no hubo, el de 90 días
+        tasa = next((tasas[v] for v in VENTANAS_COBERTURA if tasas[v] > 0), 0.0)
+        cobertura = existencias[clave] / tasa if tasa > 0 else None
+        productos.append({
+            'tipo': clave[0], 'titulo': clave[1], 'color': clave[2],
+            'stock': existencias[clave],
+            **{f'consumo_{ventana}d': round(tasas[ventana], 3) for ventana in VENTANAS_CONSUMO},
+            'consumo_diario': round(tasa, 3),
+            'dias_cobertura': round(cobertura, 1) if cobertura is not None else None,
+            'fecha_agotamiento': (hoy + timedelta(days=int(cobertura))).isoformat() if cobertura is not None else None
+        })
+    productos.sort(key=lambda p: (p['dias_cobertura'] is None, p['dias_cobertura'] or 0))
+    
+    umbrales = cargar_umbrales()
+    sugeridos = {}
+    for (tipo, formato), diario in sorted(por_formato.items(), key=lambda par: str(par[0])):
+        _, media, desvio = estadisticas_consumo(diario)
+        sugeridos.setdefault(tipo, {})[formato] = {
+            'actual': umbrales.get(tipo, {}).get(formato),
+            'sugerido': math.ceil(media * PRONOSTICO_PLAZO_DIAS + Z_NIVEL_SERVICIO * desvio * math.sqrt(PRONOSTICO_PLAZO_DIAS)),
+            'consumo_diario': round(media, 3)
+        }
+    
+    return {
+        'generado': datetime.now().isoformat(),
+        'dias_historia': dias,
+        'plazo_reposicion_dias': PRONOSTICO_PLAZO_DIAS,
+        'productos': productos,
+        'umbrales_sugeridos': sugeridos
+    }
+
+tarea_pronostico = TareaPeriodica('pronostico-consumo', PRONOSTICO_INTERVALO_MIN * 60, calcular_pronostico)
+
+# =====================================
+# SUGERENCIA DE COMPRAS POR PROVEEDOR
+# =====================================
+
+# Se sugiere reponer hasta este múltiplo del umbral bajo
+NIVEL_REPOSICION_UMBRAL = 2
+SUGERENCIA_COMPRAS_INTERVALO_MIN = 15
+
+def proveedores_por_tipo():
+    """Tipos de hilado -> proveedores que los ofrecen, según LISTA_DE_PROVEEDORES"""
+    resultado = defaultdict(list)
+    for clave, proveedor in LISTA_DE_PROVEEDORES.items():
+        for tipo in proveedor.get('productos', []):
+            resultado[tipo].append(clave)
+    return resultado
+
+def calcular_sugerencia_compras():
+    """Cantidades a pedir a cada proveedor para dejar cada tipo/título por encima del umbral
+    
+    Se agrupa el stock por tipo, título y formato; los tipo/título sin stock pero con
+    consumo reciente (según el último pronóstico) también se incluyen. Cada faltante
+    se asigna al último proveedor usado para ese tipo/título si lo ofrece, si no al
+    primero que ofrece el tipo.
+    """
+    stock = cargar_stock()
+    ofrecen = proveedores_por_tipo()
+    
+    existencias = defaultdict(float)
+    ultimo_proveedor = {}
+    for item in sorted(stock.values(), key=lambda item: item.get('fecha_ingreso') or ''):
+        clave = (item.get('tipo'), item.get('titulo'), item.get('formato') or 'cajas')
+        existencias[clave] += item.get('cantidad', 0) or 0
+        if item.get('proveedor'):
+            ultimo_proveedor[clave[:2]] = item['proveedor']
+    
+    pronostico = tarea_pronostico.resultado
+    consumo = defaultdict(float)
+    for producto in (pronostico or {}).get('productos', []):
+        consumo[(producto['tipo'], producto['titulo'])] += producto['consumo_diario']
+    for tipo, titulo in consumo:
+        if consumo[(tipo, titulo)] > 0 and not any(clave[:2] == (tipo, titulo) for clave in existencias):
+            existencias[(tipo, titulo, 'cajas')] = 0
+    
+    por_proveedor = defaultdict(list)
+    for (tipo, titulo, formato), cantidad in sorted(existencias.items(), key=lambda par: tuple(map(str, par[0]))):
+        _, umbral_bajo, _ = umbrales_compilados().resolver(tipo, formato, titulo)
+        if cantidad > umbral_bajo:
+            continue
+        candidatos = ofrecen.get(tipo, [])
+        preferido = ultimo_proveedor.get((tipo, titulo))
+        proveedor = preferido if preferido in candidatos else (candidatos[0] if candidatos else 'Sin proveedor asignado')
+        objetivo = umbral_bajo * NIVEL_REPOSICION_UMBRAL
+        por_proveedor[proveedor].append({
+            'tipo': tipo,
+            'titulo': titulo,
+            'formato': formato,
+            'stock': cantidad,
+            'umbral_bajo': umbral_bajo,
+            'objetivo': objetivo,
+            'cantidad_sugerida': math.ceil(objetivo - cantidad),
+            'consumo_diario': round(consumo.get((tipo, titulo), 0.0), 3),
+            'alternativas': [otro for otro in candidatos if otro != proveedor]
+        })
+    
+    return {
+        'generado': datetime.now().isoformat(),
+        'nivel_reposicion_umbral': NIVEL_REPOSICION_UMBRAL,
+        'total_items': sum(len(items) for items in por_proveedor.values()),
+        'proveedores': [{
+            'proveedor': proveedor,
+            'nombre': LISTA_DE_PROVEEDORES.get(proveedor, {}).get('nombre', proveedor),
+            'items': items,
+            'cantidad_total': sum(item['cantidad_sugerida'] for item in items)
+        } for proveedor, items in sorted(por_proveedor.items())]
+    }
+
+tarea_sugerencia_compras = TareaPeriodica('sugerencia-compras', SUGERENCIA_COMPRAS_INTERVALO_MIN * 60,
+                                          calcular_sugerencia_compras, espera=2)
+
+@registrar_observador
+def marcar_sugerencia_compras(stock_data, modificados, eliminados, movimientos, completo=False):
+    """Cualquier cambio de stock deja el reporte de compras desactualizado"""
+    tarea_sugerencia_compras.solicitar()
+
+# =====================================
+# ALERTAS DE STOCK (INCREMENTALES)
+# =====================================
+
+ALERTAS_WEBHOOK_URL = os.environ.get('ALERTAS_WEBHOOK_URL', '')
+COLORES_ESTADO_STOCK = {'Crítico': 'danger', 'Bajo': 'warning', 'Normal': 'success'}
+GRAVEDAD_ESTADO = {'Normal': 0, 'Bajo': 1, 'Crítico': 2}
+
+def grupo_alerta(item):
+    """Grupo de umbral al que pertenece un producto: la clave de la regla que lo rige"""
+    return regla_umbral(item)[0]
+
+def describir_grupo(grupo):
+    """Tipo, formato y atributos fijados por la regla de un grupo de alerta"""
+    descripcion = {'tipo': grupo[0], 'formato': grupo[1]}
+    descripcion.update((atributo, valor) for atributo, valor in zip(ATRIBUTOS_OVERRIDE, grupo[2:]) if valor is not None)
+    return descripcion
+
+class AlertasStock:
+    """Estado de stock por grupo de umbral mantenido de forma incremental
+    
+    Se carga una vez el total de cada grupo; después cada cambio confirmado solo
+    ajusta los grupos de los códigos tocados y los reclasifica. Al entrar en Bajo o
+    Crítico se registra una alerta, se envía a los suscriptores SSE y al webhook.
+    """
+    
+    def __init__(self):
+        self._productos = {}
+        self._totales = defaultdict(float)
+        self._estados = {}
+        self._inicializado = False
+        self._suscriptores = []
+        self._lock = threading.Lock()
+        self._lock_archivo = threading.Lock()
+    
+    def inicializar(self, stock=None):
+        """Calcular totales y estados desde el stock completo (sin emitir alertas)"""
+        stock = stock_para_indice(stock)
+        with self._lock:
+            self._productos = {codigo: (grupo_alerta(item), item.get('cantidad', 0) or 0) for codigo, item in stock.items()}
+            self._totales = defaultdict(float)
+            for grupo, cantidad in self._productos.values():
+                self._totales[grupo] += cantidad
+            self._estados = {grupo: self._clasificar(grupo) for grupo in self._totales}
+            self._inicializado = True
+    
+    def _clasificar(self, grupo):
+        return clasificar_cantidad(self._totales[grupo], *umbrales_compilados().umbral_clave(grupo))
+    
+    def reclasificar(self):
+        """Tras cambiar los umbrales: recalcular estados sin emitir alertas"""
+        with self._lock:
+            self._estados = {grupo: self._clasificar(grupo) for grupo in self._totales}
+    
+    def aplicar(self, stock_data, modificados, eliminados, movimientos, completo=False):
+        """Observador de cambios: actualizar solo los grupos afectados y emitir los cruces"""
+        if completo or not self._inicializado:
+            # Reemplazo completo (o primer uso): se recalcula todo y se comparan todos los grupos
+            anteriores = dict(self._estados) if self._inicializado else {}
+            self.inicializar(stock_data if completo else None)
+            afectados = set(anteriores) & set(self._estados)
+        else:
+            afectados, anteriores = set(), {}
+            modificados = set(modificados)
+            with self._lock:
+                for codigo in list(modificados) + list(eliminados):
+                    previo = self._productos.pop(codigo, None)
+                    if previo:
+                        self._totales[previo[0]] -= previo[1]
+                        afectados.add(previo[0])
+                    if codigo in modificados and stock_data and codigo in stock_data:
+                        item = stock_data[codigo]
+                        actual = (grupo_alerta(item), item.get('cantidad', 0) or 0)
+                        self._productos[codigo] = actual
+                        self._totales[actual[0]] += actual[1]
+                        afectados.add(actual[0])
+                for grupo in afectados:
+                    anteriores[grupo] = self._estados.get(grupo)
+                    self._estados[grupo] = self._clasificar(grupo)
+        
+        codigo_origen = next(iter(modificados or eliminados), None)
+        for grupo in afectados:
+            anterior, estado = anteriores.get(grupo), self._estados.get(grupo)
+            if estado in ('Bajo', 'Crítico') and GRAVEDAD_ESTADO[estado] > GRAVEDAD_ESTADO.get(anterior, 0):
+                self.emitir(grupo, anterior, estado, codigo_origen)
+    
+    def emitir(self, grupo, anterior, estado, codigo):
+        """Registrar la alerta y enviarla a los suscriptores y al webhook"""
+        umbral_bajo, umbral_critico = umbrales_compilados().umbral_clave(grupo)
+        alerta = {
+            'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            **describir_grupo(grupo),
+            'estado': estado,
+            'estado_anterior': anterior or 'Normal',
+            'cantidad': self._totales[grupo],
+            'umbral_bajo': umbral_bajo,
+            'umbral_critico': umbral_critico,
+            'codigo': codigo
+        }
+        detalle = ' '.join(str(valor) for valor in grupo[2:] if valor is not None)
+        print(f"🚨 Stock {estado}: {grupo[0]} ({grupo[1]}) {detalle} = {alerta['cantidad']}")
+        self._guardar(alerta)
+        for suscripcion in list(self._suscriptores):
+            try:
+                suscripcion.put_nowait(alerta)
+            except queue.Full:
+                pass
+        if ALERTAS_WEBHOOK_URL:
+            threading.Thread(target=enviar_webhook_alerta, args=(alerta,), daemon=True).start()
+    
+    def _guardar(self, alerta):
+        grupo = json.dumps({campo: alerta[campo] for campo in ['tipo', 'formato'] + ATRIBUTOS_OVERRIDE if campo in alerta},
+                           ensure_ascii=False)
+        if engine:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text("""
+                        INSERT INTO alertas_stock (fecha, grupo, estado, estado_anterior, cantidad, umbral_bajo, umbral_critico, codigo)
+                        VALUES (:fecha, :grupo, :estado, :estado_anterior, :cantidad, :umbral_bajo, :umbral_critico, :codigo)
+                    """), dict(alerta, fecha=datetime.strptime(alerta['fecha'], '%Y-%m-%d %H:%M:%S'), grupo=grupo))
+                return
+            except Exception as e:
+                print(f"❌ Error guardando alerta en PostgreSQL, usando JSON: {e}")
+        with self._lock_archivo:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            with open(ALERTAS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(alerta, ensure_ascii=False) + '\n')
+    
+    @reintentar_en_primaria
+    def recientes(self, limite=50):
+        """Últimas alertas, de la más reciente a la más antigua"""
+        if engine:
+            try:
+                with motor_lectura().connect() as conn:
+                    filas = conn.execute(text("SELECT * FROM alertas_stock ORDER BY id DESC LIMIT :limite"), {'limite': limite})
+                    return [dict(json.loads(fila.grupo),
+                                 fecha=fecha_db(fila.fecha).strftime('%Y-%m-%d %H:%M:%S'),
+                                 estado=fila.estado, estado_anterior=fila.estado_anterior, cantidad=fila.cantidad,
+                                 umbral_bajo=fila.umbral_bajo, umbral_critico=fila.umbral_critico, codigo=fila.codigo)
+                            for fila in filas]
+            except Exception as e:
+                if leyendo_de_replica():
+                    raise
+                print(f"❌ Error leyendo alertas de PostgreSQL, usando JSON: {e}")
+        try:
+            with open(ALERTAS_FILE, 'r', encoding='utf-8') as f:
+                lineas = f.readlines()[-limite:]
+        except FileNotFoundError:
+            return []
+        return [json.loads(linea) for linea in reversed(lineas) if linea.strip()]
+    
+    def suscribir(self):
+        suscripcion = queue.Queue(maxsize=100)
+        self._suscriptores.append(suscripcion)
+        return suscripcion
+    
+    def desuscribir(self, suscripcion):
+        if suscripcion in self._suscriptores:
+            self._suscriptores.remove(suscripcion)
+
+def enviar_webhook_alerta(alerta):
+    """POST de la alerta en JSON a ALERTAS_WEBHOOK_URL (sin reintentos)"""
+    try:
+        pedido = urllib.request.Request(ALERTAS_WEBHOOK_URL, data=json.dumps(alerta, ensure_ascii=False).encode('utf-8'),
+                                        headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(pedido, timeout=5) as respuesta:
+            respuesta.read()
+    except Exception as e:
+        print(f"⚠️ Error enviando alerta al webhook: {e}")
+
+alertas_stock = AlertasStock()
+registrar_observador(alertas_stock.aplicar)
+
+# =====================================
+# MODELO COLUMNAR DEL STOCK
+# =====================================
+
+# Campo de kilos por unidad de cada formato; sin dato se usa PARAMETROS_CARGA_DEFAULT
+CAMPO_KILOS_FORMATO = {'cajas': 'kilos_por_caja', 'Palletizado': 'kilos_por_pallet'}
+
+# Versión del stock en este proceso: avanza con cada cambio confirmado
+_version_stock = 0
+
+@registrar_observador
+def avanzar_version_stock(stock_data, modificados, eliminados, movimientos, completo=False):
+    global _version_stock
+    _version_stock += 1
+
+@reintentar_en_primaria
+def version_stock():
+    """Versión actual del stock
+    
+    En PostgreSQL se agrega el último movimiento para ver también las escrituras
+    hechas por otros procesos.
+    """
+    if engine:
+        try:
+            with motor_lectura().connect() as conn:
+                return (_version_stock, ultimo_movimiento_id(conn))
+        except Exception as e:
+            if leyendo_de_replica():
+                raise
+            print(f"⚠️ Error leyendo versión del stock: {e}")
+            return None
+    return (_version_stock,)
+
+class CachePorVersion:
+    """Resultado de un cálculo sobre todo el stock, reutilizado mientras no cambie la versión"""
+    
+    def __init__(self, calcular, cargar=None):
+        self._calcular = calcular
+        self._cargar = cargar or cargar_stock
+        self._version = None
+        self._valor = None
+        self._lock = threading.Lock()
+    
+    def obtener(self, stock=None):
+        # La versión se lee antes que el stock: si cambia en el medio, la próxima consulta recalcula
+        version = version_stock()
+        with self._lock:
+            if version is not None and self._version == version:
+                return self._valor
+        valor = self._calcular(self._cargar() if stock is None else stock)
+        with self._lock:
+            self._version, self._valor = version, valor
+        return valor
+    
+    def invalidar(self):
+        with self._lock:
+            self._version = None
+
+class ColumnasStock:
+    """Stock como struct-of-arrays
+    
+    Las categóricas (tipo, color, ubicación...) se guardan una vez por valor distinto,
+    internadas, y cada fila solo lleva su posición en un array de enteros. Cantidad,
+    kilos por unidad y precio unitario van en arrays de doubles. Solo se guardan las
+    columnas que usan los agregados (estadísticas, gráficos, valorización).
+    """
+    __slots__ = ('codigos', 'categorias', 'posiciones', 'codigos_categoria',
+                 'cantidad', 'precio_unitario', 'kilos_unidad')
+    
+    def __init__(self, codigos):
+        self.codigos = codigos
+        self.categorias = {campo: [] for campo in COLUMNAS_CATEGORICAS_STOCK}
+        self.posiciones = {campo: {} for campo in COLUMNAS_CATEGORICAS_STOCK}
+        self.codigos_categoria = {campo: array.array('I') for campo in COLUMNAS_CATEGORICAS_STOCK}
+        self.cantidad = array.array('d')
+        self.precio_unitario = array.array('d')
+        self.kilos_unidad = array.array('d')
+    
+    @classmethod
+    def desde_stock(cls, stock):
+        modelo = cls(list(stock))
+        kilos_default = {
+            'cajas': PARAMETROS_CARGA_DEFAULT['cajas']['kilos_por_caja'],
+            'Palletizado': PARAMETROS_CARGA_DEFAULT['Palletizado']['kilos_por_pallet']
+        }
+        for codigo in modelo.codigos:
+            item = stock[codigo]
+            for campo in COLUMNAS_CATEGORICAS_STOCK:
+                valor = item.get(campo)
+                posiciones = modelo.posiciones[campo]
+                posicion = posiciones.get(valor)
+                if posicion is None:
+                    posicion = posiciones[valor] = len(posiciones)
+                    modelo.categorias[campo].append(sys.intern(valor) if isinstance(valor, str) else valor)
+                modelo.codigos_categoria[campo].append(posicion)
+            formato = item.get('formato') or 'cajas'
+            modelo.cantidad.append(item.get('cantidad', 0) or 0)
+            modelo.precio_unitario.append(item.get('precio_unitario', 0) or 0)
+            modelo.kilos_unidad.append(item.get(CAMPO_KILOS_FORMATO.get(formato), 0) or kilos_default.get(formato, 0))
+        return modelo
+    
+    def __len__(self):
+        return len(self.codigos)
+    
+    def sumar_por(self, campo, columna=None, etiqueta_vacia=None):
+        """Suma de una columna numérica (por defecto cantidad) agrupada por una categórica
+        
+        Con `etiqueta_vacia`, None y '' se suman juntos bajo esa etiqueta.
+        """
+        valores = columna if columna is not None else self.cantidad
+        sumas = [0] * len(self.categorias[campo])
+        for posicion, valor in zip(self.codigos_categoria[campo], valores):
+            sumas[posicion] += valor
+        if etiqueta_vacia is None:
+            return dict(zip(self.categorias[campo], sumas))
+        agrupadas = {}
+        for categoria, suma in zip(self.categorias[campo], sumas):
+            clave = categoria or etiqueta_vacia
+            agrupadas[clave] = agrupadas.get(clave, 0) + suma
+        return agrupadas
+    
+    def combinaciones(self, campos):
+        """Por fila, la tupla de posiciones de varias categóricas (para resolver una vez por combinación)"""
+        return zip(*(self.codigos_categoria[campo] for campo in campos))
+
+def numero_json(valor):
+    """Las sumas sobre arrays de doubles vuelven a entero si no tienen decimales"""
+    return int(valor) if float(valor).is_integer() else valor
+
+modelo_stock = CachePorVersion(ColumnasStock.desde_stock)
+
+def umbrales_por_fila(modelo):
+    """Arrays (umbral bajo, umbral crítico) por fila, resolviendo una vez por combinación de atributos"""
+    campos = ['tipo', 'formato'] + ATRIBUTOS_OVERRIDE
+    resolutor = umbrales_compilados()
+    bajos, criticos = array.array('d'), array.array('d')
+    resueltos = {}
+    for combinacion in modelo.combinaciones(campos):
+        umbral = resueltos.get(combinacion)
+        if umbral is None:
+            tipo, formato, *atributos = (modelo.categorias[campo][posicion] for campo, posicion in zip(campos, combinacion))
+            umbral = resueltos[combinacion] = resolutor.resolver(tipo or 'Algodón', formato or 'cajas', *atributos)[1:]
+        bajos.append(umbral[0])
+        criticos.append(umbral[1])
+    return bajos, criticos
+
+# =====================================
+# VALORIZACIÓN DEL STOCK (KILOS Y VALOR)
+# =====================================
+
+def cargar_precios():
+    """Lista de precios por kg: {tipo: {'*': precio del tipo, titulo: precio}}"""
+    try:
+        with open(PRECIOS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def guardar_precios(precios):
+    """Validar y guardar la lista de precios"""
+    if not isinstance(precios, dict):
+        raise ValueError('Se esperaba un objeto {tipo: {titulo: precio}}')
+    normalizados = {}
+    for tipo, titulos in precios.items():
+        if not isinstance(titulos, dict):
+            titulos = {'*': titulos}
+        try:
+            normalizados[tipo] = {str(titulo): float(precio) for titulo, precio in titulos.items()}
+        except (TypeError, ValueError):
+            raise ValueError(f'Precio inválido para {tipo}')
+        if any(precio < 0 for precio in normalizados[tipo].values()):
+            raise ValueError(f'Precio negativo para {tipo}')
+    with open(PRECIOS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(normalizados, f, ensure_ascii=False, indent=2)
+    valorizacion_stock.invalidar()
+    return normalizados
+
+def precio_kg(precios, tipo, titulo):
+    """Precio por kg del título, del tipo o el estimado por defecto"""
+    del_tipo = precios.get(tipo, {})
+    return del_tipo.get(str(titulo), del_tipo.get('*', PRECIO_KG_DEFAULT))
+
+def calcular_valorizacion(modelo):
+    """Kilos y valor de todo el inventario sobre las columnas del modelo
+    
+    Un producto con `precio_unitario` se valoriza por unidad; el resto, por kilos
+    según la lista de precios.
+    """
+    # Un precio por (tipo, titulo) distinto, no por producto
+    precios = cargar_precios()
+    tipos, titulos = modelo.categorias['tipo'], modelo.categorias['titulo']
+    claves = list(modelo.combinaciones(['tipo', 'titulo']))
+    tabla_precios = {clave: precio_kg(precios, tipos[clave[0]], titulos[clave[1]]) for clave in set(claves)}
+    precios_kg = array.array('d', (tabla_precios[clave] for clave in claves))
+    
+    kilos = array.array('d', map(operator.mul, modelo.cantidad, modelo.kilos_unidad))
+    valores = array.array('d', (cantidad * unitario if unitario else kilo * precio
+                                for cantidad, unitario, kilo, precio
+                                in zip(modelo.cantidad, modelo.precio_unitario, kilos, precios_kg)))
+    
+    cantidad_tipo = modelo.sumar_por('tipo')
+    kilos_tipo = modelo.sumar_por('tipo', kilos)
+    valor_tipo = modelo.sumar_por('tipo', valores)
+    por_tipo = {}
+    for tipo in cantidad_tipo:
+        totales = por_tipo.setdefault(tipo or 'Sin tipo', {'cantidad': 0, 'kilos': 0.0, 'valor': 0.0})
+        totales['cantidad'] += cantidad_tipo[tipo]
+        totales['kilos'] += kilos_tipo[tipo]
+        totales['valor'] += valor_tipo[tipo]
+    
+    return {
+        'total_kilos': math.fsum(kilos),
+        'valor_total': math.fsum(valores),
+        'por_tipo': {tipo: {campo: round(valor, 2) for campo, valor in totales.items()}
+                     for tipo, totales in sorted(por_tipo.items())},
+        'productos': dict(zip(modelo.codigos, zip(kilos, valores)))
+    }
 
-def cargar_movimientos_json():
-    """Cargar historial de movimientos desde JSON"""
-    try:
-        with open(MOVIMIENTOS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+# Sin stock cargado por el llamador, el modelo columnar en caché evita volver a leerlo
+valorizacion_stock = CachePorVersion(lambda stock: calcular_valorizacion(modelo_stock.obtener(stock)),
+                                     cargar=lambda: None)
 
-def guardar_movimiento(tipo, codigo, descripcion, cantidad, ubicacion, usuario="Sistema"):
-    """Registrar un nuevo movimiento en el historial - PostgreSQL y JSON"""
-    try:
-        fecha_actual = datetime.now()
-        
-        # Guardar en PostgreSQL si está disponible
-        if engine:
-            with engine.connect() as conn:
-                conn.execute(text("""
-                    INSERT INTO movimientos (fecha, tipo, codigo, descripcion, cantidad, ubicacion, usuario)
-                    VALUES (:fecha, :tipo, :codigo, :descripcion, :cantidad, :ubicacion, :usuario)
-                """), {
-                    'fecha': fecha_actual,
-                    'tipo': tipo,
-                    'codigo': codigo,
-                    'descripcion': descripcion,
-                    'cantidad': cantidad,
-                    'ubicacion': ubicacion,
-                    'usuario': usuario
-                })
-                conn.commit()
-                print(f"✅ Movimiento guardado en PostgreSQL: {tipo} - {codigo}")
-        
-        # También guardar en JSON como backup (para desarrollo local)
-        guardar_movimiento_json(tipo, codigo, descripcion, cantidad, ubicacion, usuario)
-        
-    except Exception as e:
-        print(f"❌ Error guardando movimiento: {e}")
-        # Fallback a JSON si falla PostgreSQL
-        guardar_movimiento_json(tipo, codigo, descripcion, cantidad, ubicacion, usuario)
+# =====================================
+# ANTIGÜEDAD DE LOTES (FIFO)
+# =====================================
 
-def guardar_movimiento_json(tipo, codigo, descripcion, cantidad, ubicacion, usuario="Sistema"):
-    """Registrar un nuevo movimiento en el historial JSON"""
+# Tramos de antigüedad: (etiqueta, días máximos inclusive; None = sin límite)
+TRAMOS_ANTIGUEDAD = [('0-30', 30), ('31-90', 90), ('90+', None)]
+SEGUNDOS_DIA = 86400
+
+# Atributos que identifican un artículo; sus lotes compiten en el orden FIFO
+CAMPOS_ARTICULO = ['tipo', 'titulo', 'caracteristica', 'color', 'formato']
+
+def epoch_ingreso(valor):
+    """fecha_ingreso ISO como segundos epoch (None si falta o no se puede leer)"""
+    if not valor:
+        return None
     try:
-        movimientos = cargar_movimientos_json()
-        
-        nuevo_movimiento = {
-            'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'tipo': tipo,
+        return datetime.fromisoformat(str(valor).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+class IndiceIngresos:
+    """Fechas de ingreso ya convertidas a epoch, ordenadas de la más antigua a la más nueva
+    
+    Se arma una vez desde el stock y después cada cambio confirmado solo mueve los
+    códigos tocados (bisect), así los reportes no vuelven a leer fechas por fila.
+    """
+    
+    def __init__(self):
+        self._epochs = {}
+        self._orden = []
+        self._inicializado = False
+        self._lock = threading.Lock()
+    
+    def inicializar(self, stock=None):
+        stock = stock_para_indice(stock)
+        epochs = {codigo: epoch_ingreso(item.get('fecha_ingreso')) for codigo, item in stock.items()}
+        with self._lock:
+            self._epochs = epochs
+            self._orden = sorted((epoch, codigo) for codigo, epoch in epochs.items() if epoch is not None)
+            self._inicializado = True
+    
+    def asegurar(self, stock=None):
+        if not self._inicializado:
+            self.inicializar(stock)
+    
+    def aplicar(self, stock_data, modificados, eliminados, movimientos, completo=False):
+        """Observador de cambios: reubicar solo los códigos afectados"""
+        if completo:
+            self.inicializar(stock_data)
+            return
+        if not self._inicializado:
+            return
+        modificados = set(modificados)
+        with self._lock:
+            for codigo in modificados | set(eliminados):
+                epoch = self._epochs.pop(codigo, None)
+                if epoch is not None:
+                    posicion = bisect.bisect_left(self._orden, (epoch, codigo))
+                    if posicion < len(self._orden) and self._orden[posicion] == (epoch, codigo):
+                        del self._orden[posicion]
+                if codigo in modificados and stock_data and codigo in stock_data:
+                    epoch = epoch_ingreso(stock_data[codigo].get('fecha_ingreso'))
+                    self._epochs[codigo] = epoch
+                    if epoch is not None:
+                        bisect.insort(self._orden, (epoch, codigo))
+    
+    def dias(self, codigo, item, ahora):
+        """Días en stock de un producto (0 sin fecha de ingreso)"""
+        epoch = self._epochs[codigo] if codigo in self._epochs else epoch_ingreso(item.get('fecha_ingreso'))
+        return int((ahora - epoch) // SEGUNDOS_DIA) if epoch is not None else 0
+    
+    def por_tramo(self, ahora):
+        """Códigos de cada tramo de antigüedad, cada uno del más viejo al más nuevo"""
+        with self._lock:
+            orden = list(self._orden)
+            sin_fecha = [codigo for codigo, epoch in self._epochs.items() if epoch is None]
+        tramos, fin = [], len(orden)
+        # Del tramo más nuevo al más viejo: cada corte es una búsqueda binaria
+        for etiqueta, maximo in TRAMOS_ANTIGUEDAD:
+            inicio = bisect.bisect_right(orden, (ahora - (maximo + 1) * SEGUNDOS_DIA, '\U0010ffff')) if maximo is not None else 0
+            tramos.append((etiqueta, orden[inicio:fin]))
+            fin = inicio
+        return tramos, sin_fecha
+    
+    def ordenados(self):
+        """Pares (epoch, codigo) del ingreso más antiguo al más nuevo"""
+        with self._lock:
+            return list(self._orden)
+
+indice_ingresos = IndiceIngresos()
+registrar_observador(indice_ingresos.aplicar)
+
+def reporte_antiguedad_lotes(stock, tipo=None, ubicacion=None):
+    """Lotes y cantidades por tipo, ubicación y tramo de antigüedad, más el orden FIFO por artículo"""
+    indice_ingresos.asegurar(stock)
+    ahora = time.time()
+    incluido = lambda item: (not tipo or item.get('tipo') == tipo) and (not ubicacion or item.get('ubicacion') == ubicacion)
+    etiquetas = [etiqueta for etiqueta, _ in TRAMOS_ANTIGUEDAD] + ['sin fecha']
+    
+    grupos = {}
+    tramos, sin_fecha = indice_ingresos.por_tramo(ahora)
+    for etiqueta, pares in tramos + [('sin fecha', [(None, codigo) for codigo in sin_fecha])]:
+        for _, codigo in pares:
+            item = stock.get(codigo)
+            if item is None or not incluido(item):
+                continue
+            clave = (item.get('tipo') or '', item.get('ubicacion') or '')
+            grupo = grupos.setdefault(clave, {nombre: {'lotes': 0, 'cantidad': 0} for nombre in etiquetas})
+            grupo[etiqueta]['lotes'] += 1
+            grupo[etiqueta]['cantidad'] += item.get('cantidad', 0) or 0
+    
+    # FIFO: recorrer el índice ya ordenado agrupando por artículo; sin fecha van al final
+    articulos = {}
+    for _, codigo in indice_ingresos.ordenados() + [(None, codigo) for codigo in sin_fecha]:
+        item = stock.get(codigo)
+        if item is None or not incluido(item) or (item.get('cantidad', 0) or 0) <= 0:
+            continue
+        clave = tuple(item.get(campo) or '' for campo in CAMPOS_ARTICULO)
+        articulos.setdefault(clave, []).append({
             'codigo': codigo,
-            'descripcion': descripcion,
-            'cantidad': cantidad,
-            'ubicacion': ubicacion,
-            'usuario': usuario
-        }
-        
-        # Agregar al inicio de la lista (más recientes primero)
-        movimientos.insert(0, nuevo_movimiento)
-        
-        # Mantener solo los últimos 100 movimientos para no llenar el archivo
-        if len(movimientos) > 100:
-            movimientos = movimientos[:100]
-        
-        # Guardar al archivo
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(MOVIMIENTOS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(movimientos, f, ensure_ascii=False, indent=2)
+            'lote': item.get('lote', ''),
+            'ubicacion': item.get('ubicacion', ''),
+            'cantidad': item.get('cantidad', 0),
+            'dias_stock': indice_ingresos.dias(codigo, item, ahora)
+        })
+    
+    return {
+        'fecha_reporte': datetime.now().isoformat(),
+        'tramos': etiquetas,
+        'grupos': [{'tipo': clave[0], 'ubicacion': clave[1], 'tramos': grupo} for clave, grupo in sorted(grupos.items())],
+        'fifo': [dict(zip(CAMPOS_ARTICULO, clave), retirar_primero=lotes[0]['codigo'], lotes=lotes)
+                 for clave, lotes in sorted(articulos.items())]
+    }
+
+def picking_fifo(stock, articulo, cantidad):
+    """Lotes a retirar (del más antiguo al más nuevo) para cubrir `cantidad` de un artículo"""
+    fifo = reporte_antiguedad_lotes(stock, tipo=articulo.get('tipo'))['fifo']
+    lotes = [lote for entrada in fifo
+             if all(not articulo.get(campo) or str(entrada[campo]) == str(articulo[campo]) for campo in CAMPOS_ARTICULO)
+             for lote in entrada['lotes']]
+    lotes.sort(key=lambda lote: -lote['dias_stock'])
+    retiros, pendiente = [], cantidad
+    for lote in lotes:
+        if pendiente <= 0:
+            break
+        tomar = min(pendiente, lote['cantidad'])
+        retiros.append(dict(lote, retirar=tomar))
+        pendiente -= tomar
+    return {'retiros': retiros, 'cantidad_cubierta': cantidad - max(pendiente, 0), 'faltante': max(pendiente, 0)}
+
+# =====================================
+# BÚSQUEDA DE STOCK (ÍNDICE INVERTIDO)
+# =====================================
+
+# Campos indexados y su peso en el ranking
+PESOS_BUSQUEDA = {'lote': 4, 'proveedor': 3, 'titulo': 3, 'tipo': 2, 'caracteristica': 2, 'color': 2, 'ubicacion': 1}
+PESO_BUSQUEDA_CODIGO = 1
+PATRON_TOKEN = re.compile(r'[a-z0-9]+(?:[/.][a-z0-9]+)*')
+MAX_RESULTADOS_BUSQUEDA = 50
+
+def tokens_busqueda(texto):
+    """Tokens de búsqueda: minúsculas, sin acentos; '24/1' o '2.5' quedan como un token"""
+    texto = unicodedata.normalize('NFKD', str(texto or '').lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return PATRON_TOKEN.findall(texto)
+
+class IndiceBusqueda:
+    """Índice invertido token -> {código: peso} con vocabulario ordenado para prefijos
+    
+    Se arma una vez desde el stock y después cada cambio confirmado solo reindexa
+    los códigos tocados. Una consulta resuelve cada término con una búsqueda binaria
+    sobre el vocabulario, sin recorrer los productos.
+    """
+    
+    def __init__(self):
+        self._postings = {}
+        self._tokens = {}
+        self._cantidades = {}
+        self._tipos = {}
+        self._vocabulario = []
+        self._inicializado = False
+        self._lock = threading.Lock()
+    
+    def inicializar(self, stock=None):
+        stock = stock_para_indice(stock)
+        with self._lock:
+            self._postings, self._tokens, self._cantidades, self._tipos, self._vocabulario = {}, {}, {}, {}, []
+            for codigo, item in stock.items():
+                self._agregar(codigo, item)
+            self._vocabulario = sorted(self._postings)
+            self._inicializado = True
+    
+    def asegurar(self):
+        if not self._inicializado:
+            self.inicializar()
+    
+    def _pesos(self, codigo, item):
+        pesos = defaultdict(int)
+        for token in tokens_busqueda(codigo):
+            pesos[token] = PESO_BUSQUEDA_CODIGO
+        for campo, peso in PESOS_BUSQUEDA.items():
+            for token in tokens_busqueda(item.get(campo)):
+                pesos[token] = max(pesos[token], peso)
+        return pesos
+    
+    def _agregar(self, codigo, item, ordenar=False):
+        pesos = self._pesos(codigo, item)
+        for token, peso in pesos.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                if ordenar:
+                    bisect.insort(self._vocabulario, token)
+            self._postings[token][codigo] = peso
+        self._tokens[codigo] = list(pesos)
+        self._cantidades[codigo] = item.get('cantidad', 0) or 0
+        self._tipos[codigo] = item.get('tipo')
+    
+    def _quitar(self, codigo):
+        for token in self._tokens.pop(codigo, []):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(codigo, None)
+            if not posting:
+                del self._postings[token]
+                posicion = bisect.bisect_left(self._vocabulario, token)
+                if posicion < len(self._vocabulario) and self._vocabulario[posicion] == token:
+                    del self._vocabulario[posicion]
+        self._cantidades.pop(codigo, None)
+        self._tipos.pop(codigo, None)
+    
+    def aplicar(self, stock_data, modificados, eliminados, movimientos, completo=False):
+        """Observador de cambios: reindexar solo los códigos afectados"""
+        if completo:
+            self.inicializar(stock_data)
+            return
+        if not self._inicializado:
+            return
+        modificados = set(modificados)
+        with self._lock:
+            for codigo in modificados | set(eliminados):
+                self._quitar(codigo)
+                if codigo in modificados and stock_data and codigo in stock_data:
+                    self._agregar(codigo, stock_data[codigo], ordenar=True)
+    
+    def buscar(self, consulta, limite=10, tipo=None, desde=0):
+        """Códigos que contienen todos los términos (completos o como prefijo), mejor puntaje primero
         
-    except Exception as e:
-        print(f"Error guardando movimiento JSON: {e}")
+        Devuelve (total de coincidencias, [(código, puntaje)]) con la página que empieza
+        en `desde`; la coincidencia exacta de un término vale el doble que la de prefijo.
+        Con `tipo` solo cuentan los productos de ese tipo.
+        """
+        terminos = tokens_busqueda(consulta)
+        if not terminos:
+            return 0, []
+        self.asegurar()
+        with self._lock:
+            puntajes = None
+            for termino in terminos:
+                del_termino = {}
+                posicion = bisect.bisect_left(self._vocabulario, termino)
+                while posicion < len(self._vocabulario) and self._vocabulario[posicion].startswith(termino):
+                    token = self._vocabulario[posicion]
+                    factor = 2 if token == termino else 1
+                    for codigo, peso in self._postings[token].items():
+                        if puntajes is None or codigo in puntajes:
+                            del_termino[codigo] = max(del_termino.get(codigo, 0), peso * factor)
+                    posicion += 1
+                puntajes = del_termino if puntajes is None else {codigo: puntajes[codigo] + puntaje
+                                                                  for codigo, puntaje in del_termino.items()}
+                if not puntajes:
+                    return 0, []
+            if tipo:
+                puntajes = {codigo: puntaje for codigo, puntaje in puntajes.items() if self._tipos.get(codigo) == tipo}
+            cantidades = self._cantidades
+            ranking = sorted(puntajes.items(), key=lambda par: (-par[1], cantidades.get(par[0], 0) <= 0, par[0]))
+        return len(ranking), ranking[desde:desde + limite]
 
-def obtener_titulos(tipo_hilado):
-    """Obtener títulos disponibles para un tipo de hilado"""
-    hilado = CATALOGO_DE_HILOS.get(tipo_hilado)
-    if hilado is None:
-        return []
-    if isinstance(hilado, dict):
-        return list(hilado.keys())
-    if isinstance(hilado, list):
-        return hilado
-    return []
+indice_busqueda = IndiceBusqueda()
+registrar_observador(indice_busqueda.aplicar)
 
-def obtener_caracteristicas(tipo_hilado, titulo):
-    """Obtener características disponibles para un hilo específico"""
-    hilado = CATALOGO_DE_HILOS.get(tipo_hilado)
-    if hilado is None:
-        return []
-    if tipo_hilado == "Melange":
-        porcentajes = hilado.get(titulo, {}).get("Porcentaje", [])
-        return porcentajes
-    if isinstance(hilado, dict):
-        return hilado.get(titulo, {}).get("caracteristica", [])
-    return []
+def parametros_historia():
+    """Leer intervalo, desde y hasta de la query string"""
+    desde, hasta = request.args.get('desde'), request.args.get('hasta')
+    return {
+        'intervalo': request.args.get('intervalo', 'dia'),
+        'desde': datetime.fromisoformat(desde) if desde else None,
+        'hasta': leer_fecha_historica(hasta) if hasta else None
+    }
 
 # =====================================
 # RUTAS PRINCIPALES
@@ -630,38 +4161,21 @@ def deposito_dashboard():
 @app.route('/deposito/dashboard')
 def deposito_dashboard_view():
     """Dashboard principal del depósito con estadísticas"""
-    stock = cargar_stock()
-    umbrales = cargar_umbrales()
+    modelo = modelo_stock.obtener()
     
     # Calcular estadísticas generales
-    total_productos = len(stock)
+    total_productos = len(modelo)
     productos_criticos = 0
-    valor_total_stock = 0
     productos_sin_stock = 0
     
-    for codigo, item in stock.items():
-        cantidad = item.get('cantidad', 0)
+    # Mismos umbrales (configuración y reglas) y criterio que /api/estadisticas
+    for cantidad, umbral_bajo, umbral_critico in zip(modelo.cantidad, *umbrales_por_fila(modelo)):
         if cantidad == 0:
             productos_sin_stock += 1
-        
-        # Obtener umbral según tipo de hilo y formato
-        tipo_hilo = item.get('tipo', 'Algodón')
-        formato = item.get('formato', 'cajas')
-        umbral = umbrales.get(tipo_hilo, {}).get(formato, 0)
-        
-        if cantidad <= umbral:
+        if cantidad == 0 or cantidad <= umbral_critico:
             productos_criticos += 1
-        
-        # Calcular valor estimado
-        if formato == "cajas":
-            kilos_por_caja = item.get('kilos_por_caja', 0)
-            valor_total_stock += cantidad * kilos_por_caja * 10  # Precio estimado por kg
-        elif formato == "Palletizado":
-            kilos_por_pallet = item.get('kilos_por_pallet', 0)
-            valor_total_stock += cantidad * kilos_por_pallet * 10
-        else:
-            precio = item.get('precio_unitario', 0)
-            valor_total_stock += cantidad * precio
+    
+    valor_total_stock = round(valorizacion_stock.obtener()['valor_total'], 2)
     
     estadisticas = {
         'total_productos': total_productos,
@@ -712,46 +4226,23 @@ def deposito_configuracion():
 
 @app.route('/api/estadisticas')
 def api_estadisticas():
-    """API para obtener estadísticas del dashboard"""
+    """API para obtener estadísticas del dashboard (todo el stock o ?ubicacion=...)"""
     try:
-        stock = cargar_stock()
-        umbrales = cargar_umbrales()
+        ubicacion = request.args.get('ubicacion')
+        modelo = modelo_ubicacion(ubicacion)
+        valorizacion = calcular_valorizacion(modelo) if ubicacion else valorizacion_stock.obtener()
         
         # Contadores iniciales
-        total_productos = len(stock)
-        total_kilos = 0
-        productos_activos = 0
-        ubicaciones = set()
+        total_productos = len(modelo)
+        productos_activos = sum(1 for cantidad in modelo.cantidad if cantidad > 0)
+        ubicaciones = [ubicacion for ubicacion in modelo.categorias['ubicacion'] if ubicacion]
         stock_critico = 0
         stock_bajo = 0
         stock_normal = 0
         stock_exceso = 0
         
-        for codigo, item in stock.items():
-            cantidad = item.get('cantidad', 0)
-            ubicacion = item.get('ubicacion', '')
-            tipo_hilo = item.get('tipo', 'Algodón')
-            formato = item.get('formato', 'cajas')
-            
-            # Contar productos activos
-            if cantidad > 0:
-                productos_activos += 1
-            
-            # Agregar ubicaciones únicas
-            if ubicacion:
-                ubicaciones.add(ubicacion)
-            
-            # Calcular kilos totales
-            if formato == "cajas":
-                kilos_por_caja = item.get('kilos_por_caja', 0)
-                if kilos_por_caja > 0:
-                    total_kilos += cantidad * kilos_por_caja
-                else:
-                    total_kilos += cantidad * 25  # Estimación por defecto
-            
-            # Clasificar según umbrales
-            umbral_bajo = umbrales.get(tipo_hilo, {}).get(formato, 10)
-            umbral_critico = max(1, umbral_bajo // 2)
+        # Clasificar según umbrales (resueltos una vez por combinación de atributos)
+        for cantidad, umbral_bajo, umbral_critico in zip(modelo.cantidad, *umbrales_por_fila(modelo)):
             umbral_exceso = umbral_bajo * 3
             
             if cantidad == 0 or cantidad <= umbral_critico:
@@ -765,7 +4256,8 @@ def api_estadisticas():
         
         estadisticas = {
             'total_productos': total_productos,
-            'total_kilos': round(total_kilos, 1),
+            'total_kilos': round(valorizacion['total_kilos'], 1),
+            'valor_total': round(valorizacion['valor_total'], 2),
             'productos_activos': productos_activos,
             'ubicaciones': len(ubicaciones),
             'stock_critico': stock_critico,
@@ -782,36 +4274,36 @@ def api_estadisticas():
 
 @app.route('/api/graficos')
 def api_graficos():
-    """API para obtener datos de gráficos"""
+    """API para obtener datos de gráficos (todo el stock o ?ubicacion=...)"""
     try:
-        stock = cargar_stock()
+        ubicacion = request.args.get('ubicacion')
+        modelo = modelo_ubicacion(ubicacion)
         
-        # Datos por tipo de hilado
-        tipos_count = {}
-        ubicaciones_count = {}
-        
-        for codigo, item in stock.items():
-            tipo = item.get('tipo', 'Sin tipo')
-            ubicacion = item.get('ubicacion', 'Sin ubicación')
-            cantidad = item.get('cantidad', 0)
-            
-            tipos_count[tipo] = tipos_count.get(tipo, 0) + cantidad
-            ubicaciones_count[ubicacion] = ubicaciones_count.get(ubicacion, 0) + cantidad
+        # Datos por tipo de hilado y por ubicación, sumados sobre las columnas
+        tipos_count = modelo.sumar_por('tipo', etiqueta_vacia='Sin tipo')
+        ubicaciones_count = modelo.sumar_por('ubicacion', etiqueta_vacia='Sin ubicación')
         
         # Preparar datos para Chart.js
         por_tipo = {
             'labels': list(tipos_count.keys()),
-            'data': list(tipos_count.values())
+            'data': [numero_json(cantidad) for cantidad in tipos_count.values()]
         }
         
         por_ubicacion = {
             'labels': list(ubicaciones_count.keys()),
-            'data': list(ubicaciones_count.values())
+            'data': [numero_json(cantidad) for cantidad in ubicaciones_count.values()]
+        }
+        
+        valorizacion = (calcular_valorizacion(modelo) if ubicacion else valorizacion_stock.obtener())['por_tipo']
+        kilos_por_tipo = {
+            'labels': list(valorizacion.keys()),
+            'data': [totales['kilos'] for totales in valorizacion.values()]
         }
         
         return jsonify({
             'por_tipo': por_tipo,
-            'por_ubicacion': por_ubicacion
+            'por_ubicacion': por_ubicacion,
+            'kilos_por_tipo': kilos_por_tipo
         })
         
     except Exception as e:
@@ -822,10 +4314,18 @@ def api_graficos():
 def api_movimientos():
     """API para obtener historial de movimientos de stock - DEPLOY v1.2"""
     try:
-        movimientos = cargar_movimientos()
+        # Filtros opcionales: ?limit=N&tipo=ingreso&fecha=AAAA-MM-DD&ubicacion=...
+        limit = request.args.get('limit', type=int)
+        fecha = request.args.get('fecha')
+        movimientos = cargar_movimientos(
+            limite=limit,
+            tipo=request.args.get('tipo'),
+            desde=datetime.fromisoformat(fecha) if fecha else None,
+            hasta=leer_fecha_historica(fecha) if fecha else None,
+            ubicacion=request.args.get('ubicacion'))
         
-        # Si no hay movimientos, mostrar mensaje informativo
-        if not movimientos:
+        # Si no hay movimientos (y no se filtró), mostrar mensaje informativo
+        if not movimientos and not (fecha or request.args.get('tipo') or request.args.get('ubicacion')):
             movimientos = [{
                 'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 'tipo': 'INFO',
@@ -836,11 +4336,6 @@ def api_movimientos():
                 'usuario': 'Sistema'
             }]
         
-        # Aplicar límite si se especifica
-        limit = request.args.get('limit', type=int)
-        if limit and len(movimientos) > limit:
-            movimientos = movimientos[:limit]
-        
         return jsonify(movimientos)
         
     except Exception as e:
@@ -853,60 +4348,51 @@ def api_movimientos():
 
 @app.route('/api/deposito/productos', methods=['GET'])
 def api_deposito_obtener_productos():
-    """API para obtener todos los productos del depósito"""
+    """API para obtener todos los productos del depósito (o solo los de ?ubicacion=...)"""
     print("🔍 API llamada - obteniendo productos...")
-    stock = cargar_stock()
+    stock = cargar_stock(request.args.get('ubicacion'))
     print(f"📦 Stock cargado: {len(stock)} items")
     return jsonify(stock)
 
-@app.route('/api/deposito/producto/<codigo>', methods=['GET'])
+@app.route('/api/deposito/producto/<path:codigo>', methods=['GET'])
 def api_deposito_obtener_producto(codigo):
     """API para obtener un producto específico"""
-    stock = cargar_stock()
-    if codigo in stock:
-        return jsonify(stock[codigo])
+    producto = obtener_producto(codigo)
+    if producto is not None:
+        return jsonify(producto)
     return jsonify({'error': 'Producto no encontrado'}), 404
 
-@app.route('/api/deposito/producto/<codigo>', methods=['PUT'])
+@app.route('/api/deposito/producto/<path:codigo>', methods=['PUT'])
+@idempotente
 def api_deposito_actualizar_producto(codigo):
     """API para actualizar un producto específico"""
     try:
         data = request.get_json()
-        stock = cargar_stock()
-        
-        if codigo not in stock:
-            return jsonify({'error': 'Producto no encontrado'}), 404
         
-        # Guardar valores anteriores para el log
-        producto_anterior = stock[codigo].copy()
-        cantidad_anterior = producto_anterior.get('cantidad', 0)
-        
-        # Actualizar campos proporcionados
-        for key, value in data.items():
-            if key in ['cantidad', 'precio_unitario']:
-                stock[codigo][key] = float(value) if value is not None else stock[codigo].get(key, 0)
-            else:
-                stock[codigo][key] = value
-        
-        stock[codigo]['ultima_modificacion'] = datetime.now().isoformat()
+        if data.get('ubicacion'):
+            # Cambiar de ubicación es una transferencia: el lote cambia de código
+            codigo, producto = actualizar_con_transferencia(codigo, data)
+            return jsonify({'success': True, 'message': 'Producto actualizado correctamente',
+                            'codigo': codigo, 'producto': producto})
         
-        # Registrar movimiento si cambió la cantidad
-        cantidad_nueva = stock[codigo].get('cantidad', 0)
-        if cantidad_anterior != cantidad_nueva:
-            diferencia = cantidad_nueva - cantidad_anterior
-            descripcion = f"{producto_anterior.get('tipo', '')} {producto_anterior.get('titulo', '')} {producto_anterior.get('color', '')}".strip()
-            tipo_movimiento = 'AJUSTE'
-            
-            guardar_movimiento(tipo_movimiento, codigo, f"Actualización de stock: {descripcion}", 
-                             diferencia, producto_anterior.get('ubicacion', ''), 'Sistema')
+        if coalescedor_ajustes:
+            # Modo write-behind: se confirma junto a otros ajustes de la misma ventana
+            producto = coalescedor_ajustes.enviar(codigo, data)
+        else:
+            stock = cargar_productos([codigo])
+            modificados, movimientos = set(), []
+            producto = aplicar_actualizacion(stock, codigo, data, modificados, movimientos)
+            guardar_cambios(stock, modificados=modificados, movimientos=movimientos)
         
-        guardar_stock(stock)
-        return jsonify({'success': True, 'message': 'Producto actualizado correctamente', 'producto': stock[codigo]})
+        return jsonify({'success': True, 'message': 'Producto actualizado correctamente', 'producto': producto})
     
+    except ProductoNoEncontrado:
+        return jsonify({'error': 'Producto no encontrado'}), 404
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
 @app.route('/api/deposito/producto/<path:codigo>', methods=['DELETE'])
+@idempotente
 def api_deposito_eliminar_producto(codigo):
     """API para eliminar un producto específico"""
     try:
@@ -924,11 +4410,11 @@ def api_deposito_eliminar_producto(codigo):
         descripcion = f"{producto_eliminado.get('tipo', '')} {producto_eliminado.get('titulo', '')} {producto_eliminado.get('color', '')}".strip()
         
         # Registrar movimiento de eliminación
-        guardar_movimiento('EGRESO', codigo, f"Eliminación de producto: {descripcion}", 
-                         -cantidad_eliminada, producto_eliminado.get('ubicacion', ''), 'Sistema')
+        movimiento = crear_movimiento('EGRESO', codigo, f"Eliminación de producto: {descripcion}", 
+                                      -cantidad_eliminada, producto_eliminado.get('ubicacion', ''), 'Sistema')
         
         del stock[codigo]
-        guardar_stock(stock)
+        guardar_cambios(stock, eliminados=[codigo], movimientos=[movimiento])
         
         print(f"✅ Producto eliminado: {codigo} - {descripcion}")
         
@@ -938,7 +4424,36 @@ def api_deposito_eliminar_producto(codigo):
         print(f"❌ Error en eliminación: {e}")
         return jsonify({'success': False, 'error': str(e)}), 400
 
+@app.route('/api/deposito/p/<int:id_producto>', methods=['GET', 'PUT', 'DELETE'])
+def api_deposito_producto_por_id(id_producto):
+    """Mismas operaciones que /api/deposito/producto/<codigo>, direccionadas por id entero"""
+    codigo = codigo_por_id(id_producto)
+    if codigo is None:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    vistas = {'GET': api_deposito_obtener_producto, 'PUT': api_deposito_actualizar_producto,
+              'DELETE': api_deposito_eliminar_producto}
+    return vistas[request.method](codigo)
+
+@app.route('/api/deposito/buscar', methods=['GET'])
+def api_buscar_stock():
+    """Búsqueda por lote, proveedor, código o descripción parcial (p. ej. '24/1 peinado crudo')
+    
+    Devuelve hasta `limit` resultados desde `offset`; `total` permite pedir las páginas siguientes.
+    """
+    try:
+        limite = max(1, min(int(request.args.get('limit', 10)), MAX_RESULTADOS_BUSQUEDA))
+        desde = max(0, int(request.args.get('offset', 0)))
+        total, ranking = indice_busqueda.buscar(request.args.get('q', ''), limite,
+                                                tipo=request.args.get('tipo') or None, desde=desde)
+        productos = cargar_productos([codigo for codigo, _ in ranking])
+        resultados = [dict(productos[codigo], codigo=codigo, puntaje=puntaje)
+                      for codigo, puntaje in ranking if codigo in productos]
+        return jsonify({'success': True, 'total': total, 'resultados': resultados})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
 @app.route('/api/deposito/agregar-hilo', methods=['POST'])
+@idempotente
 def api_agregar_hilo():
     """API para agregar nuevo hilo al stock"""
     try:
@@ -946,73 +4461,226 @@ def api_agregar_hilo():
         stock = cargar_stock()
         
         # Extraer datos del request
-        tipo = data.get('tipo_hilado')
-        titulo = data.get('titulo')
-        caracteristica = data.get('caracteristica')
-        color = data.get('color')
-        lote = data.get('lote')
-        formato = data.get('formato')
-        ubicacion = data.get('ubicacion')
-        proveedor = data.get('proveedor')
-        
-        if not all([tipo, titulo, caracteristica, color, lote, formato, ubicacion, proveedor]):
+        if not all(data.get(campo) for campo in CAMPOS_OBLIGATORIOS_HILO):
             return jsonify({'success': False, 'error': 'Complete todos los campos obligatorios'}), 400
         
-        # Generar código único
-        codigo = f"{tipo}_{titulo}_{caracteristica}_{color}_{lote}_{ubicacion}".replace(' ', '_').replace('&', 'y')
+        # Crear item y sumarlo al stock (si ya existe se suman cantidades)
+        item = construir_item_hilo(data)
+        modificados, movimientos = set(), []
+        codigo = aplicar_ingreso(stock, item, modificados, movimientos)
         
-        # Crear item base
-        item = {
-            'tipo': tipo,
-            'titulo': titulo,
-            'caracteristica': caracteristica,
-            'color': color,
-            'formato': formato,
-            'lote': lote,
-            'ubicacion': ubicacion,
-            'proveedor': proveedor,
-            'fecha_ingreso': datetime.now().isoformat(),
-            'ultima_modificacion': datetime.now().isoformat()
-        }
+        guardar_cambios(stock, modificados=modificados, movimientos=movimientos)
+        return jsonify({'success': True, 'message': 'Hilo agregado correctamente', 'codigo': codigo})
         
-        # Agregar campos específicos según formato
-        if formato == "cajas":
-            item.update({
-                'cantidad': int(data.get('cantidad_cajas', 0)),
-                'kilos_por_caja': float(data.get('kilos_por_caja', 0)),
-                'conos_por_caja': int(data.get('conos_por_caja', 0)),
-                'descripcion_cono': data.get('descripcion_cono', '')
-            })
-        elif formato == "Palletizado":
-            item.update({
-                'cantidad': int(data.get('cantidad_pallets', 0)),
-                'kilos_por_pallet': float(data.get('kilos_por_pallet', 0)),
-                'conos_por_pallet': int(data.get('conos_por_pallet', 0)),
-                'descripcion_cono': data.get('descripcion_cono', '')
-            })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/operaciones-lote', methods=['POST'])
+@idempotente
+def api_operaciones_lote():
+    """API para aplicar un lote de ingresos, ajustes, egresos y transferencias en una sola transacción"""
+    try:
+        data = request.get_json() or {}
+        operaciones = data.get('operaciones')
+        todo_o_nada = bool(data.get('todo_o_nada', False))
         
-        # Verificar si ya existe y sumar cantidades
-        descripcion_movimiento = f"{tipo} {titulo} {caracteristica} {color}"
-        cantidad_movimiento = item['cantidad']
+        if not isinstance(operaciones, list) or not operaciones:
+            return jsonify({'success': False, 'error': 'Debe enviar una lista de operaciones'}), 400
+        if len(operaciones) > MAX_OPERACIONES_LOTE:
+            return jsonify({'success': False, 'error': f'Máximo {MAX_OPERACIONES_LOTE} operaciones por lote'}), 400
         
-        if codigo in stock:
-            cantidad_anterior = stock[codigo]['cantidad']
-            stock[codigo]['cantidad'] += item['cantidad']
-            stock[codigo]['ultima_modificacion'] = datetime.now().isoformat()
-            
-            # Registrar movimiento de suma
-            guardar_movimiento('AJUSTE', codigo, f"Suma a stock existente: {descripcion_movimiento}", 
-                             cantidad_movimiento, ubicacion, 'Sistema')
-        else:
-            stock[codigo] = item
-            
-            # Registrar movimiento de ingreso nuevo
-            guardar_movimiento('INGRESO', codigo, f"Nuevo ingreso: {descripcion_movimiento}", 
-                             cantidad_movimiento, ubicacion, 'Sistema')
+        stock = cargar_stock()
+        modificados, eliminados, movimientos = set(), set(), []
+        resultados = []
+        errores = 0
         
-        guardar_stock(stock)
-        return jsonify({'success': True, 'message': 'Hilo agregado correctamente', 'codigo': codigo})
+        for indice, operacion in enumerate(operaciones):
+            tipo_operacion = operacion.get('operacion') if isinstance(operacion, dict) else None
+            try:
+                resultado = aplicar_operacion(stock, operacion, modificados, eliminados, movimientos)
+                resultados.append({'indice': indice, 'operacion': tipo_operacion, 'success': True, **resultado})
+            except (OperacionInvalida, KeyError, TypeError, ValueError) as e:
+                errores += 1
+                resultados.append({'indice': indice, 'operacion': tipo_operacion, 'success': False, 'error': str(e)})
+        
+        if errores and todo_o_nada:
+            return jsonify({'success': False, 'error': 'Lote rechazado: hay operaciones inválidas',
+                            'aplicadas': 0, 'errores': errores, 'resultados': resultados}), 400
+        
+        if modificados or eliminados or movimientos:
+            guardar_cambios(stock, modificados=modificados, eliminados=eliminados, movimientos=movimientos)
+        
+        return jsonify({
+            'success': errores == 0,
+            'procesadas': len(operaciones),
+            'aplicadas': len(operaciones) - errores,
+            'errores': errores,
+            'resultados': resultados
+        })
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/transferencia', methods=['POST'])
+@idempotente
+def api_transferencia():
+    """API para mover uno o varios lotes entre ubicaciones en una sola transacción
+    
+    Acepta una transferencia ({codigo|id, ubicacion_destino, cantidad?}) o una lista en
+    `transferencias`; sin cantidad se mueve el lote completo.
+    """
+    try:
+        data = request.get_json() or {}
+        pedidos = data.get('transferencias')
+        if pedidos is None:
+            pedidos = [data]
+        resultados = transferir_lotes(pedidos, data.get('usuario') or 'Sistema')
+        return jsonify({'success': True, 'transferencias': resultados})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/importar-remito', methods=['POST'])
+@idempotente
+def api_importar_remito():
+    """API para importar un remito de proveedor en formato CSV"""
+    try:
+        archivo = request.files.get('archivo')
+        flujo = archivo.stream if archivo else request.stream
+        
+        # Valores comunes a todo el remito (el CSV puede sobreescribirlos por fila)
+        valores_defecto = {campo: request.values.get(campo) for campo in ('proveedor', 'ubicacion', 'formato')
+                           if request.values.get(campo)}
+        valores_defecto.setdefault('ubicacion', 'deposito de descarga')
+        usuario = request.values.get('usuario') or 'Sistema'
+        solo_validar = request.values.get('solo_validar') in ('1', 'true', 'si')
+        codificacion = request.values.get('codificacion') or request.values.get('encoding')
+        
+        resumen = importar_remito(flujo, valores_defecto, usuario, solo_validar, codificacion)
+        resumen['success'] = resumen['filas_con_error'] == 0 and 'interrumpido' not in resumen
+        if 'interrumpido' in resumen:
+            resumen['error'] = f"Archivo interrumpido en la línea {resumen['interrumpido']['linea']}: las filas anteriores ya se importaron"
+        resumen['solo_validar'] = solo_validar
+        return jsonify(resumen)
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/ledger/verificar', methods=['GET'])
+def api_verificar_ledger():
+    """Comparar la tabla stock con el stock reconstruido desde los movimientos"""
+    try:
+        if not engine:
+            return jsonify({'success': False, 'error': 'El ledger de movimientos requiere PostgreSQL'}), 400
+        return jsonify(dict(verificar_ledger(), success=True))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/stock-historico', methods=['GET'])
+def api_stock_historico():
+    """Stock a una fecha pasada (?fecha=AAAA-MM-DD[THH:MM:SS]&agrupar=codigo|tipo|ubicacion)"""
+    try:
+        if not engine:
+            return jsonify({'success': False, 'error': 'El ledger de movimientos requiere PostgreSQL'}), 400
+        if not request.args.get('fecha'):
+            return jsonify({'success': False, 'error': 'Falta el parámetro fecha'}), 400
+        agrupar = request.args.get('agrupar', 'codigo')
+        if agrupar not in AGRUPACIONES_STOCK_HISTORICO:
+            return jsonify({'success': False, 'error': f'agrupar debe ser uno de {AGRUPACIONES_STOCK_HISTORICO}'}), 400
         
+        fecha = leer_fecha_historica(request.args['fecha'])
+        stock, resultado = stock_en_fecha(fecha)
+        respuesta = {
+            'success': True,
+            'fecha': fecha.strftime('%Y-%m-%d %H:%M:%S'),
+            'agrupar': agrupar,
+            'snapshot_id': resultado['snapshot_id'],
+            'eventos_aplicados': resultado['eventos_aplicados'],
+            'productos': len(stock),
+            'cantidad_total': sum(item.get('cantidad', 0) or 0 for item in stock.values())
+        }
+        if agrupar == 'codigo':
+            respuesta['stock'] = [dict(item, codigo=codigo) for codigo, item in sorted(stock.items())]
+        else:
+            respuesta['grupos'] = agrupar_stock(stock, agrupar)
+        return jsonify(respuesta)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/producto/<path:codigo>/historia', methods=['GET'])
+def api_historia_producto(codigo):
+    """Nivel de stock de un lote por día o semana (?intervalo=dia|semana&desde=&hasta=)"""
+    try:
+        return jsonify(dict(serie_stock(codigo=codigo, **parametros_historia()), success=True, codigo=codigo))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/tipo/<tipo>/historia', methods=['GET'])
+def api_historia_tipo(tipo):
+    """Nivel de stock de un tipo de hilado por día o semana (?intervalo=dia|semana&desde=&hasta=)"""
+    try:
+        return jsonify(dict(serie_stock(tipo=tipo, **parametros_historia()), success=True, tipo=tipo))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/pronostico', methods=['GET'])
+def api_pronostico():
+    """Consumo por tipo/título/color, días de cobertura y umbrales sugeridos (precalculado)"""
+    try:
+        resultado, actualizado = tarea_pronostico.obtener()
+        if resultado is None:
+            return jsonify({'success': False, 'error': 'El pronóstico todavía no está disponible'}), 400
+        return jsonify(dict(resultado, success=True))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/sugerencia-compras', methods=['GET'])
+def api_sugerencia_compras():
+    """Pedido sugerido por proveedor (se calcula en segundo plano tras cada cambio)"""
+    try:
+        resultado, actualizado = tarea_sugerencia_compras.obtener(calcular_si_falta=False)
+        if resultado is None:
+            return jsonify({'success': False, 'pendiente': True, 'error': 'El reporte se está generando, reintentar en unos segundos'}), 202
+        return jsonify(dict(resultado, success=True))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/alertas', methods=['GET'])
+def api_alertas():
+    """Últimas alertas de cruce de umbral (?limit=50)"""
+    try:
+        return jsonify({'success': True, 'alertas': alertas_stock.recientes(request.args.get('limit', 50, type=int))})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/alertas/stream')
+def api_alertas_stream():
+    """Alertas en tiempo real como Server-Sent Events (evento 'alerta')"""
+    suscripcion = alertas_stock.suscribir()
+    
+    def eventos():
+        try:
+            yield ': conectado\n\n'
+            while True:
+                try:
+                    alerta = suscripcion.get(timeout=15)
+                except queue.Empty:
+                    # Comentario periódico para mantener viva la conexión
+                    yield ': ping\n\n'
+                    continue
+                yield f"event: alerta\ndata: {json.dumps(alerta, ensure_ascii=False)}\n\n"
+        finally:
+            alertas_stock.desuscribir(suscripcion)
+    
+    return Response(stream_with_context(eventos()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/deposito/ledger/snapshot', methods=['POST'])
+def api_snapshot_ledger():
+    """Tomar ahora un snapshot del stock proyectado desde el ledger"""
+    try:
+        if not engine:
+            return jsonify({'success': False, 'error': 'El ledger de movimientos requiere PostgreSQL'}), 400
+        return jsonify(dict(tomar_snapshot_stock(), success=True))
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
@@ -1022,10 +4690,17 @@ def api_agregar_hilo():
 
 @app.route('/api/reporte/stock-general')
 def api_reporte_stock_general():
-    """API para generar reporte general de stock"""
+    """API para generar reporte general de stock (todo el stock o ?ubicacion=...)"""
     try:
-        stock = cargar_stock()
-        umbrales = cargar_umbrales()
+        ubicacion = request.args.get('ubicacion')
+        stock = cargar_stock(ubicacion)
+        if ubicacion:
+            # Los cachés e índices globales no se arman con un solo fragmento
+            valorizacion = calcular_valorizacion(ColumnasStock.desde_stock(stock))
+        else:
+            valorizacion = valorizacion_stock.obtener(stock)
+            indice_ingresos.asegurar(stock)
+        ahora = time.time()
         
         reporte = []
         total_productos = 0
@@ -1037,31 +4712,16 @@ def api_reporte_stock_general():
             tipo_hilo = item.get('tipo', 'Algodón')
             formato = item.get('formato', 'cajas')
             
-            # Obtener umbrales
-            umbral_bajo = umbrales.get(tipo_hilo, {}).get(formato, 10)
-            umbral_critico = max(1, umbral_bajo // 2)
-            
-            # Determinar estado
-            if cantidad <= umbral_critico:
-                estado = 'Crítico'
-                estado_color = 'danger'
+            # Obtener umbrales y determinar estado
+            umbral_bajo, umbral_critico = umbral_producto(item, tipo_hilo, formato)
+            estado = clasificar_cantidad(cantidad, umbral_bajo, umbral_critico)
+            estado_color = COLORES_ESTADO_STOCK[estado]
+            if estado == 'Crítico':
                 productos_criticos += 1
-            elif cantidad <= umbral_bajo:
-                estado = 'Bajo'
-                estado_color = 'warning'
-            else:
-                estado = 'Normal'
-                estado_color = 'success'
             
-            # Calcular días en stock
-            fecha_ingreso = item.get('fecha_ingreso', '')
-            dias_stock = 0
-            if fecha_ingreso:
-                try:
-                    fecha_ing = datetime.fromisoformat(fecha_ingreso.replace('Z', '+00:00'))
-                    dias_stock = (datetime.now() - fecha_ing).days
-                except:
-                    dias_stock = 0
+            # Días en stock desde el índice de ingresos (fechas ya convertidas)
+            dias_stock = indice_ingresos.dias(codigo, item, ahora)
+            kilos, valor = valorizacion['productos'].get(codigo, (0, 0))
             
             producto_reporte = {
                 'codigo': codigo,
@@ -1079,7 +4739,9 @@ def api_reporte_stock_general():
                 'estado': estado,
                 'estado_color': estado_color,
                 'umbral_bajo': umbral_bajo,
-                'umbral_critico': umbral_critico
+                'umbral_critico': umbral_critico,
+                'kilos': round(kilos, 2),
+                'valor': round(valor, 2)
             }
             
             reporte.append(producto_reporte)
@@ -1093,6 +4755,8 @@ def api_reporte_stock_general():
             'total_productos': total_productos,
             'total_cajas': total_cajas,
             'productos_criticos': productos_criticos,
+            'total_kilos': round(valorizacion['total_kilos'], 1),
+            'valor_total': round(valorizacion['valor_total'], 2),
             'fecha_reporte': datetime.now().isoformat(),
             'productos': reporte
         }
@@ -1103,6 +4767,30 @@ def api_reporte_stock_general():
         print(f"Error en api_reporte_stock_general: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/reporte/antiguedad-lotes')
+def api_reporte_antiguedad_lotes():
+    """Antigüedad de lotes por tipo y ubicación, con sugerencia FIFO por artículo"""
+    try:
+        return jsonify(reporte_antiguedad_lotes(cargar_stock(), tipo=request.args.get('tipo'),
+                                                ubicacion=request.args.get('ubicacion')))
+    except Exception as e:
+        print(f"Error en api_reporte_antiguedad_lotes: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/deposito/fifo')
+def api_picking_fifo():
+    """Lotes a retirar en orden FIFO para cubrir una cantidad de un artículo"""
+    try:
+        articulo = {campo: request.args.get(campo) for campo in CAMPOS_ARTICULO}
+        if not articulo['tipo']:
+            return jsonify({'success': False, 'error': 'Falta el tipo'}), 400
+        cantidad = float(request.args.get('cantidad', 0))
+        if cantidad <= 0:
+            return jsonify({'success': False, 'error': 'La cantidad debe ser mayor a 0'}), 400
+        return jsonify(dict(picking_fifo(cargar_stock(), articulo, cantidad), success=True))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
 # =====================================
 # APIs DE DATOS AUXILIARES
 # =====================================
@@ -1139,6 +4827,42 @@ def api_proveedores():
     """API para obtener lista de proveedores"""
     return jsonify(LISTA_DE_PROVEEDORES)
 
+@app.route('/api/precios', methods=['GET', 'POST'])
+def api_precios():
+    """API para la lista de precios por kg (por tipo y título)"""
+    if request.method == 'GET':
+        return jsonify({'precio_kg_default': PRECIO_KG_DEFAULT, 'precios': cargar_precios()})
+    try:
+        precios = guardar_precios(request.get_json())
+        return jsonify({'success': True, 'message': 'Precios actualizados correctamente', 'precios': precios})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/deposito/valorizacion', methods=['GET'])
+def api_valorizacion():
+    """Kilos y valor del inventario, en total y por tipo"""
+    try:
+        valorizacion = valorizacion_stock.obtener()
+        return jsonify({'success': True,
+                        'total_kilos': round(valorizacion['total_kilos'], 1),
+                        'valor_total': round(valorizacion['valor_total'], 2),
+                        'por_tipo': valorizacion['por_tipo']})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/umbrales/sugeridos')
+def api_umbrales_sugeridos():
+    """Umbrales por tipo y formato sugeridos según el consumo reciente"""
+    try:
+        resultado, _ = tarea_pronostico.obtener()
+        if resultado is None:
+            return jsonify({'success': False, 'error': 'El pronóstico todavía no está disponible'}), 400
+        return jsonify({'success': True, 'generado': resultado['generado'],
+                        'plazo_reposicion_dias': resultado['plazo_reposicion_dias'],
+                        'umbrales': resultado['umbrales_sugeridos']})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
 @app.route('/api/umbrales', methods=['GET', 'POST'])
 def api_umbrales():
     """API para gestionar umbrales de stock"""
@@ -1153,6 +4877,17 @@ def api_umbrales():
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)}), 400
 
+@app.route('/api/umbrales/overrides', methods=['GET', 'POST'])
+def api_umbrales_overrides():
+    """API para las reglas de umbral por titulo, caracteristica, color o proveedor"""
+    if request.method == 'GET':
+        return jsonify(cargar_overrides_umbrales())
+    try:
+        reglas = guardar_overrides_umbrales(request.get_json())
+        return jsonify({'success': True, 'message': f'{len(reglas)} reglas de umbral guardadas', 'reglas': reglas})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
 # =====================================
 # MÓDULOS ADICIONALES (PRÓXIMAMENTE)
 # =====================================
@@ -1210,19 +4945,104 @@ def debug_env():
         return jsonify({'error': str(e)})
 
 @app.route('/debug/stock')
+@reintentar_en_primaria
 def debug_stock():
     """Devuelve todos los productos actuales en la base de datos PostgreSQL (solo lectura)"""
     try:
         if engine:
-            with engine.connect() as conn:
+            with motor_lectura().connect() as conn:
                 result = conn.execute(text("SELECT * FROM stock"))
                 productos = [dict(row) for row in result]
                 return jsonify(productos)
         else:
             return jsonify({'error': 'No hay conexión a PostgreSQL'})
     except Exception as e:
+        if leyendo_de_replica():
+            raise
         return jsonify({'error': str(e)})
 
+# =====================================
+# COMANDOS DE ADMINISTRACIÓN (flask --app app ...)
+# =====================================
+
+@app.cli.command('snapshot-guardar')
+@click.argument('ruta')
+@click.option('--sin-movimientos', is_flag=True, help='Guardar solo el stock')
+def cmd_snapshot_guardar(ruta, sin_movimientos):
+    """Guardar un snapshot compacto del stock y los movimientos"""
+    inicio = time.time()
+    resultado = guardar_snapshot(ruta, incluir_movimientos=not sin_movimientos)
+    print(f"✅ Snapshot guardado en {ruta}: {resultado['productos']} productos, "
+          f"{resultado['movimientos']} movimientos, {resultado['bytes']} bytes ({time.time() - inicio:.2f}s)")
+
+@app.cli.command('snapshot-restaurar')
+@click.argument('ruta')
+@click.option('--sin-movimientos', is_flag=True, help='Restaurar solo el stock')
+def cmd_snapshot_restaurar(ruta, sin_movimientos):
+    """Reemplazar el stock (y los movimientos) por el contenido de un snapshot"""
+    inicio = time.time()
+    resultado = restaurar_snapshot(ruta, incluir_movimientos=not sin_movimientos)
+    print(f"✅ Snapshot restaurado (versión {resultado['version']}, generado {resultado['generado']}): "
+          f"{resultado['productos']} productos, {resultado['movimientos']} movimientos ({time.time() - inicio:.2f}s)")
+
+@app.cli.command('movimientos-particionar')
+def cmd_movimientos_particionar():
+    """Migrar la tabla movimientos de PostgreSQL a particiones mensuales"""
+    if not engine or engine.dialect.name != 'postgresql':
+        print("ℹ️ Las particiones nativas son de PostgreSQL; en SQLite se usa el índice por fecha")
+        return
+    inicio = time.time()
+    copiadas = particiones_movimientos.particionar()
+    if copiadas is None:
+        print("ℹ️ La tabla movimientos ya está particionada por mes")
+    else:
+        print(f"✅ Movimientos particionados por mes: {copiadas} filas ({time.time() - inicio:.2f}s)")
+
+@app.cli.command('movimientos-archivar')
+def cmd_movimientos_archivar():
+    """Comprimir los meses cerrados del historial JSON de movimientos"""
+    historial_movimientos_json.compactar_cerrados()
+    print(f"✅ Historial JSON: {len(historial_movimientos_json.meses())} meses en {MOVIMIENTOS_DIR}")
+
+@app.cli.command('ledger-verificar')
+def cmd_ledger_verificar():
+    """Comparar la tabla stock con la proyección del ledger de movimientos"""
+    if not engine:
+        print("❌ El ledger de movimientos requiere PostgreSQL")
+        return
+    resultado = verificar_ledger()
+    print(f"🔎 Snapshot {resultado['snapshot_id']} + {resultado['eventos_aplicados']} eventos "
+          f"(movimientos {resultado['desde_movimiento']}..{resultado['hasta_movimiento']})")
+    if resultado['consistente']:
+        print(f"✅ Ledger consistente: {resultado['productos_tabla']} productos")
+        return
+    print(f"⚠️ {resultado['total_diferencias']} diferencias entre la tabla stock y el ledger")
+    for diferencia in resultado['diferencias']:
+        print(f"   - {diferencia['codigo']}: {', '.join(diferencia['campos'])}")
+
+@app.cli.command('ledger-snapshot')
+def cmd_ledger_snapshot():
+    """Tomar un snapshot del stock proyectado desde el ledger"""
+    if not engine:
+        print("❌ El ledger de movimientos requiere PostgreSQL")
+        return
+    resultado = tomar_snapshot_stock()
+    if resultado['nuevo_snapshot_id'] is None:
+        print(f"ℹ️ Sin movimientos nuevos desde el snapshot {resultado['snapshot_id']}")
+    else:
+        print(f"✅ Snapshot {resultado['nuevo_snapshot_id']}: {resultado['productos']} productos")
+
+@app.cli.command('ledger-reconstruir')
+def cmd_ledger_reconstruir():
+    """Reescribir la tabla stock reproduciendo el ledger desde el último snapshot"""
+    if not engine:
+        print("❌ El ledger de movimientos requiere PostgreSQL")
+        return
+    inicio = time.time()
+    resultado = reconstruir_stock_desde_ledger()
+    print(f"✅ Stock reconstruido: {resultado['productos']} productos, {resultado['eventos_aplicados']} eventos "
+          f"desde el snapshot {resultado['snapshot_id']} ({time.time() - inicio:.2f}s)")
+
 # =====================================
 # INICIALIZACIÓN DE LA APLICACIÓN
 # =====================================
@@ -15,11 +15,14 @@ Fecha: 2025
 """
 
 from flask import Flask, render_template, request, jsonify, redirect, url_for
+import atexit
 import json
 import os
 from datetime import datetime
 from collections import defaultdict
 
+from almacen_json import AlmacenStockJSON
+
 # =====================================
 # CONFIGURACIÓN DE LA APLICACIÓN
 # =====================================
@@ -31,6 +34,17 @@ DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 STOCK_FILE = os.path.join(DATA_DIR, 'stock.json')
 UMBRALES_FILE = os.path.join(DATA_DIR, 'umbrales_config.json')
 
+# =====================================
+# PERSISTENCIA DIFERIDA DEL STOCK JSON
+# =====================================
+
+# Espera sin escrituras antes de volcar stock.json, y demora máxima durante ráfagas
+STOCK_JSON_ESPERA_MS = int(os.environ.get('STOCK_JSON_ESPERA_MS', 500))
+STOCK_JSON_ESPERA_MAX_MS = int(os.environ.get('STOCK_JSON_ESPERA_MAX_MS', 5000))
+
+almacen_stock_json = AlmacenStockJSON(STOCK_FILE, STOCK_JSON_ESPERA_MS, STOCK_JSON_ESPERA_MAX_MS)
+atexit.register(almacen_stock_json.drenar)
+
 # =====================================
 # CONFIGURACIÓN DE DATOS MAESTROS
 # =====================================
@@ -167,25 +181,22 @@ def verificar_archivos_datos():
     print(f"   - Umbrales: {os.path.exists(UMBRALES_FILE)}")
 
 def cargar_stock():
-    """Cargar datos del stock desde JSON"""
+    """Cargar datos del stock desde JSON (en memoria tras la primera lectura)"""
     try:
-        if not os.path.exists(STOCK_FILE):
+        if not almacen_stock_json.existe():
             print(f"⚠️ Archivo de stock no encontrado: {STOCK_FILE}")
             return {}
-        with open(STOCK_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            print(f"✅ Stock cargado: {len(data)} productos")
-            return data
+        data = almacen_stock_json.cargar()
+        print(f"✅ Stock cargado: {len(data)} productos")
+        return data
     except Exception as e:
         print(f"❌ Error al cargar stock: {e}")
         return {}
 
-def guardar_stock(stock_data):
-    """Guardar datos del stock a JSON"""
+def guardar_stock(stock_data, modificados=None, eliminados=None):
+    """Guardar datos del stock a JSON mediante el almacén con volcado diferido"""
     try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(STOCK_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stock_data, f, ensure_ascii=False, indent=2)
+        almacen_stock_json.guardar(stock_data, modificados, eliminados)
     except Exception as e:
         print(f"Error guardando stock: {e}")
 
@@ -473,7 +484,7 @@ def api_deposito_actualizar_producto(codigo):
         
         stock[codigo]['ultima_modificacion'] = datetime.now().isoformat()
         
-        guardar_stock(stock)
+        guardar_stock(stock, modificados=[codigo])
         return jsonify({'success': True, 'message': 'Producto actualizado correctamente', 'producto': stock[codigo]})
     
     except Exception as e:
@@ -491,7 +502,7 @@ def api_deposito_eliminar_producto(codigo):
         producto_eliminado = stock[codigo].copy()
         del stock[codigo]
         
-        guardar_stock(stock)
+        guardar_stock(stock, eliminados=[codigo])
         
         print(f"🗑️ Producto eliminado: {codigo} - {producto_eliminado.get('tipo', '')} {producto_eliminado.get('titulo', '')}")
         
@@ -560,7 +571,7 @@ def api_agregar_hilo():
         else:
             stock[codigo] = item
         
-        guardar_stock(stock)
+        guardar_stock(stock, modificados=[codigo])
         return jsonify({'success': True, 'message': 'Hilo agregado correctamente', 'codigo': codigo})
         
     except Exception as e:
@@ -0,0 +1,36 @@
+"""Fixtures compartidas: cada prueba importa una copia de app.py en un directorio temporal
+
+Así el stock, los movimientos y la base SQLite no tocan la carpeta data/ del repositorio.
+Las pruebas corren en modo JSON y con una base SQLite.
+"""
+import importlib.util
+import os
+import shutil
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def cargar_app(request, tmp_path, monkeypatch):
+    """Función que importa la copia de app.py con las variables de entorno indicadas"""
+    def cargar(**entorno):
+        shutil.copy(os.path.join(RAIZ, 'app.py'), tmp_path / 'app.py')
+        shutil.copy(os.path.join(RAIZ, 'almacen_json.py'), tmp_path / 'almacen_json.py')
+        if request.param == 'sqlite':
+            monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'stock.db'}")
+        else:
+            monkeypatch.setenv('DATABASE_URL', 'sqlite:///local_data.db')
+        for nombre, valor in entorno.items():
+            monkeypatch.setenv(nombre, str(valor))
+        spec = importlib.util.spec_from_file_location(f'app_prueba_{request.param}', tmp_path / 'app.py')
+        modulo = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(modulo)
+        return modulo
+    return cargar
+
+
+@pytest.fixture
+def cliente(cargar_app):
+    return cargar_app().app.test_client()
@@ -0,0 +1,86 @@
+"""Ajustes de cantidad agrupados por CoalescedorAjustes (COALESCER_AJUSTES_MS > 0)"""
+import threading
+
+import pytest
+
+LOTE = {
+    'tipo_hilado': 'Algodón', 'titulo': '30/1', 'caracteristica': 'Cardado', 'color': 'negro',
+    'lote': 'C1', 'formato': 'cajas', 'ubicacion': 'deposito principal', 'proveedor': 'Emilio Alal',
+    'cantidad_cajas': 100,
+}
+
+
+@pytest.fixture
+def app_agrupada(cargar_app):
+    # Ventana amplia para que los pedidos concurrentes caigan en el mismo grupo
+    return cargar_app(COALESCER_AJUSTES_MS=300)
+
+
+def enviar_en_paralelo(modulo, pedidos):
+    """PUT concurrentes (codigo, datos); devuelve las respuestas en el mismo orden"""
+    respuestas = [None] * len(pedidos)
+    largada = threading.Barrier(len(pedidos))
+    
+    def enviar(posicion, codigo, datos):
+        cliente = modulo.app.test_client()
+        largada.wait()
+        respuestas[posicion] = cliente.put(f'/api/deposito/producto/{codigo}', json=datos)
+    
+    hilos = [threading.Thread(target=enviar, args=(posicion, codigo, datos))
+             for posicion, (codigo, datos) in enumerate(pedidos)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return respuestas
+
+
+def contar_confirmaciones(modulo, monkeypatch):
+    confirmaciones = []
+    guardar_cambios = modulo.guardar_cambios
+    
+    def contar(*args, **kwargs):
+        confirmaciones.append(kwargs.get('movimientos'))
+        return guardar_cambios(*args, **kwargs)
+    monkeypatch.setattr(modulo, 'guardar_cambios', contar)
+    return confirmaciones
+
+
+def test_ajustes_concurrentes_conservan_su_movimiento_y_su_producto(app_agrupada, monkeypatch):
+    codigo = app_agrupada.app.test_client().post('/api/deposito/agregar-hilo', json=LOTE).json['codigo']
+    confirmaciones = contar_confirmaciones(app_agrupada, monkeypatch)
+    cantidades = [90, 80, 70, 60, 50]
+    
+    respuestas = enviar_en_paralelo(app_agrupada, [(codigo, {'cantidad': cantidad}) for cantidad in cantidades])
+    
+    assert [r.status_code for r in respuestas] == [200] * len(cantidades)
+    # Cada pedido ve el producto tal como quedó después de su propia actualización
+    assert [r.json['producto']['cantidad'] for r in respuestas] == cantidades
+    assert len(confirmaciones) < len(cantidades)
+    
+    ajustes = [m for m in app_agrupada.cargar_movimientos() if m['tipo'] == 'AJUSTE']
+    assert len(ajustes) == len(cantidades)
+    final = app_agrupada.cargar_productos([codigo])[codigo]['cantidad']
+    assert final in cantidades
+    assert sum(m['cantidad'] for m in ajustes) == final - LOTE['cantidad_cajas']
+
+
+def test_error_de_un_pedido_no_falla_al_resto_del_grupo(app_agrupada, monkeypatch):
+    cliente = app_agrupada.app.test_client()
+    codigo = cliente.post('/api/deposito/agregar-hilo', json=LOTE).json['codigo']
+    otro = cliente.post('/api/deposito/agregar-hilo', json=dict(LOTE, lote='C2')).json['codigo']
+    confirmaciones = contar_confirmaciones(app_agrupada, monkeypatch)
+    
+    respuestas = enviar_en_paralelo(app_agrupada, [
+        (codigo, {'cantidad': 40}),
+        (codigo, {'cantidad': 'muchas'}),
+        ('NO_EXISTE', {'cantidad': 1}),
+        (otro, {'cantidad': 25}),
+    ])
+    
+    assert [r.status_code for r in respuestas] == [200, 400, 404, 200]
+    assert len(confirmaciones) == 1
+    stock = app_agrupada.cargar_productos([codigo, otro])
+    assert (stock[codigo]['cantidad'], stock[otro]['cantidad']) == (40, 25)
+    ajustes = [m for m in app_agrupada.cargar_movimientos() if m['tipo'] == 'AJUSTE']
+    assert sorted((m['codigo'], m['cantidad']) for m in ajustes) == sorted([(codigo, -60), (otro, -75)])
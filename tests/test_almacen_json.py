@@ -0,0 +1,57 @@
+"""Persistencia diferida del stock JSON: redo log y volcado en segundo plano"""
+import importlib.util
+import json
+import os
+import time
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location('almacen_json', os.path.join(RAIZ, 'almacen_json.py'))
+almacen_json = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(almacen_json)
+
+PRODUCTO = {'codigo': 'A', 'cantidad': 3}
+
+
+@pytest.fixture
+def ruta(tmp_path):
+    return str(tmp_path / 'data' / 'stock.json')
+
+
+def esperar(condicion, limite=5):
+    fin = time.monotonic() + limite
+    while not condicion():
+        assert time.monotonic() < fin, 'tiempo agotado'
+        time.sleep(0.02)
+
+
+def test_redo_log_recupera_cambios_no_volcados(ruta):
+    almacen = almacen_json.AlmacenStockJSON(ruta, espera_ms=60000, espera_max_ms=60000)
+    almacen.guardar({'A': PRODUCTO}, modificados=['A'], eliminados=[])
+    
+    assert not os.path.exists(ruta)
+    # Un proceso nuevo (corte antes del volcado) reaplica el redo log
+    assert almacen_json.AlmacenStockJSON(ruta).cargar() == {'A': PRODUCTO}
+
+
+def test_volcado_fallido_se_reintenta(ruta, monkeypatch):
+    fallas = []
+    reemplazar = os.replace
+    
+    def replace_con_fallas(origen, destino):
+        if len(fallas) < 2:
+            fallas.append(destino)
+            raise OSError(28, 'No space left on device')
+        reemplazar(origen, destino)
+    monkeypatch.setattr(almacen_json.os, 'replace', replace_con_fallas)
+    
+    almacen = almacen_json.AlmacenStockJSON(ruta, espera_ms=10, espera_max_ms=50)
+    almacen.guardar({'A': PRODUCTO}, modificados=['A'], eliminados=[])
+    esperar(lambda: not almacen._volcador_activo)
+    
+    assert len(fallas) == 2
+    with open(ruta, encoding='utf-8') as f:
+        assert json.load(f) == {'A': PRODUCTO}
+    assert not os.path.exists(almacen.ruta_redo)
@@ -0,0 +1,34 @@
+"""Respaldo movimientos JSON escrito en segundo plano por EspejoMovimientosJSON"""
+import pytest
+
+
+@pytest.fixture
+def app_db(cargar_app):
+    modulo = cargar_app()
+    if modulo.engine is None:
+        pytest.skip('el espejo solo se usa con base de datos')
+    return modulo
+
+
+def movimiento(modulo, numero):
+    return modulo.crear_movimiento('AJUSTE', f'E{numero}', f'Ajuste {numero}', numero, 'deposito principal')
+
+
+def test_drenar_escribe_los_lotes_encolados_en_orden(app_db):
+    espejo = app_db.EspejoMovimientosJSON(max_lote=3)
+    for numero in range(10):
+        espejo.encolar([movimiento(app_db, numero)])
+    espejo.drenar()
+    
+    respaldo = app_db.cargar_movimientos_json()
+    assert [m['codigo'] for m in reversed(respaldo)] == [f'E{numero}' for numero in range(10)]
+
+
+def test_cola_llena_escribe_en_linea(app_db, monkeypatch):
+    espejo = app_db.EspejoMovimientosJSON(capacidad=1)
+    # Sin hilo escritor la cola no se vacía: el segundo lote no entra
+    monkeypatch.setattr(espejo, '_iniciar', lambda: None)
+    espejo.encolar([movimiento(app_db, 1)])
+    espejo.encolar([movimiento(app_db, 2)])
+    
+    assert [m['codigo'] for m in app_db.cargar_movimientos_json()] == ['E2']
@@ -0,0 +1,51 @@
+"""Reintentos con Idempotency-Key en los endpoints de escritura"""
+import io
+
+LOTE = {
+    'tipo_hilado': 'Algodón', 'titulo': '20/1', 'caracteristica': 'Peinado', 'color': 'blanco',
+    'lote': 'I1', 'formato': 'cajas', 'ubicacion': 'deposito principal', 'proveedor': 'Tecotex',
+    'cantidad_cajas': 10,
+}
+
+REMITO = (
+    'tipo,titulo,caracteristica,color,lote,cantidad_cajas\n'
+    'Algodón,20/1,Peinado,blanco,{lote},5\n'
+)
+
+
+def cantidad_lote(cliente, lote):
+    stock = cliente.get('/api/deposito/productos').json
+    return sum(item['cantidad'] for item in stock.values() if item.get('lote') == lote)
+
+
+def test_reintento_devuelve_la_respuesta_original_sin_repetir_el_ingreso(cliente):
+    cabeceras = {'Idempotency-Key': 'ingreso-1'}
+    primera = cliente.post('/api/deposito/agregar-hilo', json=LOTE, headers=cabeceras)
+    segunda = cliente.post('/api/deposito/agregar-hilo', json=LOTE, headers=cabeceras)
+    
+    assert primera.status_code == segunda.status_code == 200
+    assert segunda.headers.get('Idempotent-Replayed') == 'true'
+    assert segunda.json == primera.json
+    assert cantidad_lote(cliente, 'I1') == 10
+
+
+def test_misma_clave_con_otro_contenido_se_rechaza(cliente):
+    cabeceras = {'Idempotency-Key': 'ingreso-2'}
+    cliente.post('/api/deposito/agregar-hilo', json=LOTE, headers=cabeceras)
+    respuesta = cliente.post('/api/deposito/agregar-hilo', json=dict(LOTE, cantidad_cajas=99), headers=cabeceras)
+    
+    assert respuesta.status_code == 422
+    assert cantidad_lote(cliente, 'I1') == 10
+
+
+def test_remito_multipart_se_identifica_por_el_contenido_del_archivo(cliente):
+    def importar(lote):
+        return cliente.post('/api/deposito/importar-remito', headers={'Idempotency-Key': 'remito-1'},
+                            content_type='multipart/form-data',
+                            data={'proveedor': 'Tecotex', 'ubicacion': 'deposito principal', 'formato': 'cajas',
+                                  'archivo': (io.BytesIO(REMITO.format(lote=lote).encode('utf-8')), 'remito.csv')})
+    
+    assert importar('R1').status_code == 200
+    assert importar('R1').headers.get('Idempotent-Replayed') == 'true'
+    assert importar('R2').status_code == 422
+    assert (cantidad_lote(cliente, 'R1'), cantidad_lote(cliente, 'R2')) == (5, 0)
@@ -0,0 +1,58 @@
+"""Formato indexado del stock (stock.dat + stock.idx)"""
+import json
+import os
+import struct
+
+import pytest
+
+
+@pytest.fixture
+def archivo_clase(cargar_app):
+    return cargar_app().ArchivoStockIndexado
+
+
+def productos(codigos):
+    return {codigo: {'codigo': codigo, 'cantidad': len(codigo), 'relleno': 'x' * 40 * len(codigo)} for codigo in codigos}
+
+
+def test_indice_de_otra_generacion_se_reconstruye(archivo_clase, tmp_path, monkeypatch):
+    ruta = str(tmp_path / 'stock.dat')
+    archivo = archivo_clase(ruta)
+    archivo.escribir(productos(['A', 'BB']))
+    archivo.punto_de_control()
+    # El archivo compactado termina más allá del fin anotado en el índice viejo
+    archivo.escribir(dict(productos(['DDDDDDDD']), A=None, BB=None))
+    
+    # Corte entre el rename del archivo compactado y el guardado de su índice
+    def cortar(self, fin):
+        raise OSError('corte')
+    monkeypatch.setattr(archivo_clase, '_guardar_indice', cortar)
+    with pytest.raises(OSError):
+        archivo.compactar()
+    monkeypatch.undo()
+    
+    with open(archivo.ruta_indice, encoding='utf-8') as f:
+        assert json.load(f)['generacion'] == 1
+    reabierto = archivo_clase(ruta)
+    assert reabierto.leer_todo() == productos(['DDDDDDDD'])
+    
+    reabierto.punto_de_control()
+    with open(archivo.ruta_indice, encoding='utf-8') as f:
+        assert json.load(f)['generacion'] == 2
+    assert archivo_clase(ruta).leer_todo() == productos(['DDDDDDDD'])
+
+
+def test_archivo_v1_se_lee_y_se_migra_al_compactar(archivo_clase, tmp_path):
+    ruta = str(tmp_path / 'stock.dat')
+    contenido = json.dumps({'codigo': 'X', 'cantidad': 1}).encode('utf-8')
+    with open(ruta, 'wb') as f:
+        f.write(b'ALVSTK01' + struct.pack('>IH', len(contenido), 1) + b'X' + contenido)
+    
+    archivo = archivo_clase(ruta)
+    assert archivo.leer_todo() == {'X': {'codigo': 'X', 'cantidad': 1}}
+    archivo.compactar()
+    
+    with open(ruta, 'rb') as f:
+        assert f.read(16) == b'ALVSTK02' + struct.pack('>Q', 1)
+    assert archivo_clase(ruta).leer_todo() == {'X': {'codigo': 'X', 'cantidad': 1}}
+    assert os.path.exists(archivo.ruta_indice)
@@ -0,0 +1,60 @@
+"""Transferencias encadenadas y de ida y vuelta en un mismo pedido"""
+
+LOTE = {
+    'tipo_hilado': 'Algodón', 'titulo': '24/1', 'caracteristica': 'Peinado', 'color': 'crudo',
+    'lote': 'T1', 'formato': 'cajas', 'proveedor': 'Emilio Alal',
+}
+
+
+def agregar_lote(cliente, ubicacion, cantidad):
+    respuesta = cliente.post('/api/deposito/agregar-hilo',
+                             json=dict(LOTE, ubicacion=ubicacion, cantidad_cajas=cantidad))
+    assert respuesta.status_code == 200, respuesta.json
+    return respuesta.json['codigo']
+
+
+def cantidades_lote(cliente):
+    stock = cliente.get('/api/deposito/productos').json
+    return {item['ubicacion']: item['cantidad'] for item in stock.values() if item.get('lote') == LOTE['lote']}
+
+
+def test_transferencia_encadenada_suma_al_destino_existente(cliente):
+    principal = agregar_lote(cliente, 'deposito principal', 10)
+    agregar_lote(cliente, 'deposito de descarga', 5)
+    tejeduria = principal.replace('deposito_principal', 'deposito_tejeduria')
+    
+    respuesta = cliente.post('/api/deposito/transferencia', json={'transferencias': [
+        {'codigo': principal, 'ubicacion_destino': 'deposito tejeduria'},
+        {'codigo': tejeduria, 'ubicacion_destino': 'deposito de descarga'},
+    ]})
+    
+    assert respuesta.status_code == 200, respuesta.json
+    assert [t['cantidad_destino'] for t in respuesta.json['transferencias']] == [10, 15]
+    assert cantidades_lote(cliente) == {'deposito de descarga': 15}
+
+
+def test_transferencia_ida_y_vuelta_conserva_el_lote(cliente):
+    principal = agregar_lote(cliente, 'deposito principal', 10)
+    tejeduria = principal.replace('deposito_principal', 'deposito_tejeduria')
+    
+    respuesta = cliente.post('/api/deposito/transferencia', json={'transferencias': [
+        {'codigo': principal, 'ubicacion_destino': 'deposito tejeduria'},
+        {'codigo': tejeduria, 'ubicacion_destino': 'deposito principal'},
+    ]})
+    
+    assert respuesta.status_code == 200, respuesta.json
+    assert respuesta.json['transferencias'][-1]['cantidad_destino'] == 10
+    assert cantidades_lote(cliente) == {'deposito principal': 10}
+
+
+def test_operaciones_lote_ida_y_vuelta_conserva_el_lote(cliente):
+    principal = agregar_lote(cliente, 'deposito principal', 10)
+    tejeduria = principal.replace('deposito_principal', 'deposito_tejeduria')
+    
+    respuesta = cliente.post('/api/deposito/operaciones-lote', json={'operaciones': [
+        {'operacion': 'TRANSFERENCIA', 'codigo': principal, 'ubicacion_destino': 'deposito tejeduria'},
+        {'operacion': 'TRANSFERENCIA', 'codigo': tejeduria, 'ubicacion_destino': 'deposito principal'},
+    ]})
+    
+    assert respuesta.status_code == 200, respuesta.json
+    assert cantidades_lote(cliente) == {'deposito principal': 10}
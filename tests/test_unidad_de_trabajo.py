@@ -0,0 +1,50 @@
+"""Unidad de trabajo: producto y movimiento se confirman juntos en la base"""
+import json
+
+import pytest
+from sqlalchemy import text
+
+LOTE = {
+    'tipo_hilado': 'Poal', 'titulo': '16/1', 'caracteristica': 'Open End', 'color': 'gris',
+    'lote': 'U1', 'formato': 'cajas', 'ubicacion': 'deposito principal', 'proveedor': 'Hilados Lear',
+    'cantidad_cajas': 12,
+}
+
+
+@pytest.fixture
+def app_db(cargar_app):
+    modulo = cargar_app()
+    if modulo.engine is None:
+        pytest.skip('requiere base de datos')
+    return modulo
+
+
+def cantidad_en_base(modulo, codigo):
+    with modulo.engine.connect() as conn:
+        return conn.execute(text("SELECT cantidad FROM stock WHERE codigo = :codigo"), {'codigo': codigo}).scalar()
+
+
+def test_ajuste_guarda_producto_y_movimiento_con_imagen(app_db):
+    cliente = app_db.app.test_client()
+    codigo = cliente.post('/api/deposito/agregar-hilo', json=LOTE).json['codigo']
+    
+    assert cliente.put(f'/api/deposito/producto/{codigo}', json={'cantidad': 7}).status_code == 200
+    
+    assert cantidad_en_base(app_db, codigo) == 7
+    with app_db.engine.connect() as conn:
+        fila = conn.execute(text("SELECT cantidad, datos FROM movimientos WHERE tipo = 'AJUSTE' AND codigo = :codigo"),
+                            {'codigo': codigo}).one()
+    assert fila.cantidad == -5
+    assert json.loads(fila.datos)['cantidad'] == 7
+
+
+def test_falla_del_movimiento_no_deja_el_producto_a_medias(app_db, monkeypatch):
+    cliente = app_db.app.test_client()
+    codigo = cliente.post('/api/deposito/agregar-hilo', json=LOTE).json['codigo']
+    monkeypatch.setattr(app_db, 'SQL_INSERTAR_MOVIMIENTO', text("INSERT INTO tabla_inexistente VALUES (:codigo)"))
+    
+    cliente.put(f'/api/deposito/producto/{codigo}', json={'cantidad': 3})
+    
+    assert cantidad_en_base(app_db, codigo) == 12
+    with app_db.engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM movimientos WHERE tipo = 'AJUSTE'")).scalar() == 0